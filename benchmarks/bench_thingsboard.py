@@ -0,0 +1,275 @@
+## Benchmarks of the telemetry fetch and assembly path, against the local thingsboard stand-in or a real server
+#
+#   python -m benchmarks.bench_thingsboard --devices 20 --history-days 30 --output bench.json
+#   python -m benchmarks.bench_thingsboard --url http://host:8080 --username ... --password ... --customer ...
+#
+# Every case runs in its own process so its peak RSS is its own, with the caches and device snapshots in a temporary
+# folder removed at the end. Requests and bytes are counted by the stand-in, they are null against a real server:
+# requests / bytes are the telemetry fetches, setup_requests / setup_bytes the login, device listing and other calls.
+# The JSON report is printed, and written to --output if given.
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os import path, remove
+from urllib.parse import urlparse
+import pandas as pd
+from lib.mCommon.thingsboard import get_tb_client, get_device_directory, device_id_from_spec, get_timeseries_all, \
+    get_timeseries_by_device, get_timeseries_by_devices
+from lib.mCommon.thingsboard_frames import wide_frame_from_arrays
+from lib.mCommon.thingsboard_mock import MockThingsBoard, SyntheticFleet, DEFAULT_KEYS
+
+REPO_PATH = path.dirname(path.dirname(path.realpath(__file__)))
+DEFAULT_BENCH_KEYS = ['data.N.payload.BV', 'data.B.frame_count', 'data.E.payload.T.1', 'data.E.payload.T.2']
+TELEMETRY_ENDPOINT = '/api/plugins/telemetry/.../values/timeseries'
+
+
+# (telemetry, setup) counts of a stats['by_endpoint'] or stats['bytes_by_endpoint'] of the stand-in
+def _split_counts(by_endpoint: dict):
+    telemetry = by_endpoint.get(TELEMETRY_ENDPOINT, 0)
+    return telemetry, sum(by_endpoint.values()) - telemetry
+
+
+# Records of every key of one device, the input of the assembly cases (not timed)
+def _fetch_records(ctx) -> dict:
+    dev = device_id_from_spec(ctx.specs[ctx.names[0]])
+    return {k: get_timeseries_all(ctx.tb_client, dev, k, ctx.start_ts, end_ts=ctx.end_ts, page_limit=ctx.page_limit)
+            for k in ctx.keys}
+
+
+# Assembly as the pages do it: from_records, to_datetime, apply(pd.to_numeric) and a concat per key
+def _assemble_pages_style(dict_raw: dict) -> pd.DataFrame:
+    df_final = pd.DataFrame()
+    for k, data in dict_raw.items():
+        df_data = pd.DataFrame.from_records(data)
+        if df_data.empty:
+            continue
+        df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
+        df_data['value'] = df_data['value'].apply(pd.to_numeric)
+        df_data.set_index('ts', inplace=True)
+        df_data.rename(columns={"value": k}, inplace=True)
+        df_final = pd.concat([df_final, df_data], axis=1)
+    return df_final
+
+
+def case_paging(ctx):
+    dev = device_id_from_spec(ctx.specs[ctx.names[0]])
+    start = time.perf_counter()
+    raw = get_timeseries_all(ctx.tb_client, dev, ctx.keys[0], ctx.start_ts, end_ts=ctx.end_ts,
+                             page_limit=ctx.page_limit)
+    return time.perf_counter() - start, len(raw)
+
+
+def case_paging_raw_json(ctx):
+    dev = device_id_from_spec(ctx.specs[ctx.names[0]])
+    start = time.perf_counter()
+    arrays = get_timeseries_all(ctx.tb_client, dev, ctx.keys[0], ctx.start_ts, end_ts=ctx.end_ts,
+                                page_limit=ctx.page_limit, use_strict_data_types=True, raw_json=True,
+                                result_type='arrays')
+    return time.perf_counter() - start, len(arrays.ts)
+
+
+def case_by_device(ctx):
+    dev = device_id_from_spec(ctx.specs[ctx.names[0]])
+    start = time.perf_counter()
+    raw = get_timeseries_by_device(ctx.tb_client, dev, ctx.keys, start_ts=ctx.start_ts, end_ts=ctx.end_ts)
+    return time.perf_counter() - start, len(raw)
+
+
+def case_by_devices(ctx):
+    start = time.perf_counter()
+    dict_raw, _ = get_timeseries_by_devices(ctx.tb_client, ctx.specs, ctx.keys, start_ts=ctx.start_ts,
+                                            end_ts=ctx.end_ts, page_limit=ctx.page_limit)
+    return time.perf_counter() - start, sum([len(raw) for d in dict_raw.values() for raw in d.values()])
+
+
+def case_assembly(ctx):
+    dict_raw = _fetch_records(ctx)
+    start = time.perf_counter()
+    df = _assemble_pages_style(dict_raw)
+    return time.perf_counter() - start, int(df.count().sum())
+
+
+def case_assembly_frame(ctx):
+    dict_raw, _ = get_timeseries_by_devices(ctx.tb_client, {ctx.names[0]: ctx.specs[ctx.names[0]]}, ctx.keys,
+                                            start_ts=ctx.start_ts, end_ts=ctx.end_ts, page_limit=ctx.page_limit,
+                                            result_type='frame')
+    dict_raw = dict_raw[ctx.names[0]]
+    start = time.perf_counter()
+    df = pd.concat([dict_raw[k] for k in ctx.keys], axis=1)
+    return time.perf_counter() - start, int(df.count().sum())
+
+
+def case_assembly_wide(ctx):
+    dict_raw, _ = get_timeseries_by_devices(ctx.tb_client, {ctx.names[0]: ctx.specs[ctx.names[0]]}, ctx.keys,
+                                            start_ts=ctx.start_ts, end_ts=ctx.end_ts, page_limit=ctx.page_limit,
+                                            result_type='arrays')
+    dict_raw = dict_raw[ctx.names[0]]
+    start = time.perf_counter()
+    df = wide_frame_from_arrays(dict_raw, ctx.keys)
+    return time.perf_counter() - start, int(df.count().sum())
+
+
+def case_excel(ctx):
+    df = _assemble_pages_style(_fetch_records(ctx))
+    file_name = path.join(tempfile.mkdtemp(), 'bench.xlsx')
+    start = time.perf_counter()
+    df.to_excel(file_name, index_label='Timestamp', freeze_panes=(1, 0))
+    elapsed = time.perf_counter() - start
+    remove(file_name)
+    return elapsed, int(df.count().sum())
+
+
+# case name: (function, whether the wall time includes requests)
+CASES = {
+    'paging': (case_paging, True),
+    'paging_raw_json': (case_paging_raw_json, True),
+    'by_device': (case_by_device, True),
+    'by_devices': (case_by_devices, True),
+    'assembly': (case_assembly, False),
+    'assembly_frame': (case_assembly_frame, False),
+    'assembly_wide': (case_assembly_wide, False),
+    'excel': (case_excel, False),
+}
+
+
+class _Context(object):
+    def __init__(self, args):
+        url = urlparse(args.url)
+        self.tb_client = get_tb_client('%s://%s' % (url.scheme, url.hostname), url.port,
+                                       args.username, args.password)
+        self.keys = args.keys
+        self.page_limit = args.page_limit
+        self.end_ts = int(time.time() * 1000)
+        self.start_ts = self.end_ts - int(args.history_days * 86400 * 1000)
+        directory = get_device_directory(self.tb_client, args.customer)
+        self.specs = directory.get_specs(args.names)
+        self.names = [n for n in args.names if n in self.specs]
+        if not self.names:
+            raise SystemExit('none of the devices %s found' % ', '.join(args.names))
+
+
+# Child process side: run one case repeat times and print its measures as JSON
+def run_case(args):
+    ctx = _Context(args)
+    function, _ = CASES[args.case]
+    lst_wall = []
+    points = 0
+    for _ in range(args.repeat):
+        wall, points = function(ctx)
+        lst_wall.append(wall)
+
+    # ru_maxrss is in kB on linux, in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak_rss / 1024.0
+    print(json.dumps({'wall_s': lst_wall, 'points': points, 'peak_rss_mb': round(peak_rss_mb, 1)}))
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_PATH,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_all(args, mock: MockThingsBoard = None) -> dict:
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bench_thingsboard_') as cache_dir:
+        env = dict(os.environ, TB_STREAMLITTOOLS_CACHE=cache_dir)
+        for name in args.cases:
+            cmd = [sys.executable, '-m', 'benchmarks.bench_thingsboard', '--case', name, '--url', args.url,
+                   '--username', args.username, '--password', args.password, '--customer', args.customer,
+                   '--history-days', str(args.history_days), '--page-limit', str(args.page_limit),
+                   '--repeat', str(args.repeat), '--keys'] + args.keys + ['--names'] + args.names
+            if mock is not None:
+                mock.reset_stats()
+            out = subprocess.run(cmd, cwd=REPO_PATH, env=env, check=True, stdout=subprocess.PIPE).stdout
+            measures = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+            wall = statistics.median(measures['wall_s'])
+            requests, setup_requests = _split_counts(mock.stats['by_endpoint']) if mock is not None else (None, None)
+            n_bytes, setup_bytes = _split_counts(mock.stats['bytes_by_endpoint']) if mock is not None else (None, None)
+            result = {'case': name,
+                      'includes_requests': CASES[name][1],
+                      'wall_s': round(wall, 4),
+                      'wall_s_min': round(min(measures['wall_s']), 4),
+                      'runs': len(measures['wall_s']),
+                      'points': measures['points'],
+                      'points_per_s': round(measures['points'] / wall) if wall else None,
+                      'peak_rss_mb': measures['peak_rss_mb'],
+                      # the untimed fetch of the assembly cases included
+                      'requests': requests,
+                      'bytes': n_bytes,
+                      'setup_requests': setup_requests,
+                      'setup_bytes': setup_bytes}
+            results.append(result)
+            print('%-16s %8.3f s %12d points %10s points/s %8.1f MB' %
+                  (name, wall, result['points'], result['points_per_s'], result['peak_rss_mb']), file=sys.stderr)
+
+    return {'commit': _git_commit(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'server': 'mock' if mock is not None else args.url,
+            'params': {'devices': len(args.names), 'keys': args.keys, 'history_days': args.history_days,
+                       'page_limit': args.page_limit, 'repeat': args.repeat,
+                       'period_ms': args.period_ms if mock is not None else None,
+                       'latency_ms': args.latency_ms if mock is not None else None},
+            'results': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the thingsboard fetch and assembly path')
+    parser.add_argument('--cases', nargs='+', default=list(CASES), choices=list(CASES))
+    parser.add_argument('--devices', type=int, default=10, help='devices fetched by the multi-device cases')
+    parser.add_argument('--keys', nargs='+', default=DEFAULT_BENCH_KEYS)
+    parser.add_argument('--history-days', type=float, default=30)
+    parser.add_argument('--page-limit', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='also write the JSON report to this file')
+    # stand-in server
+    parser.add_argument('--period-ms', type=int, default=60000, help='time between two values of a key')
+    parser.add_argument('--latency-ms', type=float, default=5, help='added to every request')
+    # real server instead of the stand-in
+    parser.add_argument('--url', help='thingsboard url, e.g. http://host:8080; the stand-in is used if not given')
+    parser.add_argument('--username', default='bench')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--customer', default='AOMS OPS')
+    parser.add_argument('--names', nargs='+', help='device names, 260A2000... on the stand-in')
+    # child process
+    parser.add_argument('--case', choices=list(CASES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        return run_case(args)
+
+    mock = None
+    if not args.url:
+        fleet = SyntheticFleet(n_devices=args.devices, keys=DEFAULT_KEYS, period_ms=args.period_ms,
+                               history_days=int(args.history_days) + 1, customer_name=args.customer)
+        mock = MockThingsBoard(fleet, latency_ms=args.latency_ms).start()
+        args.url = mock.url
+        args.names = args.names or [fleet.device(i)['name'] for i in range(args.devices)]
+    elif not args.names:
+        raise SystemExit('--names is needed with --url')
+
+    try:
+        report = run_all(args, mock)
+    finally:
+        if mock is not None:
+            mock.stop()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
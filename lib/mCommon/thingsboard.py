@@ -1,110 +1,1450 @@
 ## Common helper functions to interface with thingsboard
 from datetime import datetime
 import time
+import math
+import json
+import re
+import base64
+import threading
 import logging
+from os import path, makedirs
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
+import numpy as np
+# orjson is optional (not in requirements.txt): pip install orjson for faster decoding of raw_json requests
+try:
+    import orjson as fast_json
+except ImportError:
+    fast_json = json
+import pandas as pd
 from tb_rest_client32.rest_client_pe import RestClientPE
 from tb_rest_client32.models.models_ce import DeviceId
+from tb_rest_client32.rest import ApiException
+from lib.mCommon.thingsboard_cache import TimeseriesCache, CACHE_FOLDER
+from lib.mCommon.thingsboard_throttle import RequestThrottle, gThrottle
+from lib.mCommon.thingsboard_metrics import FetchMetrics, gMetrics, show_metrics_expander, session_metrics, \
+    submit_in_context
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_MAX_WORKERS = 32        # threads of the multi-device helpers, gThrottle keeps the requests in flight to what
+                                # thingsboard sustains
+
+AGG_FUNCTIONS = ('MIN', 'MAX', 'AVG', 'SUM', 'COUNT', 'NONE')
+TS_MAX_INTERVALS = 700          # thingsboard default for database.ts_max_intervals, aggregated intervals per request
+AGG_INTERVALS_MS = [1000, 5000, 10000, 30000,
+                    60000, 5*60000, 10*60000, 15*60000, 30*60000,
+                    3600000, 2*3600000, 4*3600000, 6*3600000, 12*3600000,
+                    86400000, 7*86400000]
+
+# Result types of get_timeseries_all():
+#   records     [{'ts': ..., 'value': ...}, ...] as received from thingsboard, newest first
+#   arrays      TimeseriesArrays of int64 ts (ms) and float64 values, oldest first
+#   frame       DataFrame indexed by the datetime 'ts' with one float64 column named after the key, oldest first
+RESULT_TYPES = ('records', 'arrays', 'frame')
+TimeseriesArrays = namedtuple('TimeseriesArrays', ['ts', 'value'])
+
+DEVICE_DIRECTORY_TTL_SECONDS = 10 * 60                  # list new devices when the directory is older than this
+DEVICE_DIRECTORY_FULL_REFRESH_SECONDS = 3600           # list every device when the directory is older than this
+DEVICE_PAGE_SIZE = 1000
+
+gDeviceDirectories = {}         # DeviceDirectory objects shared by every page of the process, by (host, user, customer)
+gDeviceDirectoriesLock = threading.Lock()
+
+KEY_INDEX_TTL_SECONDS = 60 * 60                         # list the timeseries keys of a device again after this
+
+gKeyIndexes = {}                # TimeseriesKeyIndex objects shared by every page of the process, by (host, user)
+gKeyIndexesLock = threading.Lock()
+
+gTimeseriesCaches = {}          # TimeseriesCache objects shared by every page of the process, by (host, user)
+gTimeseriesCachesLock = threading.Lock()
+
+ASSET_MAX_LEVEL = 3                                     # relation levels followed below an asset (site, area, ...)
+gAssetDevices = {}              # (listed time.time(), {name: device dict}) by (host, user, asset, max_level, relation)
+gAssetDevicesLock = threading.Lock()
+
+DEFAULT_POOL_MAXSIZE = DEFAULT_MAX_WORKERS              # connections kept open to the thingsboard host by each client
+TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60                   # refresh the token when it expires sooner than this
+
+gClients = {}                   # {'client': logged in RestClientPE, 'password', 'lock'} shared by every page of the
+                                # process, by (url, username)
+gClientsLock = threading.Lock()
+
+
+# Claims of a thingsboard JWT, {} if it cannot be read
+def _jwt_claims(token: str) -> dict:
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return {}
+    return claims if isinstance(claims, dict) else {}
+
+
+# Expiry (epoch seconds) of a thingsboard JWT, 0 if it cannot be read
+def _jwt_exp(token: str) -> int:
+    try:
+        return int(_jwt_claims(token)['exp'])
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+# User logged in on tb_client (the subject of its token, the username), '' if it is not logged in. Caches shared by
+# the sessions of the process key on it with the host, a user only gets what thingsboard lets them list
+def client_user(tb_client: RestClientPE) -> str:
+    token_info = getattr(tb_client, 'token_info', None) or {}
+    return str(_jwt_claims(token_info.get('token')).get('sub', ''))
+
+
+# POST a token request on the pool of tb_client and keep the tokens received. Unlike RestClientPE.login() and
+# refresh(), the ApiClient and its warm connection pool are kept: requests read the token from the configuration
+# every time
+def _post_token(tb_client: RestClientPE, url_path: str, body: dict):
+    resp = tb_client.api_client.rest_client.pool_manager.request(
+        'POST', tb_client.base_url + url_path, body=json.dumps(body), headers={'Content-Type': 'application/json'})
+    if resp.status != 200:
+        raise RuntimeError('%s failed with HTTP %d' % (url_path, resp.status))
+
+    token_json = json.loads(resp.data)
+    tb_client.configuration.api_key['X-Authorization'] = token_json['token']
+    tb_client.token_info['token'] = token_json['token']
+    tb_client.token_info['refreshToken'] = token_json['refreshToken']
+
+
+# Exchange the refresh token for a new token, on the existing pool
+def _refresh_token(tb_client: RestClientPE):
+    _post_token(tb_client, '/api/auth/token', {'refreshToken': tb_client.token_info['refreshToken']})
+
+
+# Log in again on the existing pool, when the refresh token is no longer accepted
+def _login_pooled(tb_client: RestClientPE, username: str, password: str):
+    _post_token(tb_client, '/api/auth/login', {'username': username, 'password': password})
+
+
+def _client_entry(url: str, username: str) -> dict:
+    # the global lock only guards the registry, logins and refreshes hold the lock of their entry
+    with gClientsLock:
+        entry = gClients.get((url, username))
+        if entry is None:
+            entry = {'client': None, 'password': None, 'lock': threading.Lock()}
+            gClients[(url, username)] = entry
+        return entry
+
+
+def get_tb_client(host: str, port, username: str, password: str,
+                  pool_maxsize: int = DEFAULT_POOL_MAXSIZE) -> RestClientPE:
+    '''
+    Logged in RestClientPE for host:port and username, shared by every page of the process so the connection pool
+    and the login survive streamlit reruns. The client is created and logged in on first use; afterwards its token is
+    refreshed when it expires within TOKEN_REFRESH_MARGIN_SECONDS, with a new login on the same pool if the refresh
+    fails. A slow login only holds up the callers of the same host and username.
+    '''
+    url = host + ':' + str(port)
+    entry = _client_entry(url, username)
+    with entry['lock']:
+        if entry['client'] is None or entry['password'] != password:
+            tb_client = RestClientPE(base_url=url)
+            # must be set before login(), which creates the ApiClient and its pool
+            tb_client.configuration.connection_pool_maxsize = pool_maxsize
+            tb_client.login(username=username, password=password)
+            logger.debug('get_tb_client(): logged in to %s as %s' % (url, username))
+            entry['client'] = tb_client
+            entry['password'] = password
+            return tb_client
+
+        tb_client = entry['client']
+        if _jwt_exp(tb_client.token_info['token']) - time.time() < TOKEN_REFRESH_MARGIN_SECONDS:
+            try:
+                _refresh_token(tb_client)
+                logger.debug('get_tb_client(): token refreshed for %s on %s' % (username, url))
+            except Exception as e:
+                logger.warning('get_tb_client(): token refresh failed (%s), logging in again' % e)
+                _login_pooled(tb_client, username, password)
+
+        return tb_client
+
+
+# Points and response bytes of an API result: {key: values} of a timeseries request, a page of a listing or the
+# (data, n_bytes) of _request_timeseries_json()
+def _measure(result):
+    data, n_bytes = result if isinstance(result, tuple) else (result, None)
+    if isinstance(data, list):
+        return len(data), n_bytes
+    if isinstance(data, dict):
+        return sum([len(v) for v in data.values() if isinstance(v, list)]), n_bytes
+    return len(getattr(data, 'data', None) or []), n_bytes
+
+
+# Every API request goes through here: gThrottle for the back-pressure, and a request record in gMetrics
+def _call_api(operation: str, dev_id, key: str, function, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        result = gThrottle.call(function, *args, points_of=lambda r: _measure(r)[0], **kwargs)
+    except Exception:
+        gMetrics.record_request(operation, dev_id, key, latency_s=time.perf_counter() - start,
+                                retries=gThrottle.last_retries, error=True)
+        raise
+
+    points, n_bytes = _measure(result)
+    gMetrics.record_request(operation, dev_id, key, latency_s=time.perf_counter() - start, points=points,
+                            n_bytes=n_bytes, retries=gThrottle.last_retries)
+    return result
+
 
 def get_assets_by_customer_name_as_dict(tb_client: RestClientPE, customer_name: str) -> dict:
-    target_customer = tb_client.get_tenant_customer(customer_name)
+    exec_start_ts = time.perf_counter()
+    target_customer = _call_api('tenant_customer', None, None, tb_client.get_tenant_customer, customer_name)
 
     customer_assets = []
     i_page = 0
 
     while True:
-        resp = tb_client.get_customer_assets(target_customer.id, page=i_page)
+        resp = _call_api('customer_assets', None, None, tb_client.get_customer_assets, target_customer.id, page=i_page)
         customer_assets.extend(resp.data)
 
         i_page += 1
-        if i_page > resp.total_pages:
+        if i_page >= resp.total_pages:
             break
 
     # convert to dict
     d = {obj.name: obj for obj in customer_assets}
+    gMetrics.record_call('get_assets_by_customer_name_as_dict', wall_s=time.perf_counter() - exec_start_ts,
+                         pages=i_page, points=len(d))
 
     return d
 
 
 def get_devices_by_customer_name_as_dict(tb_client: RestClientPE, customer_name: str) -> dict:
-    target_customer = tb_client.get_tenant_customer(customer_name)
+    exec_start_ts = time.perf_counter()
+    target_customer = _call_api('tenant_customer', None, None, tb_client.get_tenant_customer, customer_name)
 
     customer_devices = []
     i_page = 0
 
     while True:
-        resp = tb_client.get_customer_devices(target_customer.id, page=i_page)
+        resp = _call_api('customer_devices', None, None, tb_client.get_customer_devices, target_customer.id, page=i_page)
         customer_devices.extend(resp.data)
 
         i_page += 1
-        if i_page > resp.total_pages:
+        if i_page >= resp.total_pages:
             break
 
     dict_all_devices = {d['name']: d for d in customer_devices}
+    gMetrics.record_call('get_devices_by_customer_name_as_dict', wall_s=time.perf_counter() - exec_start_ts,
+                         pages=i_page, points=len(dict_all_devices))
 
     return dict_all_devices
 
 
-# todo:
-def get_devices_by_asset_name_as_dict():
-    pass
+class DeviceDirectory(object):
+    '''
+    Cached directory of the devices of one customer, indexed by name for O(1) lookups, exact or case insensitive.
+
+    Once older than ttl_seconds, only the devices created since the last listing are downloaded (newest first,
+    stopping at the first device already known); when the device count thingsboard reports then differs from the
+    directory's, devices were deleted and every device is listed again. Once older than full_refresh_seconds every
+    device is listed again, so a renamed device, which changes no count, is found under its new name within
+    full_refresh_seconds. With snapshot_path the listing is saved to disk, so a new process starts from the snapshot
+    instead of listing the whole customer.
+    '''
+    def __init__(self, tb_client: RestClientPE, customer_name: str,
+                 ttl_seconds: int = DEVICE_DIRECTORY_TTL_SECONDS,
+                 full_refresh_seconds: int = DEVICE_DIRECTORY_FULL_REFRESH_SECONDS,
+                 snapshot_path: str = None, page_size: int = DEVICE_PAGE_SIZE):
+        self.tb_client = tb_client
+        self._customer_name = customer_name
+        self._ttl_seconds = ttl_seconds
+        self._full_refresh_seconds = full_refresh_seconds
+        self._snapshot_path = snapshot_path
+        self._page_size = page_size
+        self._lock = threading.RLock()
+
+        self._by_name = {}
+        self._by_upper_name = {}
+        self._refresh_ts = 0            # time.time() of the last listing
+        self._full_refresh_ts = 0       # time.time() of the last full listing
+
+        if snapshot_path and path.isfile(snapshot_path):
+            self._load_snapshot()
+
+    def _index(self, devices: list):
+        for d in devices:
+            self._by_name[d['name']] = d
+            self._by_upper_name[d['name'].upper()] = d
+
+    def _load_snapshot(self):
+        try:
+            with open(self._snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self._index(snapshot['devices'])
+            self._refresh_ts = snapshot['refresh_ts']
+            self._full_refresh_ts = snapshot['full_refresh_ts']
+            logger.debug('DeviceDirectory(): %d devices loaded from %s' % (len(self._by_name), self._snapshot_path))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            # start empty, the first lookup lists every device
+            logger.warning('DeviceDirectory(): ignoring unreadable snapshot %s: %s' % (self._snapshot_path, e))
+            self._by_name = {}
+            self._by_upper_name = {}
+            self._refresh_ts = 0
+            self._full_refresh_ts = 0
+
+    def _save_snapshot(self):
+        folder = path.dirname(path.abspath(self._snapshot_path))
+        if not path.isdir(folder):
+            makedirs(folder)
+        with open(self._snapshot_path, 'w', encoding='utf-8') as f:
+            json.dump({'customer_name': self._customer_name,
+                       'refresh_ts': self._refresh_ts,
+                       'full_refresh_ts': self._full_refresh_ts,
+                       'devices': list(self._by_name.values())}, f, default=str)
+
+    def refresh(self, full: bool = False):
+        '''
+        List the devices created since the last listing, or every device with full set
+        '''
+        with self._lock:
+            exec_start_ts = time.perf_counter()
+            target_customer = _call_api('tenant_customer', None, None,
+                                        self.tb_client.get_tenant_customer, self._customer_name)
+            newest_created_ts = max([d.get('createdTime') or 0 for d in self._by_name.values()] or [0])
+            full = full or not self._by_name
+
+            devices = []
+            i_page = 0
+            n_pages = 0
+            total_elements = None
+            while True:
+                resp = _call_api('customer_devices', None, None, self.tb_client.get_customer_devices,
+                                 target_customer.id, page_size=self._page_size, page=i_page,
+                                 sort_property='createdTime', sort_order='DESC')
+                n_pages += 1
+                if total_elements is None:
+                    total_elements = getattr(resp, 'total_elements', None)
+                if full:
+                    devices.extend(resp.data)
+                else:
+                    new_devices = [d for d in resp.data if (d.get('createdTime') or 0) > newest_created_ts]
+                    devices.extend(new_devices)
+                    if len(new_devices) < len(resp.data):
+                        break
+
+                i_page += 1
+                if i_page >= resp.total_pages:
+                    break
+
+            if not full and total_elements is not None and len(self._by_name) + len(devices) != total_elements:
+                logger.debug('DeviceDirectory.refresh(): %d devices known, %d listed by thingsboard, listing every '
+                             'device' % (len(self._by_name) + len(devices), total_elements))
+                return self.refresh(full=True)
+
+            if full:
+                self._by_name = {}
+                self._by_upper_name = {}
+                self._full_refresh_ts = time.time()
+            self._index(devices)
+            self._refresh_ts = time.time()
+            gMetrics.record_call('DeviceDirectory.refresh_full' if full else 'DeviceDirectory.refresh_new',
+                                 wall_s=time.perf_counter() - exec_start_ts, pages=n_pages, points=len(devices))
+
+            if self._snapshot_path:
+                self._save_snapshot()
+
+    def _ensure_fresh(self):
+        with self._lock:
+            now = time.time()
+            if now - self._full_refresh_ts > self._full_refresh_seconds:
+                self.refresh(full=True)
+            elif now - self._refresh_ts > self._ttl_seconds:
+                self.refresh()
+
+    def get(self, name: str):
+        '''
+        :return: device dict of name, matched exactly or else case insensitively, None if not found
+        '''
+        self._ensure_fresh()
+        return self._by_name.get(name) or self._by_upper_name.get(name.upper())
+
+    def get_specs(self, names: list) -> dict:
+        '''
+        :return: {name: device dict} for every name found, keyed by the names as given
+        '''
+        self._ensure_fresh()
+        specs = {}
+        for name in names:
+            spec = self._by_name.get(name) or self._by_upper_name.get(name.upper())
+            if spec is not None:
+                specs[name] = spec
+
+        return specs
+
+    def as_dict(self) -> dict:
+        '''
+        :return: {name: device dict} of every device, as get_devices_by_customer_name_as_dict() does
+        '''
+        self._ensure_fresh()
+        return dict(self._by_name)
+
+
+# Shared DeviceDirectory of customer_name on the host of tb_client for the user logged in on it, created on first use
+# with a snapshot in CACHE_FOLDER. Every page of the process gets the same directory for the same user
+def get_device_directory(tb_client: RestClientPE, customer_name: str,
+                         ttl_seconds: int = DEVICE_DIRECTORY_TTL_SECONDS) -> DeviceDirectory:
+    host = getattr(tb_client, 'base_url', '')
+    user = client_user(tb_client)
+    with gDeviceDirectoriesLock:
+        directory = gDeviceDirectories.get((host, user, customer_name))
+        if directory is None:
+            snapshot_name = re.sub(r'[^A-Za-z0-9]+', '_', 'devices_%s_%s_%s' % (host, user, customer_name)) + '.json'
+            directory = DeviceDirectory(tb_client, customer_name, ttl_seconds=ttl_seconds,
+                                        snapshot_path=path.join(CACHE_FOLDER, snapshot_name))
+            gDeviceDirectories[(host, user, customer_name)] = directory
+
+    # pages log in again on every run, always list with the newest client of that user
+    directory.tb_client = tb_client
+
+    return directory
+
+
+# TimeseriesCache of the host and user of tb_client in CACHE_FOLDER, shared by every page of the process: a user only
+# reads back values thingsboard let them download
+def get_timeseries_cache(tb_client: RestClientPE) -> TimeseriesCache:
+    host = getattr(tb_client, 'base_url', '')
+    user = client_user(tb_client)
+    with gTimeseriesCachesLock:
+        cache = gTimeseriesCaches.get((host, user))
+        if cache is None:
+            cache_name = re.sub(r'[^A-Za-z0-9]+', '_', 'timeseries_%s_%s' % (host, user)) + '.sqlite'
+            cache = TimeseriesCache(path.join(CACHE_FOLDER, cache_name))
+            gTimeseriesCaches[(host, user)] = cache
+
+    return cache
+
+
+class TimeseriesKeyIndex(object):
+    '''
+    Timeseries keys every device ever reported, from the timeseries keys endpoint. The keys of a device are listed
+    the first time it is looked up and again once older than ttl_seconds; prefetch() lists many devices concurrently.
+    The fetch helpers use it to request only the keys a device has, a key a device never reported costing an empty
+    round trip otherwise. A device whose keys cannot be listed is assumed to have every key.
+    '''
+    def __init__(self, tb_client: RestClientPE, ttl_seconds: int = KEY_INDEX_TTL_SECONDS,
+                 max_workers: int = DEFAULT_MAX_WORKERS):
+        self.tb_client = tb_client
+        self._ttl_seconds = ttl_seconds
+        self._max_workers = max_workers
+        self._lock = threading.Lock()
+        self._keys = {}             # device id -> (listed time.time(), frozenset of keys)
+
+    def _is_fresh(self, dev_id: DeviceId) -> bool:
+        with self._lock:
+            listed = self._keys.get(dev_id.id)
+        return listed is not None and time.time() - listed[0] <= self._ttl_seconds
+
+    def _list_keys(self, dev_id: DeviceId):
+        try:
+            keys = _call_api('timeseries_keys', dev_id, None, self.tb_client.get_timeseries_keys_v1, dev_id)
+        except ApiException as e:
+            logger.warning('TimeseriesKeyIndex(): cannot list the keys of %s, assuming all keys: %s' % (dev_id.id, e))
+            return None
+
+        keys = frozenset(keys or [])
+        with self._lock:
+            self._keys[dev_id.id] = (time.time(), keys)
+        return keys
+
+    def keys(self, dev) -> frozenset:
+        '''
+        :param dev: DeviceId or device dict
+        :return: the keys of dev, None if they cannot be listed
+        '''
+        dev_id = device_id_from_spec(dev)
+        if not self._is_fresh(dev_id):
+            return self._list_keys(dev_id)
+
+        with self._lock:
+            return self._keys[dev_id.id][1]
+
+    def prefetch(self, dev_specs: dict):
+        '''
+        List the keys of every device of dev_specs ({name: device dict or DeviceId}) not listed or too old
+        '''
+        lst_dev = []
+        for spec in dev_specs.values():
+            try:
+                lst_dev.append(device_id_from_spec(spec))
+            except (KeyError, TypeError):
+                continue
+        lst_dev = [d for d in lst_dev if not self._is_fresh(d)]
+        if not lst_dev:
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self._max_workers, len(lst_dev)))) as executor:
+            for f in [submit_in_context(executor, self._list_keys, d) for d in lst_dev]:
+                f.result()
+
+    def invalidate(self, dev=None):
+        '''
+        Forget the keys of dev, or of every device, they are listed again on the next lookup
+        '''
+        with self._lock:
+            if dev is None:
+                self._keys = {}
+            else:
+                self._keys.pop(device_id_from_spec(dev).id, None)
+
+    def split_keys(self, dev, lst_key: list):
+        '''
+        :return: (present, skipped), the keys of lst_key dev reported and the others, both in lst_key order
+        '''
+        keys = self.keys(dev)
+        if keys is None:
+            return list(lst_key), []
+
+        return [k for k in lst_key if k in keys], [k for k in lst_key if k not in keys]
+
+    def skip_report(self, dev_specs: dict, lst_key: list) -> dict:
+        '''
+        :return: {name: [skipped keys]} of the devices of dev_specs missing some keys of lst_key
+        '''
+        self.prefetch(dev_specs)
+        report = {}
+        for name, spec in dev_specs.items():
+            try:
+                _, skipped = self.split_keys(spec, lst_key)
+            except (KeyError, TypeError):
+                continue
+            if skipped:
+                report[name] = skipped
+
+        return report
+
+
+# Shared TimeseriesKeyIndex of the host and user of tb_client, created on first use. Every page of the process logged
+# in as the same user gets the same index, keys listed under a user never decide the requests of another one
+def get_key_index(tb_client: RestClientPE, ttl_seconds: int = KEY_INDEX_TTL_SECONDS) -> TimeseriesKeyIndex:
+    host = getattr(tb_client, 'base_url', '')
+    user = client_user(tb_client)
+    with gKeyIndexesLock:
+        key_index = gKeyIndexes.get((host, user))
+        if key_index is None:
+            key_index = TimeseriesKeyIndex(tb_client, ttl_seconds=ttl_seconds)
+            gKeyIndexes[(host, user)] = key_index
+
+    # pages log in again on every run, always list with the newest client of that user
+    key_index.tb_client = tb_client
+
+    return key_index
+
+
+# Build a DeviceId from a device dict as returned by get_devices_by_customer_name_as_dict()
+def device_id_from_spec(dev_spec) -> DeviceId:
+    if isinstance(dev_spec, DeviceId):
+        return dev_spec
+
+    return DeviceId(id=dev_spec['id']['id'], entity_type=dev_spec['id']['entityType'])
+
+
+# Device dict as listed by get_devices_by_customer_name_as_dict() from an entity data query result
+def _device_from_entity_data(entity_data: dict) -> dict:
+    entity_id = _as_dict(entity_data.get('entity_id') or entity_data.get('entityId'))
+    fields = (entity_data.get('latest') or {}).get('ENTITY_FIELD') or {}
+    device = {'id': {'id': entity_id['id'], 'entityType': entity_id.get('entityType') or entity_id.get('entity_type')}}
+    for k in ('name', 'type', 'label', 'createdTime'):
+        value = _as_dict(fields.get(k)) or {}
+        device[k] = value.get('value')
+    if device['createdTime']:
+        device['createdTime'] = int(device['createdTime'])
+
+    return device
+
+
+def get_devices_by_asset_name_as_dict(tb_client: RestClientPE, asset_name: str, max_level: int = ASSET_MAX_LEVEL,
+                                      relation_type: str = 'Contains', ttl_seconds: int = DEVICE_DIRECTORY_TTL_SECONDS,
+                                      page_size: int = DEVICE_PAGE_SIZE) -> dict:
+    '''
+    Devices related to the asset asset_name (a site) by relation_type relations, down to max_level levels so the
+    devices of sub-assets are included. The whole tree is resolved by thingsboard in one entity data query with a
+    relations query filter, page_size devices per request, instead of a relation request per asset and device.
+
+    Returns {name: device dict} in the format of get_devices_by_customer_name_as_dict(), with the id, name, type,
+    label and createdTime of the devices. The result is kept for ttl_seconds, shared by every page of the process
+    logged in as the same user; ttl_seconds 0 lists the devices again.
+    '''
+    host = getattr(tb_client, 'base_url', '')
+    cache_key = (host, client_user(tb_client), asset_name, max_level, relation_type)
+    with gAssetDevicesLock:
+        cached = gAssetDevices.get(cache_key)
+    if cached is not None and time.time() - cached[0] <= ttl_seconds:
+        return dict(cached[1])
+
+    exec_start_ts = time.perf_counter()
+    asset = _as_dict(_call_api('tenant_asset', None, None, tb_client.get_tenant_asset, asset_name=asset_name))
+    root = _as_dict(asset['id'])
+
+    body = {'entityFilter': {'type': 'relationsQuery',
+                             'rootEntity': {'entityType': 'ASSET', 'id': root['id']},
+                             'direction': 'FROM',
+                             'maxLevel': max_level,
+                             'fetchLastLevelOnly': False,
+                             'filters': [{'relationType': relation_type, 'entityTypes': ['DEVICE']}]},
+            'entityFields': [{'type': 'ENTITY_FIELD', 'key': k} for k in ('name', 'type', 'label', 'createdTime')],
+            'pageLink': {'page': 0, 'pageSize': page_size}}
+
+    dict_devices = {}
+    i_page = 0
+    while True:
+        body['pageLink']['page'] = i_page
+        resp = _call_api('entity_data_query', None, None, tb_client.find_entity_data_by_query, body=body)
+        for entity_data in resp.data:
+            device = _device_from_entity_data(_as_dict(entity_data))
+            if device['id']['entityType'] == 'DEVICE' and device['name']:
+                dict_devices[device['name']] = device
+
+        i_page += 1
+        if i_page >= resp.total_pages:
+            break
+
+    with gAssetDevicesLock:
+        gAssetDevices[cache_key] = (time.time(), dict_devices)
+    gMetrics.record_call('get_devices_by_asset_name_as_dict', wall_s=time.perf_counter() - exec_start_ts,
+                         pages=i_page, points=len(dict_devices))
+
+    return dict(dict_devices)
+
+
+# Timeseries request bypassing the generated client: sent on the pool of tb_client with its token, and the body
+# decoded by orjson (json if it is not installed) without any swagger deserialization. Same result as
+# tb_client.get_timeseries() with the size of the response, (data, n_bytes); errors raise ApiException like the
+# generated client does
+def _request_timeseries_json(tb_client: RestClientPE, dev_id: DeviceId, keys: list, start_ts: int, end_ts: int,
+                             limit: int, use_strict_data_types: bool = False,
+                             agg: str = None, interval: int = None) -> tuple:
+    fields = {'keys': ','.join(keys), 'startTs': start_ts, 'endTs': end_ts,
+              'useStrictDataTypes': 'true' if use_strict_data_types else 'false'}
+    if limit is not None:
+        fields['limit'] = limit
+    if agg is not None:
+        fields['agg'] = agg
+    if interval is not None:
+        fields['interval'] = interval
+
+    resp = tb_client.api_client.rest_client.pool_manager.request(
+        'GET', '%s/api/plugins/telemetry/%s/%s/values/timeseries' % (tb_client.base_url, dev_id.entity_type, dev_id.id),
+        fields=fields,
+        headers={'Accept': 'application/json',
+                 'X-Authorization': 'Bearer %s' % tb_client.configuration.api_key['X-Authorization']})
+    if not 200 <= resp.status < 300:
+        e = ApiException(status=resp.status, reason=resp.reason)
+        e.body = resp.data
+        e.headers = resp.headers
+        raise e
+
+    return fast_json.loads(resp.data), len(resp.data)
+
+
+# Single request to the timeseries endpoint; ThingsBoard accepts a comma separated list of keys and applies
+# limit to each key separately. Returns {key: [{'ts': ..., 'value': ...}, ...]}, newest first.
+# With raw_json the request skips the generated client, see _request_timeseries_json().
+# Every request goes through _call_api(): gThrottle retries the ones thingsboard rejects as overloaded
+def _request_timeseries(tb_client: RestClientPE, dev_id: DeviceId, keys: list, start_ts: int, end_ts: int,
+                        limit: int, use_strict_data_types: bool = False,
+                        agg: str = None, interval: int = None, raw_json: bool = False) -> dict:
+    if raw_json:
+        data, _ = _call_api('timeseries', dev_id, ','.join(keys), _request_timeseries_json, tb_client, dev_id, keys,
+                            start_ts=start_ts, end_ts=end_ts, limit=limit,
+                            use_strict_data_types=use_strict_data_types, agg=agg, interval=interval)
+        return data
+
+    return _call_api('timeseries', dev_id, ','.join(keys), tb_client.get_timeseries, dev_id, ','.join(keys),
+                     use_strict_data_types=use_strict_data_types,
+                     start_ts=start_ts, end_ts=end_ts, limit=limit,
+                     agg=agg, interval=interval)
+
+
+# Pick the server side aggregation for plotting [start_ts, end_ts]: ranges longer than min_range_ms are aggregated
+# with agg over the smallest interval of AGG_INTERVALS_MS giving at most max_points values per key.
+# Returns (agg, interval), (None, None) when the raw values should be used
+def get_auto_aggregation(start_ts: int, end_ts: int, agg: str = 'AVG', max_points: int = 2000,
+                         min_range_ms: int = 48 * 3600 * 1000):
+    if max_points < 1:
+        raise ValueError('max_points must be at least 1')
+    if not agg or agg == 'NONE' or end_ts - start_ts <= min_range_ms:
+        return None, None
+
+    interval = int(math.ceil((end_ts - start_ts) / float(max_points)))
+    for i in AGG_INTERVALS_MS:
+        if i >= interval:
+            return agg, i
+
+    return agg, interval
+
+
+# Generator over the pages of aggregated values, see get_timeseries_aggregated()
+def _iter_aggregated_pages(tb_client: RestClientPE, dev_id: DeviceId, key: str,
+                           start_ts: int, end_ts: int, agg: str, interval: int,
+                           use_strict_data_types: bool = False, raw_json: bool = False):
+    if agg not in AGG_FUNCTIONS:
+        raise ValueError('unknown aggregation function %s, expected one of %s' % (agg, ', '.join(AGG_FUNCTIONS)))
+    if not interval or interval <= 0:
+        raise ValueError('aggregation interval must be positive')
+
+    window_ms = interval * TS_MAX_INTERVALS
+    windows = [(w_start_ts, min(w_start_ts + window_ms, end_ts)) for w_start_ts in range(start_ts, end_ts, window_ms)]
+
+    for w_start_ts, w_end_ts in reversed(windows):
+        data = _request_timeseries(tb_client, dev_id, [key], start_ts=w_start_ts, end_ts=w_end_ts,
+                                   limit=TS_MAX_INTERVALS, use_strict_data_types=use_strict_data_types,
+                                   agg=agg, interval=interval, raw_json=raw_json)
+        page = sorted(data.get(key, []), key=lambda d: d['ts'], reverse=True)
+        if page:
+            yield page
+
+
+# Helper function to get timeseries data aggregated by thingsboard: one value per interval, agg being one of
+# AGG_FUNCTIONS. The range is requested in windows of whole intervals counted from start_ts, so no interval is cut in
+# two. Returns the same format as get_timeseries_all(), newest first
+def get_timeseries_aggregated(tb_client: RestClientPE, dev_id: DeviceId, key: str,
+                              start_ts: int, end_ts: int, agg: str, interval: int,
+                              use_strict_data_types: bool = False) -> list:
+    raw = []
+    n_pages = 0
+    exec_start_ts = time.perf_counter()
+    for page in _iter_aggregated_pages(tb_client, dev_id, key, start_ts, end_ts, agg, interval,
+                                       use_strict_data_types=use_strict_data_types):
+        raw.extend(page)
+        n_pages += 1
+
+    gMetrics.record_call('get_timeseries_aggregated', dev_id, key, wall_s=time.perf_counter() - exec_start_ts,
+                         pages=n_pages, points=len(raw))
+
+    return raw
+
+
+# Generator over the pages of raw values, walking backwards from end_ts
+def _iter_raw_pages(tb_client: RestClientPE, dev_id: DeviceId, key: str, start_ts: int, end_ts: int,
+                    page_limit: int, use_strict_data_types: bool = False, raw_json: bool = False):
+    my_end_ts = end_ts
+
+    while my_end_ts >= start_ts:
+        data = _request_timeseries(tb_client, dev_id, [key], start_ts=start_ts, end_ts=my_end_ts,
+                                   limit=page_limit, use_strict_data_types=use_strict_data_types, raw_json=raw_json)
+        page = data.get(key, [])
+        if not page:
+            return
+
+        yield page
+
+        # a short page means everything down to start_ts has been received
+        if len(page) < page_limit:
+            return
+
+        my_end_ts = min([d['ts'] for d in page]) - 1    #subtract 1 ms to minimum time received as new end ts
+
+
+# Generator over the pages of timeseries data of one key, newest page first. Only the current page is held, so
+# callers can process and drop the values as they stream in and memory stays bounded by page_limit.
+# Every page is a list of records (newest first), or TimeseriesArrays (oldest first) with result_type 'arrays'.
+# With agg and interval, the pages hold the values aggregated by thingsboard (see get_timeseries_aggregated()).
+# With raw_json the requests skip the generated client, see _request_timeseries_json()
+def iter_timeseries_pages(tb_client: RestClientPE, dev_id: DeviceId, key: str, start_ts: int, end_ts: int = None,
+                          page_limit: int = 1000, use_strict_data_types: bool = False,
+                          agg: str = None, interval: int = None, result_type: str = 'records',
+                          raw_json: bool = False):
+    if result_type not in ('records', 'arrays'):
+        raise ValueError('unknown page result type %s, expected records or arrays' % result_type)
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    if agg is not None and agg != 'NONE':
+        pages = _iter_aggregated_pages(tb_client, dev_id, key, start_ts, end_ts, agg, interval,
+                                       use_strict_data_types=use_strict_data_types, raw_json=raw_json)
+    else:
+        pages = _iter_raw_pages(tb_client, dev_id, key, start_ts, end_ts, page_limit,
+                                use_strict_data_types=use_strict_data_types, raw_json=raw_json)
+
+    for page in pages:
+        if result_type == 'arrays':
+            builder = TimeseriesBuilder()
+            builder.add_page(page)
+            yield builder.to_arrays()
+        else:
+            yield page
+
+
+# Convert timeseries values to float64 in one vectorized pass, values that are not numbers become NaN
+def values_to_float(values) -> np.ndarray:
+    try:
+        return np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64)
+
+
+class TimeseriesBuilder(object):
+    '''
+    Collects pages of timeseries values (newest first, as thingsboard returns them) into int64 / float64 chunks,
+    concatenated once into contiguous oldest first arrays at the end. The page dicts can be dropped as soon as
+    they are added.
+    '''
+    def __init__(self):
+        self._ts = []
+        self._value = []
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add_page(self, page: list):
+        self._ts.append(np.fromiter((d['ts'] for d in page), dtype=np.int64, count=len(page))[::-1])
+        self._value.append(values_to_float([d['value'] for d in page])[::-1])
+        self._count += len(page)
+
+    def to_arrays(self) -> TimeseriesArrays:
+        if not self._ts:
+            return TimeseriesArrays(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64))
+
+        return TimeseriesArrays(np.concatenate(self._ts[::-1]), np.concatenate(self._value[::-1]))
+
+    def to_frame(self, key: str) -> pd.DataFrame:
+        arrays = self.to_arrays()
+        return pd.DataFrame({key: arrays.value}, index=pd.DatetimeIndex(pd.to_datetime(arrays.ts, unit='ms'), name='ts'))
+
+    def result(self, key: str, result_type: str):
+        if result_type == 'frame':
+            return self.to_frame(key)
+        return self.to_arrays()
+
+
+# Convert records as returned by get_timeseries_all() to result_type (see RESULT_TYPES), anything already converted
+# is returned as is
+def convert_timeseries(raw, key: str, result_type: str = 'records'):
+    if result_type not in RESULT_TYPES:
+        raise ValueError('unknown result type %s, expected one of %s' % (result_type, ', '.join(RESULT_TYPES)))
+    if result_type == 'records' or not isinstance(raw, list):
+        return raw
+
+    builder = TimeseriesBuilder()
+    builder.add_page(raw)
+    return builder.result(key, result_type)
+
+
+# Number of values of a download in any result type: records and frames have a row per value, arrays a pair of arrays
+def count_points(raw) -> int:
+    if isinstance(raw, TimeseriesArrays):
+        return len(raw.ts)
+    return len(raw)
+
+
+# Merge {key: raw} into one wide table aligned on ts: [{'ts': ..., key1: value, key2: value}, ...], oldest first.
+# A key without a value at a given ts is left out of that row
+def merge_timeseries_on_ts(dict_raw: dict) -> list:
+    rows = {}
+    for k, raw in dict_raw.items():
+        for d in raw:
+            rows.setdefault(d['ts'], {'ts': d['ts']})[k] = d['value']
+
+    return [rows[ts] for ts in sorted(rows)]
 
 
 # Helper function to get all timeseries data
 def get_timeseries_all(tb_client: RestClientPE, dev_id:DeviceId, key:str,
                        start_ts: int, end_ts: int = int(time.time())*1000, page_limit: int = 1000,
                        use_strict_data_types:bool = False,
-                       timeout_seconds: int = 20):
+                       timeout_seconds: int = None,
+                       agg: str = None, interval: int = None,
+                       result_type: str = 'records',
+                       raw_json: bool = False):
+
+    if result_type not in RESULT_TYPES:
+        raise ValueError('unknown result type %s, expected one of %s' % (result_type, ', '.join(RESULT_TYPES)))
 
-    my_end_ts = end_ts
-    i = 1
     raw = []
+    # columnar results are built page by page instead of keeping the records
+    builder = TimeseriesBuilder() if result_type != 'records' else None
 
+    n_pages = 0
     exec_start_ts = time.time()
+    perf_start_ts = time.perf_counter()
 
-    while True:
-        logger.debug('get_timeseries_all(): pass %d, end_ts = %d | %s' % (i, my_end_ts,
-                                               datetime.fromtimestamp(float(my_end_ts/1000)).strftime('%Y-%m-%d %H:%M:%S')))
-        i += 1
+    for page in iter_timeseries_pages(tb_client, dev_id, key, start_ts, end_ts=end_ts, page_limit=page_limit,
+                                      use_strict_data_types=use_strict_data_types, agg=agg, interval=interval,
+                                      raw_json=raw_json):
+        n_pages += 1
+        if builder is not None:
+            builder.add_page(page)
+        else:
+            raw.extend(page)
+
+        # keep what was received, but do not start another request
+        if timeout_seconds is not None and time.time() - exec_start_ts > timeout_seconds:
+            logger.warning('get_timeseries_all(): exceeded timeout %s s, returning partial data' % timeout_seconds)
+            break
+
+    gMetrics.record_call('get_timeseries_all', dev_id, key, wall_s=time.perf_counter() - perf_start_ts,
+                         pages=n_pages, points=len(builder) if builder is not None else len(raw))
+
+    if builder is not None:
+        return builder.result(key, result_type)
+
+    return raw
+
+
+# One page of a window for get_timeseries_sharded(). Returns (page, remaining) with remaining the part of the window
+# older than the page, None once the window is complete
+def _fetch_shard_page(tb_client: RestClientPE, dev_id: DeviceId, key: str, start_ts: int, end_ts: int,
+                      page_limit: int, use_strict_data_types: bool = False):
+    data = _request_timeseries(tb_client, dev_id, [key], start_ts=start_ts, end_ts=end_ts,
+                               limit=page_limit, use_strict_data_types=use_strict_data_types)
+    page = data.get(key, [])
+    if len(page) < page_limit:
+        return page, None
 
-        data = tb_client.get_timeseries(dev_id, key, use_strict_data_types=use_strict_data_types,
-                                        start_ts=start_ts, end_ts=my_end_ts,
-                                        limit=page_limit)
+    min_ts = min([d['ts'] for d in page])
+    if min_ts - 1 < start_ts:
+        return page, None
 
-        if len(data) == 0:
-            logger.debug('get_timeseries_all(): no more data to download')
+    return page, (start_ts, min_ts - 1)
+
+
+# Split the remaining part of a window in sub-windows of about one page each, using the point density seen on the
+# page just received, at most max_split sub-windows
+def _split_shard(page_span_ms: int, page_len: int, remaining: tuple, page_limit: int, max_split: int) -> list:
+    start_ts, end_ts = remaining
+    expected = page_len * (end_ts - start_ts + 1) / float(max(1, page_span_ms))
+    n = int(min(max_split, max(1, math.ceil(expected / page_limit))))
+
+    edges = [start_ts + (end_ts - start_ts + 1) * j // n for j in range(n + 1)]
+    return [(edges[j], edges[j + 1] - 1) for j in range(n) if edges[j + 1] - 1 >= edges[j]]
+
+
+# Helper function to get all timeseries data of one long series with concurrent requests: the range is split into
+# windows fetched in parallel, and any window that turns out to hold more than one page is split again according to
+# the point density observed on its first page, so dense stretches get more windows than sparse ones.
+# Returns the same format as get_timeseries_all(), newest first and without duplicates at the window edges
+def get_timeseries_sharded(tb_client: RestClientPE, dev_id: DeviceId, key: str, start_ts: int, end_ts: int = None,
+                           page_limit: int = 1000, use_strict_data_types: bool = False,
+                           max_workers: int = DEFAULT_MAX_WORKERS, max_split: int = None) -> list:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+    if max_split is None:
+        max_split = max(2, max_workers)
+
+    pages = []
+    n_requests = 0
+    exec_start_ts = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {submit_in_context(executor, _fetch_shard_page, tb_client, dev_id, key, start_ts, end_ts,
+                                     page_limit, use_strict_data_types): end_ts}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for f in done:
+                w_end_ts = futures.pop(f)
+                page, remaining = f.result()
+                n_requests += 1
+                pages.append(page)
+                if remaining is None:
+                    continue
+
+                page_span_ms = w_end_ts - remaining[1]
+                for s_start_ts, s_end_ts in _split_shard(page_span_ms, len(page), remaining, page_limit, max_split):
+                    futures[submit_in_context(executor, _fetch_shard_page, tb_client, dev_id, key, s_start_ts,
+                                              s_end_ts, page_limit, use_strict_data_types)] = s_end_ts
+
+    raw = []
+    last_ts = None
+    for d in sorted([d for page in pages for d in page], key=lambda d: d['ts'], reverse=True):
+        if d['ts'] != last_ts:
+            raw.append(d)
+            last_ts = d['ts']
+
+    gMetrics.record_call('get_timeseries_sharded', dev_id, key, wall_s=time.perf_counter() - exec_start_ts,
+                         pages=n_requests, points=len(raw))
+
+    return raw
+
+
+# Helper function to get all timeseries data of several keys in one cursor walk, each request asks for all keys
+# that are not exhausted yet. Returns {key: raw} in the same per key format as get_timeseries_all()
+def get_timeseries_all_keys(tb_client: RestClientPE, dev_id: DeviceId, lst_key: list,
+                            start_ts: int, end_ts: int = None, page_limit: int = 1000,
+                            use_strict_data_types: bool = False,
+                            timeout_seconds: int = None, raw_json: bool = False) -> dict:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    dict_raw = {k: [] for k in lst_key}
+    key_end_ts = {k: end_ts for k in lst_key}       # per key cursor, values newer than this are already received
+    pending = list(dict_raw)
+    n_pages = 0
+
+    exec_start_ts = time.time()
+    perf_start_ts = time.perf_counter()
+
+    while pending:
+        my_end_ts = max(key_end_ts[k] for k in pending)
+        n_pages += 1
+
+        data = _request_timeseries(tb_client, dev_id, pending, start_ts=start_ts, end_ts=my_end_ts,
+                                   limit=page_limit, use_strict_data_types=use_strict_data_types, raw_json=raw_json)
+
+        still_pending = []
+        for k in pending:
+            values = data.get(k, [])
+            dict_raw[k].extend([d for d in values if d['ts'] <= key_end_ts[k]])
+
+            # a short page means everything between start_ts and my_end_ts was returned for this key
+            if len(values) < page_limit:
+                continue
+
+            min_ts = min([d['ts'] for d in values])
+            key_end_ts[k] = min(key_end_ts[k], min_ts - 1)
+            if key_end_ts[k] >= start_ts:
+                still_pending.append(k)
+        pending = still_pending
+
+        if pending and timeout_seconds is not None and time.time() - exec_start_ts > timeout_seconds:
+            logger.warning('get_timeseries_all_keys(): exceeded timeout %d' % timeout_seconds)
             break
 
-        if exec_start_ts - time.time() > timeout_seconds:
-            logger.warning('get_timeseries_all(): exceeded timeout %d' % timeout_seconds)
+    gMetrics.record_call('get_timeseries_all_keys', dev_id, ','.join(lst_key),
+                         wall_s=time.perf_counter() - perf_start_ts, pages=n_pages,
+                         points=sum([len(v) for v in dict_raw.values()]))
+
+    return dict_raw
+
+
+# Download [start_ts, end_ts] page by page into the cache, every page is stored and marked covered as soon as it
+# arrives, which makes the coverage of the cache a checkpoint to resume from. No request is started after deadline
+# (a time.time() value). Returns (max_ts, complete), max_ts being the newest ts received, None if there was no value
+def _download_to_cache(tb_client: RestClientPE, cache: TimeseriesCache, dev_id: DeviceId, key: str,
+                       start_ts: int, end_ts: int, page_limit: int, use_strict_data_types: bool = False,
+                       deadline: float = None):
+    logger.debug('_download_to_cache(): %s %d - %d' % (key, start_ts, end_ts))
+    max_ts = None
+    my_end_ts = end_ts
+    while my_end_ts >= start_ts:
+        if deadline is not None and time.time() >= deadline:
+            logger.warning('_download_to_cache(): %s deadline reached, %d - %d left to download' % (key, start_ts, my_end_ts))
+            return max_ts, False
+
+        data = _request_timeseries(tb_client, dev_id, [key], start_ts=start_ts, end_ts=my_end_ts,
+                                   limit=page_limit, use_strict_data_types=use_strict_data_types)
+        values = data.get(key, [])
+        if values and max_ts is None:
+            max_ts = max([d['ts'] for d in values])
+
+        # a short page means the rest of the interval has been received
+        if len(values) < page_limit:
+            cache.add_values(dev_id, key, values, start_ts, my_end_ts, strict=use_strict_data_types)
             break
 
-        raw.extend(data[key])
+        min_ts = min([d['ts'] for d in values])
+        cache.add_values(dev_id, key, values, min_ts, my_end_ts, strict=use_strict_data_types)
+        my_end_ts = min_ts - 1
 
-        min_ts = min([d['ts'] for d in data[key]])
-        if min_ts >= start_ts:
-            my_end_ts = min_ts - 1    #subtract 1 ms to minimum time received as new end ts
+    return max_ts, True
 
-    logger.debug("get_timeseries_all(): a total of %d values received" % len(raw))
 
-    return raw
+# Download the intervals of [start_ts, end_ts] the cache does not cover yet, newest first, the same direction
+# get_timeseries_all() walks in. Returns (max_ts, complete) as _download_to_cache() does
+def _download_missing(tb_client: RestClientPE, cache: TimeseriesCache, dev_id: DeviceId, key: str,
+                      start_ts: int, end_ts: int, page_limit: int, use_strict_data_types: bool = False,
+                      deadline: float = None):
+    max_ts = None
+    for gap_start_ts, gap_end_ts in reversed(cache.get_missing_intervals(dev_id, key, start_ts, end_ts,
+                                                                          strict=use_strict_data_types)):
+        gap_max_ts, complete = _download_to_cache(tb_client, cache, dev_id, key, gap_start_ts, gap_end_ts, page_limit,
+                                                  use_strict_data_types=use_strict_data_types, deadline=deadline)
+        if max_ts is None:
+            max_ts = gap_max_ts
+        if not complete:
+            return max_ts, False
+
+    return max_ts, True
 
 
-def get_timeseries_by_device(tb_client: RestClientPE, this_dev: DeviceId, lst_key: list, start_ts: int = 1, end_ts: int = int(time.time()*1000)):
+# Helper function to get all timeseries data through a TimeseriesCache: only the intervals the cache does not cover
+# yet are downloaded. No request is started after deadline (a time.time() value), what is cached by then is returned.
+# Returns the same format as get_timeseries_all()
+def get_timeseries_cached(tb_client: RestClientPE, cache: TimeseriesCache, dev_id: DeviceId, key: str,
+                          start_ts: int, end_ts: int = None, page_limit: int = 1000,
+                          use_strict_data_types: bool = False, deadline: float = None) -> list:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    _download_missing(tb_client, cache, dev_id, key, start_ts, end_ts, page_limit,
+                      use_strict_data_types=use_strict_data_types, deadline=deadline)
+
+    return cache.get_values(dev_id, key, start_ts, end_ts, strict=use_strict_data_types)
+
+
+# Result of get_timeseries_resumable(): the values available so far (newest first), whether they cover the whole
+# request, and the (start_ts, end_ts) intervals still to download, oldest first
+TimeseriesPartial = namedtuple('TimeseriesPartial', ['values', 'complete', 'missing'])
+
+
+class DownloadIncomplete(Exception):
+    '''
+    Reported in dict_failed by get_timeseries_by_devices() for a download its deadline cut short: the values received
+    are in dict_raw, missing holds the (start_ts, end_ts) intervals still to download. Running the same download again
+    continues from the cache.
+    '''
+    def __init__(self, missing: list):
+        super().__init__('deadline reached, %d interval(s) left to download' % len(missing))
+        self.missing = missing
+
+
+# Helper function for long downloads that may be cut short (streamlit rerun, stalled server): stops starting requests
+# at deadline (a time.time() value) and returns a TimeseriesPartial. Every page received is checkpointed in the cache,
+# so calling it again with the same arguments continues where the previous call stopped. With incremental set the
+# download goes through get_timeseries_incremental() instead of get_timeseries_cached()
+def get_timeseries_resumable(tb_client: RestClientPE, cache: TimeseriesCache, dev_id: DeviceId, key: str,
+                             start_ts: int, end_ts: int = None, page_limit: int = 1000,
+                             use_strict_data_types: bool = False, deadline: float = None,
+                             incremental: bool = False) -> TimeseriesPartial:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    fetch = get_timeseries_incremental if incremental else get_timeseries_cached
+    values = fetch(tb_client, cache, dev_id, key, start_ts, end_ts=end_ts, page_limit=page_limit,
+                   use_strict_data_types=use_strict_data_types, deadline=deadline)
+
+    # the last few minutes are never marked covered (see TimeseriesCache), they do not make a download incomplete
+    settled_end_ts = min(end_ts, int(time.time() * 1000) - cache.settle_ms)
+    missing = cache.get_missing_intervals(dev_id, key, start_ts, settled_end_ts, strict=use_strict_data_types) \
+        if settled_end_ts >= start_ts else []
+
+    return TimeseriesPartial(values, not missing, missing)
+
+
+# Helper function for recurring reports: the history of every (device, key) is kept in the cache together with a
+# high-water mark, the newest ts received. Later runs only ask thingsboard for values newer than the mark, from
+# cache.settle_ms before it so that values stored late are picked up (and for values older than the stored history if
+# start_ts moved back). No request is started after deadline (a time.time() value): the mark only moves once
+# everything up to it was received, what was downloaded by then stays in the cache for the next run.
+# Returns the same format as get_timeseries_all()
+def get_timeseries_incremental(tb_client: RestClientPE, cache: TimeseriesCache, dev_id: DeviceId, key: str,
+                               start_ts: int, end_ts: int = None, page_limit: int = 1000,
+                               use_strict_data_types: bool = False, deadline: float = None) -> list:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    watermark = cache.get_watermark(dev_id, key, strict=use_strict_data_types)
+    if watermark is None:
+        history_start_ts, watermark_ts = start_ts, start_ts - 1
+    else:
+        history_start_ts, watermark_ts = watermark
+
+    logger.debug('get_timeseries_incremental(): %s watermark %d' % (key, watermark_ts))
+    complete = True
+    if end_ts > watermark_ts:
+        max_ts, complete = _download_missing(tb_client, cache, dev_id, key, watermark_ts + 1, end_ts, page_limit,
+                                             use_strict_data_types=use_strict_data_types, deadline=deadline)
+        # the values of the last settle_ms before the mark may still have been incomplete when it was set
+        settle_start_ts = max(history_start_ts, watermark_ts + 1 - cache.settle_ms)
+        if complete and settle_start_ts <= watermark_ts:
+            _, complete = _download_to_cache(tb_client, cache, dev_id, key, settle_start_ts, watermark_ts, page_limit,
+                                             use_strict_data_types=use_strict_data_types, deadline=deadline)
+        if complete and max_ts is not None:
+            watermark_ts = max(watermark_ts, max_ts)
+
+    if complete and start_ts < history_start_ts:
+        _, complete = _download_missing(tb_client, cache, dev_id, key, start_ts, history_start_ts - 1, page_limit,
+                                        use_strict_data_types=use_strict_data_types, deadline=deadline)
+        if complete:
+            history_start_ts = start_ts
+    cache.set_watermark(dev_id, key, history_start_ts, watermark_ts, strict=use_strict_data_types)
+
+    return cache.get_values(dev_id, key, start_ts, end_ts, strict=use_strict_data_types)
+
+
+# Download one key with the strategy selected by cache / incremental / agg. Aggregated values are never cached
+def _get_timeseries_key(tb_client: RestClientPE, this_dev: DeviceId, key: str, start_ts: int, end_ts: int,
+                        page_limit: int, cache: TimeseriesCache = None, incremental: bool = False,
+                        agg: str = None, interval: int = None) -> list:
+    if agg is not None and agg != 'NONE':
+        return get_timeseries_aggregated(tb_client, this_dev, key, start_ts, end_ts, agg, interval)
+    if incremental:
+        if cache is None:
+            raise ValueError('incremental mode needs a TimeseriesCache to keep the history in')
+        return get_timeseries_incremental(tb_client, cache, this_dev, key, start_ts=start_ts, end_ts=end_ts,
+                                          page_limit=page_limit)
+    if cache is not None:
+        return get_timeseries_cached(tb_client, cache, this_dev, key, start_ts=start_ts, end_ts=end_ts,
+                                     page_limit=page_limit)
+
+    return get_timeseries_all(tb_client, this_dev, key, start_ts=start_ts, end_ts=end_ts, page_limit=page_limit)
+
+
+# With multi_key set, all keys are downloaded together (see get_timeseries_all_keys()) and the result is a wide
+# table aligned on ts (see merge_timeseries_on_ts()) instead of the flat list of values of all keys.
+# With a cache, every key goes through get_timeseries_cached(), or get_timeseries_incremental() if incremental is set.
+# With agg and interval, thingsboard aggregates the values (see get_timeseries_aggregated()).
+# With a key_index, the keys the device never reported are not requested (see TimeseriesKeyIndex)
+def get_timeseries_by_device(tb_client: RestClientPE, this_dev: DeviceId, lst_key: list, start_ts: int = 1, end_ts: int = int(time.time()*1000),
+                             multi_key: bool = False, cache: TimeseriesCache = None, incremental: bool = False,
+                             agg: str = None, interval: int = None, key_index: TimeseriesKeyIndex = None):
+
+    if key_index is not None:
+        lst_key, skipped = key_index.split_keys(this_dev, lst_key)
+        if skipped:
+            logger.debug('get_timeseries_by_device(): %s never reported %s, skipped' % (this_dev.id, ', '.join(skipped)))
+
+    if multi_key:
+        if cache is not None or incremental or agg is not None:
+            dict_raw = {k: _get_timeseries_key(tb_client, this_dev, k, start_ts, end_ts, page_limit=5000,
+                                               cache=cache, incremental=incremental, agg=agg, interval=interval)
+                        for k in lst_key}
+        else:
+            dict_raw = get_timeseries_all_keys(tb_client, this_dev, lst_key, start_ts=start_ts, end_ts=end_ts, page_limit=5000)
+        return merge_timeseries_on_ts(dict_raw)
 
     lst_raw = []
+    exec_start_ts = time.perf_counter()
     for k in lst_key:
-        logger.debug('get_timeseries_by_device(): processing key %s' % k)
-        resp = get_timeseries_all(tb_client, this_dev, k, start_ts=start_ts, end_ts=end_ts, page_limit=5000)
+        resp = _get_timeseries_key(tb_client, this_dev, k, start_ts, end_ts, page_limit=5000,
+                                   cache=cache, incremental=incremental, agg=agg, interval=interval)
         # resp has this format: # {"data.E.raw": {'ts': 1644846652219,'value': 'abc'}, {'ts': 1644839452413,'value': 'efg'}}
         lst_raw.extend(resp)
-        logger.debug("get_timeseries_by_device(): total values %d" % len(lst_raw))
+
+    gMetrics.record_call('get_timeseries_by_device', this_dev, ','.join(lst_key),
+                         wall_s=time.perf_counter() - exec_start_ts, points=len(lst_raw))
 
     return lst_raw
 
 
+def get_timeseries_by_devices(tb_client: RestClientPE, dev_specs: dict, lst_key: list, start_ts: int = 1,
+                              end_ts: int = None, page_limit: int = 5000,
+                              max_workers: int = DEFAULT_MAX_WORKERS, multi_key: bool = False,
+                              cache: TimeseriesCache = None, incremental: bool = False,
+                              agg: str = None, interval: int = None, result_type: str = 'records',
+                              deadline: float = None, raw_json: bool = False, key_index: TimeseriesKeyIndex = None):
+    '''
+    Download every key in lst_key for every device in dev_specs ({name: device dict or DeviceId}), running the
+    device x key downloads on a pool of at most max_workers threads.
+
+    Returns (dict_raw, dict_failed):
+        dict_raw    {name: {key: [{'ts': ..., 'value': ...}, ...]}} for every key that was downloaded, the values being
+                    converted to result_type (see RESULT_TYPES)
+        dict_failed {name: {key: exception}} for every device with at least one failed download; a device that
+                    could not be resolved at all (e.g. spec is None) is reported under the key None
+    A failing device or key never aborts the downloads of the others.
+    With multi_key set there is one task per device downloading all keys together (see get_timeseries_all_keys()).
+    With a cache, every device x key goes through get_timeseries_cached() (get_timeseries_incremental() if incremental
+    is set) and multi_key is ignored. With agg and interval, every device x key goes through
+    get_timeseries_aggregated() instead.
+    With a deadline (a time.time() value, needs a cache, not with agg) every device x key goes through
+    get_timeseries_resumable() and no request is started after it: a download cut short keeps its values in dict_raw
+    and is reported in dict_failed as a DownloadIncomplete, running the same call again continues from the cache.
+    With raw_json the multi_key and default downloads skip the generated client, see _request_timeseries_json().
+    With a key_index, the keys a device never reported are not requested and are left out of dict_raw,
+    key_index.skip_report() tells which ones.
+    '''
+    if incremental and cache is None:
+        raise ValueError('incremental mode needs a TimeseriesCache to keep the history in')
+    if deadline is not None and (cache is None or agg is not None):
+        raise ValueError('a deadline needs a TimeseriesCache to resume from and raw values, not agg')
+    if result_type not in RESULT_TYPES:
+        raise ValueError('unknown result type %s, expected one of %s' % (result_type, ', '.join(RESULT_TYPES)))
+
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    dict_raw = {}
+    dict_failed = {}
+    exec_start_ts = time.perf_counter()
+    dev_keys = lst_key
+    multi_keys = {}             # keys requested together, by device
+    if key_index is not None:
+        key_index.prefetch(dev_specs)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {}
+        for name, spec in dev_specs.items():
+            try:
+                if spec is None:
+                    raise KeyError(name)
+                this_dev = device_id_from_spec(spec)
+            except (KeyError, TypeError) as e:
+                logger.warning('get_timeseries_by_devices(): cannot resolve device %s, skipping it' % name)
+                dict_failed[name] = {None: e}
+                continue
+
+            gMetrics.name_devices({this_dev.id: name})
+            dict_raw[name] = {}
+            if key_index is not None:
+                dev_keys, _ = key_index.split_keys(this_dev, lst_key)
+                if not dev_keys:
+                    continue
+
+            if deadline is not None:
+                for k in dev_keys:
+                    f = submit_in_context(executor, get_timeseries_resumable, tb_client, cache, this_dev, k,
+                                          start_ts, end_ts=end_ts, page_limit=page_limit, deadline=deadline,
+                                          incremental=incremental)
+                    futures[f] = (name, k)
+                continue
+
+            if cache is not None or agg is not None:
+                for k in dev_keys:
+                    f = submit_in_context(executor, _get_timeseries_key, tb_client, this_dev, k, start_ts, end_ts,
+                                          page_limit, cache=cache, incremental=incremental, agg=agg,
+                                          interval=interval)
+                    futures[f] = (name, k)
+                continue
+
+            if multi_key:
+                f = submit_in_context(executor, get_timeseries_all_keys, tb_client, this_dev, dev_keys,
+                                      start_ts=start_ts, end_ts=end_ts, page_limit=page_limit, raw_json=raw_json)
+                futures[f] = (name, None)
+                multi_keys[name] = dev_keys
+                continue
+
+            for k in dev_keys:
+                f = submit_in_context(executor, get_timeseries_all, tb_client, this_dev, k,
+                                      start_ts=start_ts, end_ts=end_ts, page_limit=page_limit,
+                                      result_type=result_type, raw_json=raw_json)
+                futures[f] = (name, k)
+
+        for f in as_completed(futures):
+            name, k = futures[f]
+            try:
+                if k is None:
+                    dict_raw[name].update({key: convert_timeseries(raw, key, result_type)
+                                           for key, raw in f.result().items()})
+                elif deadline is not None:
+                    partial = f.result()
+                    dict_raw[name][k] = convert_timeseries(partial.values, k, result_type)
+                    if not partial.complete:
+                        dict_failed.setdefault(name, {})[k] = DownloadIncomplete(partial.missing)
+                else:
+                    dict_raw[name][k] = convert_timeseries(f.result(), k, result_type)
+            except Exception as e:
+                logger.warning('get_timeseries_by_devices(): %s %s failed: %s' % (name, k or 'all keys', e))
+                if k is None:
+                    dict_failed.setdefault(name, {}).update({key: e for key in multi_keys[name]})
+                else:
+                    dict_failed.setdefault(name, {})[k] = e
+
+    gMetrics.record_call('get_timeseries_by_devices', key=','.join(lst_key), wall_s=time.perf_counter() - exec_start_ts,
+                         points=sum([count_points(raw) for d in dict_raw.values() for raw in d.values()]))
+
+    return dict_raw, dict_failed
+
+
+# Normalize an entity data query result to plain dicts, the rest client returns models or dicts depending on version
+def _as_dict(obj):
+    if hasattr(obj, 'to_dict'):
+        return obj.to_dict()
+    return obj
+
+
+def get_latest_values_by_devices(tb_client: RestClientPE, dev_specs: dict, lst_key: list, attribute_keys: list = None,
+                                 batch_size: int = 1000) -> dict:
+    '''
+    Latest value of every timeseries key in lst_key (and attribute in attribute_keys) for every device in dev_specs
+    ({name: device dict or DeviceId}), using the entity data query: one request per batch_size devices instead of a
+    download per device and key.
+
+    Returns {name: {key: {'ts': ..., 'value': ...}}}, keys without any value being left out. Attributes share the
+    dict with the timeseries keys, a timeseries key wins if a name is both.
+    '''
+    names_by_id = {}
+    for name, spec in dev_specs.items():
+        try:
+            names_by_id[device_id_from_spec(spec).id] = name
+        except (KeyError, TypeError):
+            logger.warning('get_latest_values_by_devices(): cannot resolve device %s, skipping it' % name)
+
+    latest_values = [{'type': 'TIME_SERIES', 'key': k} for k in lst_key]
+    latest_values.extend([{'type': 'ATTRIBUTE', 'key': k} for k in attribute_keys or []])
+
+    gMetrics.name_devices(names_by_id)
+
+    dict_latest = {}
+    lst_id = list(names_by_id)
+    n_pages = 0
+    exec_start_ts = time.perf_counter()
+    for i_batch in range(0, len(lst_id), batch_size):
+        batch = lst_id[i_batch:i_batch + batch_size]
+        body = {'entityFilter': {'type': 'entityList', 'entityType': 'DEVICE', 'entityList': batch},
+                'latestValues': latest_values,
+                'pageLink': {'page': 0, 'pageSize': len(batch)}}
+        resp = _call_api('entity_data_query', None, None, tb_client.find_entity_data_by_query, body=body)
+        n_pages += 1
+
+        for entity_data in resp.data:
+            entity_data = _as_dict(entity_data)
+            entity_id = _as_dict(entity_data.get('entity_id') or entity_data.get('entityId'))
+            name = names_by_id.get(entity_id['id'])
+            if name is None:
+                continue
+
+            latest = entity_data.get('latest') or {}
+            values = {}
+            for value_type in ('ATTRIBUTE', 'TIME_SERIES'):
+                for k, ts_value in (latest.get(value_type) or {}).items():
+                    ts_value = _as_dict(ts_value)
+                    # thingsboard reports keys without any value with ts 0
+                    if ts_value and ts_value.get('ts'):
+                        values[k] = {'ts': ts_value['ts'], 'value': ts_value.get('value')}
+            dict_latest[name] = values
+
+    gMetrics.record_call('get_latest_values_by_devices', key=','.join(lst_key + list(attribute_keys or [])),
+                         wall_s=time.perf_counter() - exec_start_ts, pages=n_pages, points=len(dict_latest))
+
+    return dict_latest
+
+
+# Whether value passes a filter of filter_devices_by_latest(): a collection of allowed values or a predicate
+def _latest_value_allowed(value, allowed) -> bool:
+    if callable(allowed):
+        return bool(allowed(value))
+    return value in allowed
+
+
+def filter_devices_by_latest(tb_client: RestClientPE, dev_specs: dict, timeseries_filters: dict = None,
+                             attribute_filters: dict = None, batch_size: int = 1000):
+    '''
+    Device filter stage to run before downloading any history: the latest values of the filtered keys are resolved
+    for all of dev_specs at once (see get_latest_values_by_devices()) and checked against the filters,
+    {key: allowed values or predicate(value)}, timeseries keys in timeseries_filters, attributes in attribute_filters.
+
+    Returns (dict_kept, dict_rejected):
+        dict_kept       {name: spec} of the devices passing every filter
+        dict_rejected   {name: reason} of the others, including devices without any value for a filtered key
+    '''
+    timeseries_filters = timeseries_filters or {}
+    attribute_filters = attribute_filters or {}
+    if not timeseries_filters and not attribute_filters:
+        return dict(dev_specs), {}
+
+    dict_latest = get_latest_values_by_devices(tb_client, dev_specs, list(timeseries_filters),
+                                               attribute_keys=list(attribute_filters), batch_size=batch_size)
+
+    dict_kept = {}
+    dict_rejected = {}
+    for name, spec in dev_specs.items():
+        values = dict_latest.get(name)
+        if values is None:
+            dict_rejected[name] = 'not found in thingsboard'
+            continue
+
+        for k, allowed in list(timeseries_filters.items()) + list(attribute_filters.items()):
+            if k not in values:
+                dict_rejected[name] = 'no %s value' % k
+                break
+            if not _latest_value_allowed(values[k]['value'], allowed):
+                dict_rejected[name] = '%s is %s' % (k, values[k]['value'])
+                break
+        else:
+            dict_kept[name] = spec
+
+    logger.debug('filter_devices_by_latest(): %d of %d devices kept' % (len(dict_kept), len(dev_specs)))
+
+    return dict_kept, dict_rejected
+
+
 if __name__ == "__main__":
 
     logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.DEBUG,
@@ -0,0 +1,233 @@
+## Asyncio client for the thingsboard REST API: login, customer device listing and timeseries paging
+import asyncio
+import time
+import logging
+import aiohttp
+from lib.mCommon.thingsboard import device_id_from_spec, convert_timeseries, RESULT_TYPES
+from lib.mCommon.thingsboard_throttle import RequestThrottle, gThrottle
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_MAXSIZE = 100          # connections kept open to the thingsboard host
+DEFAULT_MAX_CONCURRENCY = 100       # requests in flight for the multi-device helpers
+KEEPALIVE_SECONDS = 60
+
+
+# Points of a JSON answer: the values of every key of a timeseries answer, the entries of a listing page
+def _points(result) -> int:
+    if not isinstance(result, dict):
+        return 0
+    return sum([len(v) for v in result.values() if isinstance(v, list)])
+
+
+class AsyncTbClient(object):
+    '''
+    Asyncio counterpart of the RestClientPE calls used by lib.mCommon.thingsboard, on a single aiohttp session:
+    every request shares one pool of at most pool_maxsize keep-alive connections to the host.
+    Responses are the decoded JSON (dicts), not tb_rest_client32 models.
+    Every request goes through throttle (the process wide gThrottle by default), shared with the synchronous helpers;
+    give it a RequestThrottle with a higher max_concurrency to keep hundreds of requests in flight.
+
+        async with AsyncTbClient(TB_URL) as tb_client:
+            await tb_client.login(TB_USERNAME, TB_PASSWORD)
+            raw = await get_timeseries_all_async(tb_client, dev_id, 'data.T.raw', start_ts)
+    '''
+    def __init__(self, base_url: str, pool_maxsize: int = DEFAULT_POOL_MAXSIZE, timeout_seconds: int = 60,
+                 throttle: RequestThrottle = None):
+        self.base_url = base_url.rstrip('/')
+        self.throttle = throttle or gThrottle
+        self._pool_maxsize = pool_maxsize
+        self._timeout = aiohttp.ClientTimeout(total=timeout_seconds)
+        self._session = None
+        self._token = None
+        self._username = None
+        self._password = None
+        self._login_lock = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # created lazily, the session must belong to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self._pool_maxsize, limit_per_host=self._pool_maxsize,
+                                             keepalive_timeout=KEEPALIVE_SECONDS, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+            self._login_lock = asyncio.Lock()
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _login_unlocked(self):
+        # under self._login_lock
+        async with self._get_session().post(self.base_url + '/api/auth/login',
+                                            json={'username': self._username, 'password': self._password}) as resp:
+            resp.raise_for_status()
+            self._token = (await resp.json())['token']
+        logger.debug('AsyncTbClient.login(): logged in to %s as %s' % (self.base_url, self._username))
+
+    async def login(self, username: str, password: str):
+        self._username = username
+        self._password = password
+        self._get_session()
+        async with self._login_lock:
+            await self._login_unlocked()
+
+    async def _relogin(self, old_token: str):
+        # many requests may see the same expired token, only the first one logs in again: the check and the login
+        # are done under the same lock, the others find a new token once they get it
+        async with self._login_lock:
+            if self._token != old_token:
+                return
+            await self._login_unlocked()
+
+    async def _get(self, url_path: str, params: dict = None):
+        return await self.throttle.call_async(self._get_once, url_path, params, points_of=_points)
+
+    async def _get_once(self, url_path: str, params: dict = None):
+        session = self._get_session()
+        for attempt in range(2):
+            token = self._token
+            async with session.get(self.base_url + url_path, params=params,
+                                   headers={'X-Authorization': 'Bearer %s' % token}) as resp:
+                if resp.status == 401 and attempt == 0 and self._username is not None:
+                    logger.debug('AsyncTbClient._get(): token expired, logging in again')
+                    await self._relogin(token)
+                    continue
+                resp.raise_for_status()
+                return await resp.json()
+
+    async def get_tenant_customer(self, customer_title: str) -> dict:
+        return await self._get('/api/tenant/customers', params={'customerTitle': customer_title})
+
+    async def get_customer_devices(self, customer_id: str, page_size: int, page: int,
+                                   sort_property: str = None, sort_order: str = None) -> dict:
+        params = {'pageSize': page_size, 'page': page}
+        if sort_property:
+            params['sortProperty'] = sort_property
+        if sort_order:
+            params['sortOrder'] = sort_order
+        return await self._get('/api/customer/%s/devices' % customer_id, params=params)
+
+    async def get_timeseries(self, dev_id, keys: str, start_ts: int, end_ts: int, limit: int = None,
+                             agg: str = None, interval: int = None, use_strict_data_types: bool = False) -> dict:
+        params = {'keys': keys, 'startTs': start_ts, 'endTs': end_ts,
+                  'useStrictDataTypes': 'true' if use_strict_data_types else 'false'}
+        if limit is not None:
+            params['limit'] = limit
+        if agg is not None:
+            params['agg'] = agg
+        if interval is not None:
+            params['interval'] = interval
+        return await self._get('/api/plugins/telemetry/%s/%s/values/timeseries' % (dev_id.entity_type, dev_id.id),
+                               params=params)
+
+
+# Async counterpart of get_devices_by_customer_name_as_dict()
+async def get_devices_by_customer_name_as_dict_async(tb_client: AsyncTbClient, customer_name: str,
+                                                     page_size: int = 1000) -> dict:
+    target_customer = await tb_client.get_tenant_customer(customer_name)
+    customer_devices = []
+
+    i_page = 0
+    while True:
+        resp = await tb_client.get_customer_devices(target_customer['id']['id'], page_size=page_size, page=i_page)
+        customer_devices.extend(resp['data'])
+
+        i_page += 1
+        if i_page >= resp['totalPages']:
+            break
+
+    return {d['name']: d for d in customer_devices}
+
+
+# Async counterpart of get_timeseries_all() for raw values, same paging and format (newest first).
+# semaphore, if given, is held for each request rather than for the whole download
+async def get_timeseries_all_async(tb_client: AsyncTbClient, dev_id, key: str, start_ts: int, end_ts: int = None,
+                                   page_limit: int = 1000, use_strict_data_types: bool = False,
+                                   semaphore: asyncio.Semaphore = None) -> list:
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    raw = []
+    my_end_ts = end_ts
+    while my_end_ts >= start_ts:
+        if semaphore is not None:
+            async with semaphore:
+                data = await tb_client.get_timeseries(dev_id, key, start_ts=start_ts, end_ts=my_end_ts,
+                                                      limit=page_limit, use_strict_data_types=use_strict_data_types)
+        else:
+            data = await tb_client.get_timeseries(dev_id, key, start_ts=start_ts, end_ts=my_end_ts,
+                                                  limit=page_limit, use_strict_data_types=use_strict_data_types)
+        page = data.get(key, [])
+        raw.extend(page)
+
+        # a short page means everything down to start_ts has been received
+        if len(page) < page_limit:
+            break
+
+        my_end_ts = min([d['ts'] for d in page]) - 1
+
+    logger.debug("get_timeseries_all_async(): %s a total of %d values received" % (key, len(raw)))
+
+    return raw
+
+
+# Async counterpart of get_timeseries_by_device(), the keys are downloaded concurrently. Same flat list, in lst_key order
+async def get_timeseries_by_device_async(tb_client: AsyncTbClient, this_dev, lst_key: list, start_ts: int = 1,
+                                         end_ts: int = None, page_limit: int = 5000,
+                                         semaphore: asyncio.Semaphore = None) -> list:
+    lst_resp = await asyncio.gather(*[get_timeseries_all_async(tb_client, this_dev, k, start_ts, end_ts=end_ts,
+                                                               page_limit=page_limit, semaphore=semaphore)
+                                      for k in lst_key])
+
+    return [d for resp in lst_resp for d in resp]
+
+
+async def get_timeseries_by_devices_async(tb_client: AsyncTbClient, dev_specs: dict, lst_key: list,
+                                          start_ts: int = 1, end_ts: int = None, page_limit: int = 5000,
+                                          max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                          result_type: str = 'records'):
+    '''
+    Async counterpart of get_timeseries_by_devices(): every device x key download runs as a task, with at most
+    max_concurrency requests in flight. Returns the same (dict_raw, dict_failed).
+    '''
+    if result_type not in RESULT_TYPES:
+        raise ValueError('unknown result type %s, expected one of %s' % (result_type, ', '.join(RESULT_TYPES)))
+    if end_ts is None:
+        end_ts = int(time.time() * 1000)
+
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+    dict_raw = {}
+    dict_failed = {}
+
+    tasks = []
+    for name, spec in dev_specs.items():
+        try:
+            if spec is None:
+                raise KeyError(name)
+            this_dev = device_id_from_spec(spec)
+        except (KeyError, TypeError) as e:
+            logger.warning('get_timeseries_by_devices_async(): cannot resolve device %s, skipping it' % name)
+            dict_failed[name] = {None: e}
+            continue
+
+        dict_raw[name] = {}
+        for k in lst_key:
+            tasks.append((name, k, get_timeseries_all_async(tb_client, this_dev, k, start_ts, end_ts=end_ts,
+                                                            page_limit=page_limit, semaphore=semaphore)))
+
+    results = await asyncio.gather(*[t for _, _, t in tasks], return_exceptions=True)
+    for (name, k, _), result in zip(tasks, results):
+        if isinstance(result, Exception):
+            logger.warning('get_timeseries_by_devices_async(): %s %s failed: %s' % (name, k, result))
+            dict_failed.setdefault(name, {})[k] = result
+        else:
+            dict_raw[name][k] = convert_timeseries(result, k, result_type)
+
+    return dict_raw, dict_failed
@@ -0,0 +1,181 @@
+## Disk backed cache for timeseries data downloaded from thingsboard
+import json
+import sqlite3
+import threading
+import time
+import logging
+from os import path, makedirs, environ
+
+logger = logging.getLogger(__name__)
+
+# TB_STREAMLITTOOLS_CACHE moves every cache and snapshot of the process elsewhere (benchmarks, tests)
+CACHE_FOLDER = environ.get('TB_STREAMLITTOOLS_CACHE') or path.join(path.expanduser('~'), '.cache', 'tb_streamlittools')
+DEFAULT_CACHE_PATH = path.join(CACHE_FOLDER, 'timeseries.sqlite')
+COVERAGE_SETTLE_MS = 5 * 60 * 1000      # values younger than this may still arrive late, never mark them as covered
+
+
+STRICT_KEY_SUFFIX = '\x00strict'     # rows of values downloaded with use_strict_data_types
+
+
+def _dev_key(dev_id) -> str:
+    # accept a DeviceId or a plain device id string
+    return getattr(dev_id, 'id', dev_id)
+
+
+def _row_key(key: str, strict: bool) -> str:
+    # typed and string values of a key are cached apart, rows of string values keep the plain key
+    return key + STRICT_KEY_SUFFIX if strict else key
+
+
+class TimeseriesCache(object):
+    '''
+    SQLite cache of timeseries values keyed by (device id, key, ts).
+
+    Next to the values, the cache keeps the time intervals [start_ts, end_ts] (ms, inclusive) that were completely
+    downloaded for each (device id, key), so a request only needs to download the intervals that are not covered
+    yet and can answer the rest locally. The object can be shared between threads.
+    Values downloaded with use_strict_data_types (numbers, booleans) and without (strings) are kept apart: every
+    method takes strict, which must match the use_strict_data_types of the downloads.
+    '''
+    def __init__(self, db_path: str = DEFAULT_CACHE_PATH, settle_ms: int = COVERAGE_SETTLE_MS):
+        '''
+        :param db_path: sqlite file, created with its folder if needed; ':memory:' for a throw away cache
+        :param settle_ms: the last settle_ms before now are never marked as covered
+        '''
+        if db_path != ':memory:':
+            folder = path.dirname(path.abspath(db_path))
+            if not path.isdir(folder):
+                makedirs(folder)
+
+        self._db_path = db_path
+        self._settle_ms = settle_ms
+        self._lock = threading.Lock()
+        self._cnx = sqlite3.connect(db_path, check_same_thread=False)
+        self._cnx.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            CREATE TABLE IF NOT EXISTS ts_value (
+                device_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                value TEXT,
+                PRIMARY KEY (device_id, key, ts)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS ts_coverage (
+                device_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER NOT NULL,
+                PRIMARY KEY (device_id, key, start_ts)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS ts_watermark (
+                device_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                start_ts INTEGER NOT NULL,
+                watermark_ts INTEGER NOT NULL,
+                PRIMARY KEY (device_id, key)
+            ) WITHOUT ROWID;
+        ''')
+        logger.debug('TimeseriesCache(): using %s' % db_path)
+
+    @property
+    def settle_ms(self) -> int:
+        return self._settle_ms
+
+    def close(self):
+        with self._lock:
+            self._cnx.close()
+
+    def get_missing_intervals(self, dev_id, key: str, start_ts: int, end_ts: int, strict: bool = False) -> list:
+        '''
+        :return: list of (start_ts, end_ts) intervals within [start_ts, end_ts] not covered yet, oldest first
+        '''
+        with self._lock:
+            covered = self._cnx.execute('SELECT start_ts, end_ts FROM ts_coverage '
+                                        'WHERE device_id = ? AND key = ? AND end_ts >= ? AND start_ts <= ? '
+                                        'ORDER BY start_ts',
+                                        (_dev_key(dev_id), _row_key(key, strict), start_ts, end_ts)).fetchall()
+
+        missing = []
+        cursor = start_ts
+        for c_start, c_end in covered:
+            if c_start > cursor:
+                missing.append((cursor, c_start - 1))
+            cursor = max(cursor, c_end + 1)
+        if cursor <= end_ts:
+            missing.append((cursor, end_ts))
+
+        return missing
+
+    def add_values(self, dev_id, key: str, raw: list, start_ts: int, end_ts: int, strict: bool = False):
+        '''
+        Store raw ([{'ts': ..., 'value': ...}, ...]) and mark [start_ts, end_ts] as covered, meaning raw holds every
+        value thingsboard has in that interval.
+        '''
+        dev = _dev_key(dev_id)
+        key = _row_key(key, strict)
+        end_ts = min(end_ts, int(time.time() * 1000) - self._settle_ms)
+
+        with self._lock, self._cnx:
+            self._cnx.executemany('INSERT OR REPLACE INTO ts_value (device_id, key, ts, value) VALUES (?, ?, ?, ?)',
+                                  [(dev, key, d['ts'], json.dumps(d['value'])) for d in raw])
+            if end_ts < start_ts:
+                return
+
+            # merge with the intervals it overlaps or touches
+            touching = self._cnx.execute('SELECT start_ts, end_ts FROM ts_coverage '
+                                         'WHERE device_id = ? AND key = ? AND end_ts >= ? AND start_ts <= ?',
+                                         (dev, key, start_ts - 1, end_ts + 1)).fetchall()
+            for c_start, c_end in touching:
+                start_ts = min(start_ts, c_start)
+                end_ts = max(end_ts, c_end)
+            self._cnx.executemany('DELETE FROM ts_coverage WHERE device_id = ? AND key = ? AND start_ts = ?',
+                                  [(dev, key, c_start) for c_start, _ in touching])
+            self._cnx.execute('INSERT INTO ts_coverage (device_id, key, start_ts, end_ts) VALUES (?, ?, ?, ?)',
+                              (dev, key, start_ts, end_ts))
+
+    def get_values(self, dev_id, key: str, start_ts: int, end_ts: int, strict: bool = False) -> list:
+        '''
+        :return: cached values within [start_ts, end_ts] in the get_timeseries_all() format, newest first
+        '''
+        with self._lock:
+            rows = self._cnx.execute('SELECT ts, value FROM ts_value '
+                                     'WHERE device_id = ? AND key = ? AND ts >= ? AND ts <= ? ORDER BY ts DESC',
+                                     (_dev_key(dev_id), _row_key(key, strict), start_ts, end_ts)).fetchall()
+
+        return [{'ts': ts, 'value': json.loads(value)} for ts, value in rows]
+
+    def get_watermark(self, dev_id, key: str, strict: bool = False):
+        '''
+        :return: (start_ts, watermark_ts) of the history stored by the incremental mode, None if there is none yet.
+            The history holds every value from start_ts up to the newest value received, watermark_ts.
+        '''
+        with self._lock:
+            return self._cnx.execute('SELECT start_ts, watermark_ts FROM ts_watermark WHERE device_id = ? AND key = ?',
+                                     (_dev_key(dev_id), _row_key(key, strict))).fetchone()
+
+    def set_watermark(self, dev_id, key: str, start_ts: int, watermark_ts: int, strict: bool = False):
+        with self._lock, self._cnx:
+            self._cnx.execute('INSERT OR REPLACE INTO ts_watermark (device_id, key, start_ts, watermark_ts) '
+                              'VALUES (?, ?, ?, ?)',
+                              (_dev_key(dev_id), _row_key(key, strict), start_ts, watermark_ts))
+
+    def invalidate(self, dev_id=None, key: str = None):
+        '''
+        Drop cached values, coverage and watermarks, for one device and/or key (typed and string values) or for
+        everything
+        '''
+        where = []
+        args = []
+        if dev_id is not None:
+            where.append('device_id = ?')
+            args.append(_dev_key(dev_id))
+        if key is not None:
+            where.append('key IN (?, ?)')
+            args.extend([key, _row_key(key, True)])
+        clause = (' WHERE ' + ' AND '.join(where)) if where else ''
+
+        with self._lock, self._cnx:
+            self._cnx.execute('DELETE FROM ts_value' + clause, args)
+            self._cnx.execute('DELETE FROM ts_coverage' + clause, args)
+            self._cnx.execute('DELETE FROM ts_watermark' + clause, args)
@@ -0,0 +1,169 @@
+## Fetch the timeseries of many devices and keys and assemble them into DataFrames in a single pass
+import time
+import logging
+import numpy as np
+import pandas as pd
+from lib.mCommon.thingsboard import RestClientPE, TimeseriesArrays, TimeseriesCache, TimeseriesKeyIndex, \
+    DEFAULT_MAX_WORKERS, get_timeseries_by_devices
+from lib.mCommon.thingsboard_memo import FrameMemo, memo_key
+from lib.mCommon.thingsboard_cache import COVERAGE_SETTLE_MS
+
+logger = logging.getLogger(__name__)
+
+LONG_COLUMNS = ['device', 'key', 'ts', 'value']
+
+
+def _ts_index(ts: np.ndarray) -> pd.DatetimeIndex:
+    return pd.DatetimeIndex(pd.to_datetime(ts, unit='ms'), name='ts')
+
+
+# Wide frame of one device from {key: TimeseriesArrays}: indexed by the datetime 'ts' of every value of any key
+# (ascending), one float64 column per key in lst_key order, NaN where a key has no value at that ts. Keys without any
+# value get no column, a device without any value gives an empty DataFrame
+def wide_frame_from_arrays(dict_arrays: dict, lst_key: list = None) -> pd.DataFrame:
+    lst_key = [k for k in (lst_key or list(dict_arrays)) if k in dict_arrays and len(dict_arrays[k].ts)]
+    if not lst_key:
+        return pd.DataFrame()
+
+    ts = np.unique(np.concatenate([dict_arrays[k].ts for k in lst_key]))
+    matrix = np.full((len(ts), len(lst_key)), np.nan, dtype=np.float64)
+    for j, k in enumerate(lst_key):
+        matrix[np.searchsorted(ts, dict_arrays[k].ts), j] = dict_arrays[k].value
+
+    return pd.DataFrame(matrix, index=_ts_index(ts), columns=lst_key)
+
+
+# Long frame from {name: {key: TimeseriesArrays}}: one row per value with the columns device and key (categoricals,
+# in the order of dict_raw and lst_key), ts (datetime) and value (float64), sorted by device, key and ts
+def long_frame_from_arrays(dict_raw: dict, lst_key: list = None) -> pd.DataFrame:
+    devices = list(dict_raw)
+    if lst_key is None:
+        lst_key = list(dict.fromkeys([k for d in dict_raw.values() for k in d]))
+
+    lst_arrays = []
+    device_codes = []
+    key_codes = []
+    for i_dev, name in enumerate(devices):
+        for j, k in enumerate(lst_key):
+            arrays = dict_raw[name].get(k)
+            if arrays is None or not len(arrays.ts):
+                continue
+            lst_arrays.append(arrays)
+            device_codes.append(np.full(len(arrays.ts), i_dev, dtype=np.int32))
+            key_codes.append(np.full(len(arrays.ts), j, dtype=np.int32))
+
+    if not lst_arrays:
+        return pd.DataFrame({'device': pd.Categorical([], categories=devices),
+                             'key': pd.Categorical([], categories=lst_key),
+                             'ts': pd.to_datetime(np.empty(0, dtype=np.int64), unit='ms'),
+                             'value': np.empty(0, dtype=np.float64)}, columns=LONG_COLUMNS)
+
+    return pd.DataFrame({'device': pd.Categorical.from_codes(np.concatenate(device_codes), categories=devices),
+                         'key': pd.Categorical.from_codes(np.concatenate(key_codes), categories=lst_key),
+                         'ts': pd.to_datetime(np.concatenate([a.ts for a in lst_arrays]), unit='ms'),
+                         'value': np.concatenate([a.value for a in lst_arrays])}, columns=LONG_COLUMNS)
+
+
+# {name: wide frame} (see wide_frame_from_arrays()) from a long frame, one frame per device of the long frame
+def wide_frames_from_long(df_long: pd.DataFrame, lst_key: list = None) -> dict:
+    if lst_key is None:
+        lst_key = list(df_long['key'].cat.categories)
+
+    frames = {}
+    for name, df_dev in df_long.groupby('device', observed=False, sort=False):
+        dict_arrays = {k: TimeseriesArrays(df_key['ts'].to_numpy(dtype='datetime64[ms]').astype(np.int64),
+                                           df_key['value'].to_numpy())
+                       for k, df_key in df_dev.groupby('key', observed=True, sort=False)}
+        frames[name] = wide_frame_from_arrays(dict_arrays, lst_key)
+
+    return frames
+
+
+# Result of the query from memo if it holds it, else run assemble() (returning (result, dict_failed)) and keep its
+# result in memo when every download succeeded. A query ending less than COVERAGE_SETTLE_MS ago, or in the future, may
+# still get values: it is kept as open ended, with the TTL of the memo
+def _memoized(memo: FrameMemo, operation: str, tb_client: RestClientPE, dev_specs: dict, lst_key: list, assemble,
+              start_ts: int, end_ts: int, agg: str, interval: int):
+    if memo is None:
+        return assemble()
+
+    key = memo_key(operation, tb_client, dev_specs, lst_key, start_ts=start_ts, end_ts=end_ts, agg=agg,
+                   interval=interval)
+    result = memo.get(key)
+    if result is not None:
+        return result, {}
+
+    result, dict_failed = assemble()
+    if not dict_failed:
+        now_ms = int(time.time() * 1000)
+        memo.put(key, result, open_ended=end_ts is None or end_ts >= now_ms - COVERAGE_SETTLE_MS)
+    return result, dict_failed
+
+
+# ms timestamps of the rows of a wide frame where key has a value, NaN on the other rows
+def raw_ts_column(df_wide: pd.DataFrame, key: str) -> pd.Series:
+    ts_ms = (df_wide.index - pd.Timestamp(0)) // pd.Timedelta(milliseconds=1)
+    return pd.Series(ts_ms, index=df_wide.index, dtype=np.float64).where(df_wide[key].notna())
+
+
+def _fetch_arrays(tb_client: RestClientPE, dev_specs: dict, lst_key: list, **kwargs):
+    dict_raw, dict_failed = get_timeseries_by_devices(tb_client, dev_specs, lst_key, result_type='arrays', **kwargs)
+    for name, failed in dict_failed.items():
+        for k, e in failed.items():
+            logger.warning('%s: %s could not be downloaded: %s' % (name, k or 'device', e))
+
+    # the download order is the completion order, keep the order of dev_specs
+    return {name: dict_raw[name] for name in dev_specs if name in dict_raw}, dict_failed
+
+
+def get_wide_frames_by_devices(tb_client: RestClientPE, dev_specs: dict, lst_key: list, start_ts: int = 1,
+                               end_ts: int = None, page_limit: int = 5000, max_workers: int = DEFAULT_MAX_WORKERS,
+                               cache: TimeseriesCache = None, incremental: bool = False,
+                               agg: str = None, interval: int = None, key_index: TimeseriesKeyIndex = None,
+                               raw_json: bool = False, memo: FrameMemo = None, deadline: float = None):
+    '''
+    Download every key in lst_key for every device in dev_specs ({name: device dict or DeviceId}) with
+    get_timeseries_by_devices(), and build one wide frame per device, what the pages did with a from_records() and
+    concat() per key:
+        index       datetime 'ts' of every value of any key, ascending
+        columns     one float64 column per key with at least one value, in lst_key order, NaN where a key has no value
+                    at that ts; values that are not numbers are NaN
+    A device without any value gets an empty DataFrame.
+    With a memo (see get_frame_memo()) the same query (host, devices, keys, start_ts, end_ts, agg, interval) is only
+    downloaded once, until it is evicted or invalidated. With a deadline and a cache, downloads cut short are reported
+    in dict_failed (see get_timeseries_by_devices()) and their frames hold what was received so far, such a result is
+    not memoized.
+
+    Returns (frames, dict_failed), frames being {name: DataFrame} in dev_specs order and dict_failed as returned by
+    get_timeseries_by_devices()
+    '''
+    def assemble():
+        dict_raw, dict_failed = _fetch_arrays(tb_client, dev_specs, lst_key, start_ts=start_ts, end_ts=end_ts,
+                                              page_limit=page_limit, max_workers=max_workers, cache=cache,
+                                              incremental=incremental, agg=agg, interval=interval,
+                                              key_index=key_index, raw_json=raw_json, deadline=deadline)
+        return {name: wide_frame_from_arrays(dict_arrays, lst_key) for name, dict_arrays in dict_raw.items()}, \
+            dict_failed
+
+    return _memoized(memo, 'wide', tb_client, dev_specs, lst_key, assemble, start_ts, end_ts, agg, interval)
+
+
+def get_long_frame_by_devices(tb_client: RestClientPE, dev_specs: dict, lst_key: list, start_ts: int = 1,
+                              end_ts: int = None, page_limit: int = 5000, max_workers: int = DEFAULT_MAX_WORKERS,
+                              cache: TimeseriesCache = None, incremental: bool = False,
+                              agg: str = None, interval: int = None, key_index: TimeseriesKeyIndex = None,
+                              raw_json: bool = False, memo: FrameMemo = None, deadline: float = None):
+    '''
+    Same downloads as get_wide_frames_by_devices(), assembled into one long frame of every value of every device
+    (see long_frame_from_arrays()), built from the downloaded arrays in one concatenation.
+
+    Returns (df_long, dict_failed)
+    '''
+    def assemble():
+        dict_raw, dict_failed = _fetch_arrays(tb_client, dev_specs, lst_key, start_ts=start_ts, end_ts=end_ts,
+                                              page_limit=page_limit, max_workers=max_workers, cache=cache,
+                                              incremental=incremental, agg=agg, interval=interval,
+                                              key_index=key_index, raw_json=raw_json, deadline=deadline)
+        return long_frame_from_arrays(dict_raw, lst_key), dict_failed
+
+    return _memoized(memo, 'long', tb_client, dev_specs, lst_key, assemble, start_ts, end_ts, agg, interval)
@@ -0,0 +1,184 @@
+## Memoization of the assembled telemetry across streamlit reruns, with a memory budget and LRU eviction
+import time
+import threading
+import logging
+from collections import OrderedDict
+import pandas as pd
+from lib.mCommon.thingsboard import device_id_from_spec, client_user
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMO_MAX_BYTES = 512 * 1024 * 1024
+OPEN_END_TTL_SECONDS = 5 * 60       # results up to "now" (no end_ts) are downloaded again when older than this
+
+gFrameMemo = None               # FrameMemo of the process when streamlit is not running
+gFrameMemoLock = threading.Lock()
+_cached_memo_factory = None
+
+
+def _copy(result):
+    # callers add columns to the frames they get, the memoized ones stay as downloaded
+    if isinstance(result, dict):
+        return {k: _copy(v) for k, v in result.items()}
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.copy()
+    return result
+
+
+def _size(result) -> int:
+    if isinstance(result, dict):
+        return sum([_size(v) for v in result.values()])
+    if isinstance(result, pd.DataFrame):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    if isinstance(result, pd.Series):
+        return int(result.memory_usage(index=True, deep=True))
+    return 0
+
+
+def memo_key(operation: str, tb_client, dev_specs: dict, lst_key: list, **params) -> tuple:
+    '''
+    Key of a query: the operation, the thingsboard host and user, the devices (names and ids), the keys and every
+    other parameter of the query (start_ts, end_ts, agg...). Parameters are compared by value, so give hashable ones.
+    The memo is shared by every session: with the user in the key, a user never gets frames thingsboard did not let
+    them download.
+    '''
+    devices = []
+    for name, spec in dev_specs.items():
+        try:
+            devices.append((name, device_id_from_spec(spec).id))
+        except (KeyError, TypeError):
+            devices.append((name, None))
+
+    return (operation, getattr(tb_client, 'base_url', ''), client_user(tb_client), tuple(devices), tuple(lst_key),
+            tuple(sorted(params.items())))
+
+
+class FrameMemo(object):
+    '''
+    LRU memo of query results (frames or {name: frame}) by memo_key(), holding at most max_bytes of frames: the
+    least recently used results are evicted first, a result larger than max_bytes is not kept.
+    get() and put() copy the frames, callers can modify what they get. Results of open ended queries (end_ts None)
+    expire after open_end_ttl_seconds.
+
+        memo = get_frame_memo()
+        frames, dict_failed = get_wide_frames_by_devices(tb_client, specs, keys, start_ts, end_ts, memo=memo)
+    '''
+    def __init__(self, max_bytes: int = DEFAULT_MEMO_MAX_BYTES, open_end_ttl_seconds: int = OPEN_END_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.open_end_ttl_seconds = open_end_ttl_seconds
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()       # key -> (result, n_bytes, stored time.time(), open ended)
+        self.n_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        # under self._lock
+        _, n_bytes, _, _ = self._entries.pop(key)
+        self.n_bytes -= n_bytes
+
+    def get(self, key: tuple):
+        '''
+        :return: a copy of the result of key, None if it is not memoized
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[3] and time.time() - entry[2] > self.open_end_ttl_seconds:
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            result = entry[0]
+
+        return _copy(result)
+
+    def put(self, key: tuple, result, open_ended: bool = False):
+        n_bytes = _size(result)
+        if n_bytes > self.max_bytes:
+            logger.debug('FrameMemo: %d bytes result over the %d bytes budget, not kept' % (n_bytes, self.max_bytes))
+            return
+
+        result = _copy(result)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (result, n_bytes, time.time(), open_ended)
+            self.n_bytes += n_bytes
+            while self.n_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.stats['evictions'] += 1
+
+    def invalidate(self, device: str = None, key: str = None, host: str = None) -> int:
+        '''
+        Forget the results involving the device (name or id), the timeseries key and / or the host, every result if
+        none is given. Returns the number of results forgotten
+        '''
+        def matches(memo_key):
+            _, memo_host, _, devices, keys, _ = memo_key
+            if host is not None and memo_host != host:
+                return False
+            if device is not None and not any([device in d for d in devices]):
+                return False
+            if key is not None and key not in keys:
+                return False
+            return True
+
+        with self._lock:
+            lst_key = [k for k in self._entries if matches(k)]
+            for k in lst_key:
+                self._drop(k)
+
+        return len(lst_key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.n_bytes = 0
+
+
+def _streamlit_running() -> bool:
+    try:
+        from streamlit import runtime
+    except ImportError:
+        return False
+    return runtime.exists()
+
+
+def _new_frame_memo(max_bytes: int) -> FrameMemo:
+    return FrameMemo(max_bytes=max_bytes)
+
+
+# FrameMemo shared by every session and rerun: a st.cache_resource when streamlit runs (cleared with the other
+# resources from the streamlit menu), a module level one otherwise
+def get_frame_memo(max_bytes: int = DEFAULT_MEMO_MAX_BYTES) -> FrameMemo:
+    global gFrameMemo, _cached_memo_factory
+
+    if _streamlit_running():
+        import streamlit as st
+
+        if _cached_memo_factory is None:
+            _cached_memo_factory = st.cache_resource(show_spinner=False)(_new_frame_memo)
+        return _cached_memo_factory(max_bytes)
+
+    with gFrameMemoLock:
+        if gFrameMemo is None:
+            gFrameMemo = FrameMemo(max_bytes=max_bytes)
+        return gFrameMemo
+
+
+# Show the memo usage in the sidebar with a button to forget every downloaded result
+def show_memo_controls(memo: FrameMemo = None):
+    import streamlit as st
+
+    memo = memo or get_frame_memo()
+    with st.sidebar:
+        st.caption('Downloaded data: %d results, %.1f of %.0f MB (%d hits, %d misses)' %
+                   (len(memo), memo.n_bytes / 1e6, memo.max_bytes / 1e6, memo.stats['hits'], memo.stats['misses']))
+        if st.button('Clear downloaded data'):
+            memo.clear()
+            st.toast('Downloaded data cleared, the next run downloads again')
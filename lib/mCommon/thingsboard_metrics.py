@@ -0,0 +1,192 @@
+## Instrumentation of the thingsboard helpers: requests, pages, points, bytes, latencies and retries
+import time
+import threading
+import logging
+import contextvars
+from collections import deque
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+MAX_RECORDS = 200000            # oldest records are dropped beyond this, the totals keep counting
+PERCENTILES = (50, 90, 99)
+
+# FetchMetrics of the streamlit session running the current code, see session_metrics()
+_session_metrics = contextvars.ContextVar('session_metrics', default=None)
+
+
+def _dev_label(dev_id) -> str:
+    # accept a DeviceId, a plain id string or None
+    return getattr(dev_id, 'id', dev_id)
+
+
+class FetchMetrics(object):
+    '''
+    Thread safe recorder of what the thingsboard helpers do, as two kinds of records:
+        request     one HTTP request: operation, device, key, latency_s, points, bytes, retries, error
+        call        one helper call (get_timeseries_all(), a device listing...): operation, device, key, wall_s,
+                    pages, points
+    bytes is None when the response size is not known (requests through the generated client, see raw_json).
+    Devices are recorded by id, name_devices() lets the reports show names instead.
+    With forward_to_session set (gMetrics) every record is also given to the metrics bound by session_metrics(), so a
+    page reports its own downloads without resetting the process wide totals of the others.
+
+        metrics = FetchMetrics()
+        ... run the downloads ...
+        print(metrics.summary())
+        df = metrics.by_device_key()
+    '''
+    def __init__(self, max_records: int = MAX_RECORDS, forward_to_session: bool = False):
+        self._forward_to_session = forward_to_session
+        self._lock = threading.Lock()
+        self._requests = deque(maxlen=max_records)
+        self._calls = deque(maxlen=max_records)
+        self._names = {}
+        self.start_ts = time.time()
+        self.totals = {}
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._calls.clear()
+            self.start_ts = time.time()
+            self.totals = {'requests': 0, 'points': 0, 'bytes': 0, 'retries': 0, 'errors': 0, 'calls': 0}
+
+    def _session(self):
+        session = _session_metrics.get() if self._forward_to_session else None
+        return session if session is not self else None
+
+    def name_devices(self, dict_names: dict):
+        '''
+        :param dict_names: {device id or DeviceId: name}
+        '''
+        with self._lock:
+            self._names.update({_dev_label(k): v for k, v in dict_names.items()})
+        session = self._session()
+        if session is not None:
+            session.name_devices(dict_names)
+
+    def record_request(self, operation: str, dev_id=None, key: str = None, latency_s: float = 0.0,
+                       points: int = 0, n_bytes: int = None, retries: int = 0, error: bool = False):
+        record = {'operation': operation, 'device': _dev_label(dev_id), 'key': key, 'latency_s': latency_s,
+                  'points': points, 'bytes': n_bytes, 'retries': retries, 'error': error}
+        with self._lock:
+            self._requests.append(record)
+            self.totals['requests'] += 1
+            self.totals['points'] += points
+            self.totals['bytes'] += n_bytes or 0
+            self.totals['retries'] += retries
+            self.totals['errors'] += int(error)
+        session = self._session()
+        if session is not None:
+            session.record_request(operation, dev_id, key, latency_s=latency_s, points=points, n_bytes=n_bytes,
+                                   retries=retries, error=error)
+        logger.debug('request %(operation)s device=%(device)s key=%(key)s latency_s=%(latency_s).3f '
+                     'points=%(points)d bytes=%(bytes)s retries=%(retries)d error=%(error)s' % record)
+
+    def record_call(self, operation: str, dev_id=None, key: str = None, wall_s: float = 0.0,
+                    pages: int = 0, points: int = 0):
+        record = {'operation': operation, 'device': _dev_label(dev_id), 'key': key, 'wall_s': wall_s,
+                  'pages': pages, 'points': points}
+        with self._lock:
+            self._calls.append(record)
+            self.totals['calls'] += 1
+        session = self._session()
+        if session is not None:
+            session.record_call(operation, dev_id, key, wall_s=wall_s, pages=pages, points=points)
+        logger.debug('call %(operation)s device=%(device)s key=%(key)s wall_s=%(wall_s).3f '
+                     'pages=%(pages)d points=%(points)d' % record)
+
+    def _frame(self, records) -> pd.DataFrame:
+        with self._lock:
+            df = pd.DataFrame(list(records))
+            names = dict(self._names)
+        if not df.empty:
+            df['device'] = df['device'].map(lambda d: names.get(d, d))
+        return df
+
+    def requests_frame(self) -> pd.DataFrame:
+        return self._frame(self._requests)
+
+    def calls_frame(self) -> pd.DataFrame:
+        return self._frame(self._calls)
+
+    def summary(self) -> dict:
+        '''
+        :return: totals since the last reset() with the request latency percentiles (s) and the throughput
+        '''
+        with self._lock:
+            summary = dict(self.totals)
+            latencies = np.array([r['latency_s'] for r in self._requests], dtype=np.float64)
+            elapsed = time.time() - self.start_ts
+
+        for p in PERCENTILES:
+            summary['latency_p%d_s' % p] = float(np.percentile(latencies, p)) if len(latencies) else None
+        summary['latency_max_s'] = float(latencies.max()) if len(latencies) else None
+        summary['elapsed_s'] = elapsed
+        summary['points_per_s'] = summary['points'] / elapsed if elapsed > 0 else None
+
+        return summary
+
+    def by_device_key(self) -> pd.DataFrame:
+        '''
+        :return: one row per (operation, device, key) with requests, points, bytes, retries, errors and latency
+            percentiles, the slowest total latency first
+        '''
+        df = self.requests_frame()
+        if df.empty:
+            return df
+
+        df = df.fillna({'device': '', 'key': ''})
+        grouped = df.groupby(['operation', 'device', 'key'])
+        result = grouped.agg(requests=('latency_s', 'size'), points=('points', 'sum'),
+                             bytes=('bytes', lambda b: b.sum(min_count=1)), retries=('retries', 'sum'),
+                             errors=('error', 'sum'), latency_total_s=('latency_s', 'sum'))
+        for p in PERCENTILES:
+            result['latency_p%d_s' % p] = grouped['latency_s'].quantile(p / 100.0)
+
+        return result.sort_values('latency_total_s', ascending=False)
+
+
+gMetrics = FetchMetrics(forward_to_session=True)        # shared by every thingsboard helper of the process
+
+
+# Fresh FetchMetrics for a run of a page, bound to the current context so that gMetrics also records into it: kept in
+# st.session_state when streamlit runs, so concurrent sessions do not count (or reset) each other's downloads.
+# Worker threads see it when their tasks run in a copy of the context (see submit_in_context())
+def session_metrics() -> FetchMetrics:
+    metrics = FetchMetrics()
+    try:
+        from streamlit import runtime
+        if runtime.exists():
+            import streamlit as st
+            st.session_state['fetch_metrics'] = metrics
+    except ImportError:
+        pass
+    _session_metrics.set(metrics)
+
+    return metrics
+
+
+# executor.submit() running function in a copy of the current context, the session metrics included
+def submit_in_context(executor, function, *args, **kwargs):
+    return executor.submit(contextvars.copy_context().run, function, *args, **kwargs)
+
+
+# Show metrics in a streamlit expander: the totals, then the per device and key table. By default the metrics of the
+# session (see session_metrics()), gMetrics if there are none
+def show_metrics_expander(metrics: FetchMetrics = None, title: str = 'Fetch metrics', expanded: bool = False):
+    import streamlit as st
+
+    metrics = metrics or _session_metrics.get() or gMetrics
+    summary = metrics.summary()
+    with st.expander(title, expanded=expanded):
+        cols = st.columns(4)
+        cols[0].metric('Requests', summary['requests'], '%d retries' % summary['retries'], delta_color='off')
+        cols[1].metric('Points', summary['points'])
+        cols[2].metric('MB received', '%.1f' % (summary['bytes'] / 1e6))
+        cols[3].metric('Latency p50 / p99',
+                       '%.2f / %.2f s' % (summary['latency_p50_s'] or 0, summary['latency_p99_s'] or 0))
+        st.dataframe(metrics.by_device_key())
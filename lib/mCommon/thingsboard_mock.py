@@ -0,0 +1,512 @@
+## Local stand-in for the thingsboard REST API, serving a synthetic fleet for benchmarks and offline runs
+import json
+import time
+import math
+import base64
+import random
+import threading
+import logging
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Keys read by the pages, every synthetic device reports all of them
+DEFAULT_KEYS = ['data.N.payload.BV', 'data.N.payload.ASCII.1.creed_active', 'data.E.payload.A',
+                'data.D.payload.ASCII.1.brd_ver', 'data.B.frame_count', 'data.N.payload.ASCII.1.conn_time'] + \
+               ['data.E.payload.T.%d' % n for n in range(1, 31)]
+BOARD_VERSIONS = ['2.1', '2.2', '3.0']
+AGG_TS_MAX_INTERVALS = 700
+
+
+class SyntheticFleet(object):
+    '''
+    Fleet of n_devices devices named like the real ones (260A2000, 260A2001, ...) owned by customer_name, each
+    reporting the keys of keys once per period_ms (shifted per device) over the last history_days. Like the real
+    boards, not every device has all 30 temperature sensors: device i reports data.E.payload.T.1 to T.(6 * (1 + i % 5)).
+    The devices are grouped in sites of site_size devices, assets 'Site 0', 'Site 1'... containing them.
+
+    Nothing is stored: the values are computed from (device, key, point index), so a fleet of any size and density
+    answers a request in time proportional to the values returned.
+    '''
+    def __init__(self, n_devices: int = 100, keys: list = None, period_ms: int = 60 * 1000, history_days: int = 30,
+                 customer_name: str = 'AOMS OPS', first_node: int = 2000, now_ms: int = None, site_size: int = 10):
+        self.n_devices = n_devices
+        self.site_size = max(1, site_size)
+        self.n_sites = int(math.ceil(n_devices / float(self.site_size)))
+        self.keys = list(keys or DEFAULT_KEYS)
+        self.period_ms = period_ms
+        self.customer_name = customer_name
+        self.customer_id = '00000000-0000-0000-0001-000000000000'
+        self.first_node = first_node
+        self.end_ms = now_ms if now_ms is not None else int(time.time() * 1000)
+        self.start_ms = self.end_ms - history_days * 86400 * 1000
+        self._created_ms = self.start_ms
+
+    def device_id(self, i_dev: int) -> str:
+        return '00000000-0000-0000-0002-%012x' % i_dev
+
+    def device_index(self, device_id: str):
+        try:
+            i_dev = int(device_id.rsplit('-', 1)[1], 16)
+        except (IndexError, ValueError):
+            return None
+        if not device_id.startswith('00000000-0000-0000-0002-') or i_dev >= self.n_devices:
+            return None
+        return i_dev
+
+    def device(self, i_dev: int) -> dict:
+        return {'id': {'entityType': 'DEVICE', 'id': self.device_id(i_dev)},
+                'createdTime': self._created_ms + i_dev * 1000,
+                'name': '260A%d' % (self.first_node + i_dev),
+                'type': 'default',
+                'label': None,
+                'customerId': {'entityType': 'CUSTOMER', 'id': self.customer_id},
+                'additionalInfo': None}
+
+    def asset_id(self, i_site: int) -> str:
+        return '00000000-0000-0000-0003-%012x' % i_site
+
+    def asset_index(self, asset_id: str):
+        try:
+            i_site = int(asset_id.rsplit('-', 1)[1], 16)
+        except (IndexError, ValueError):
+            return None
+        if not asset_id.startswith('00000000-0000-0000-0003-') or i_site >= self.n_sites:
+            return None
+        return i_site
+
+    def asset(self, i_site: int) -> dict:
+        return {'id': {'entityType': 'ASSET', 'id': self.asset_id(i_site)},
+                'createdTime': self._created_ms,
+                'name': 'Site %d' % i_site,
+                'type': 'site',
+                'label': None,
+                'customerId': {'entityType': 'CUSTOMER', 'id': self.customer_id},
+                'additionalInfo': None}
+
+    def site_devices(self, i_site: int) -> list:
+        return list(range(i_site * self.site_size, min(self.n_devices, (i_site + 1) * self.site_size)))
+
+    def _offset(self, i_dev: int) -> int:
+        # devices do not all report at the same instant
+        return self.start_ms + (i_dev * 7919) % self.period_ms
+
+    def point_range(self, i_dev: int, start_ts: int, end_ts: int):
+        '''
+        :return: (k_min, k_max) of the points within [start_ts, end_ts], k_max < k_min if there is none
+        '''
+        offset = self._offset(i_dev)
+        k_min = max(0, int(math.ceil((start_ts - offset) / float(self.period_ms))))
+        k_max = int(math.floor((min(end_ts, self.end_ms) - offset) / float(self.period_ms)))
+        return k_min, k_max
+
+    def ts(self, i_dev: int, k: np.ndarray) -> np.ndarray:
+        return self._offset(i_dev) + k * self.period_ms
+
+    def values(self, i_dev: int, key: str, k: np.ndarray):
+        '''
+        :return: values of key for the points k, float64 for numeric keys, a list of str for the others
+        '''
+        if key == 'data.D.payload.ASCII.1.brd_ver':
+            return [BOARD_VERSIONS[i_dev % len(BOARD_VERSIONS)]] * len(k)
+        if key == 'data.N.payload.BV':
+            return np.round(3.6 - 0.4 * k / max(1.0, float(self.n_points(i_dev))) + 0.01 * ((k * 13 + i_dev) % 5), 3)
+        if key == 'data.N.payload.ASCII.1.creed_active':
+            return ((k // 3 + i_dev) % 2).astype(np.float64)
+        if key == 'data.E.payload.A':
+            return ((k * 37 + i_dev * 101) % 1600 + 450).astype(np.float64)
+        if key == 'data.B.frame_count':
+            return ((k + i_dev) % 5000 + 1).astype(np.float64)
+        if key == 'data.N.payload.ASCII.1.conn_time':
+            return ((k * 7 + i_dev) % 40 + 2).astype(np.float64)
+        if key.startswith('data.E.payload.T.'):
+            return np.round(20.0 + 5.0 * np.sin(k / 60.0 + sum(map(ord, key)) % 7) + (i_dev % 10) / 10.0, 2)
+        return ((k + i_dev) % 100).astype(np.float64)
+
+    def n_points(self, i_dev: int) -> int:
+        k_min, k_max = self.point_range(i_dev, self.start_ms, self.end_ms)
+        return max(0, k_max - k_min + 1)
+
+    def device_keys(self, i_dev: int) -> list:
+        n_sensors = 6 * (1 + i_dev % 5)
+        sensors = ['data.E.payload.T.%d' % n for n in range(n_sensors + 1, 31)]
+        return [k for k in self.keys if k not in sensors]
+
+    def get_timeseries(self, i_dev: int, key: str, start_ts: int, end_ts: int, limit: int,
+                       agg: str = None, interval: int = None, strict: bool = False) -> list:
+        '''
+        :return: [{'ts': ..., 'value': ...}, ...] newest first as thingsboard answers, limited to limit values
+        '''
+        if key not in self.device_keys(i_dev):
+            return []
+
+        if agg and agg != 'NONE':
+            return self._get_aggregated(i_dev, key, start_ts, end_ts, agg, interval, limit, strict)
+
+        k_min, k_max = self.point_range(i_dev, start_ts, end_ts)
+        k_min = max(k_min, k_max - limit + 1)
+        if k_max < k_min:
+            return []
+
+        k = np.arange(k_max, k_min - 1, -1, dtype=np.int64)
+        return _records(self.ts(i_dev, k), self.values(i_dev, key, k), strict)
+
+    def _get_aggregated(self, i_dev: int, key: str, start_ts: int, end_ts: int, agg: str, interval: int,
+                        limit: int, strict: bool) -> list:
+        k_min, k_max = self.point_range(i_dev, start_ts, end_ts)
+        if k_max < k_min or not interval:
+            return []
+
+        k = np.arange(k_min, k_max + 1, dtype=np.int64)
+        ts = self.ts(i_dev, k)
+        values = self.values(i_dev, key, k)
+        if not isinstance(values, np.ndarray):
+            return []
+
+        bucket = (ts - start_ts) // interval
+        first = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+        if agg == 'COUNT':
+            result = np.diff(np.r_[first, len(ts)]).astype(np.float64)
+        elif agg == 'SUM':
+            result = np.add.reduceat(values, first)
+        elif agg == 'MIN':
+            result = np.minimum.reduceat(values, first)
+        elif agg == 'MAX':
+            result = np.maximum.reduceat(values, first)
+        else:
+            result = np.add.reduceat(values, first) / np.diff(np.r_[first, len(ts)])
+
+        bucket_ts = start_ts + bucket[first] * interval + interval // 2
+        n = min(limit, AGG_TS_MAX_INTERVALS)
+        return _records(bucket_ts[::-1][:n], result[::-1][:n], strict)
+
+    def get_latest(self, i_dev: int, key: str, strict: bool = False):
+        raw = self.get_timeseries(i_dev, key, self.start_ms, self.end_ms, 1, strict=strict)
+        return raw[0] if raw else None
+
+
+def _records(ts: np.ndarray, values, strict: bool) -> list:
+    ts = ts.tolist()
+    if isinstance(values, np.ndarray):
+        values = [int(v) if v.is_integer() else v for v in values.tolist()]
+        if not strict:
+            values = [str(v) for v in values]
+    return [{'ts': t, 'value': v} for t, v in zip(ts, values)]
+
+
+def _make_token(ttl_seconds: int, username: str = 'mock') -> str:
+    # unsigned JWT, enough for clients reading the expiry
+    def b64(d):
+        return base64.urlsafe_b64encode(json.dumps(d).encode('ascii')).decode('ascii').rstrip('=')
+    return '%s.%s.%s' % (b64({'alg': 'none'}), b64({'sub': username, 'exp': int(time.time()) + ttl_seconds,
+                                                    'jti': random.getrandbits(64)}), 'mock')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep-alive, as thingsboard behind its proxy
+
+    def log_message(self, fmt, *args):
+        logger.debug('MockThingsBoard: ' + fmt % args)
+
+    def _send(self, status: int, body=None, headers: dict = None):
+        data = b'' if body is None else json.dumps(body, separators=(',', ':')).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.mock.count(self.path, len(data))
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+    def _dispatch(self, method: str):
+        mock = self.server.mock
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = [p for p in url.path.split('/') if p]
+        # always consume the body, the connection is kept alive
+        body = self._read_json() if method == 'POST' else {}
+
+        fault = mock.inject_fault()
+        if fault is not None:
+            return self._send(*fault)
+
+        if method == 'POST' and url.path == '/api/auth/login':
+            if not body.get('username') or body.get('password') is None:
+                return self._send(401, {'status': 401, 'message': 'Authentication failed'})
+            return self._send(200, mock.new_tokens(body['username']))
+        if method == 'POST' and url.path == '/api/auth/token':
+            if body.get('refreshToken') not in mock.refresh_tokens:
+                return self._send(401, {'status': 401, 'message': 'Invalid refresh token'})
+            return self._send(200, mock.new_tokens(mock.refresh_tokens[body['refreshToken']]))
+
+        if not mock.authorized(self.headers.get('X-Authorization', '')):
+            return self._send(401, {'status': 401, 'message': 'Token has expired', 'errorCode': 11})
+
+        fleet = mock.fleet
+        if method == 'GET' and url.path == '/api/tenant/customers':
+            if query.get('customerTitle') != fleet.customer_name:
+                return self._send(404, {'status': 404, 'message': 'Requested item wasn\'t found!'})
+            return self._send(200, {'id': {'entityType': 'CUSTOMER', 'id': fleet.customer_id},
+                                    'title': fleet.customer_name, 'name': fleet.customer_name})
+
+        if method == 'GET' and url.path == '/api/tenant/assets':
+            names = [fleet.asset(i)['name'] for i in range(fleet.n_sites)]
+            if query.get('assetName') not in names:
+                return self._send(404, {'status': 404, 'message': 'Requested item wasn\'t found!'})
+            return self._send(200, fleet.asset(names.index(query['assetName'])))
+
+        if method == 'GET' and len(parts) == 4 and parts[:2] == ['api', 'customer'] and parts[3] == 'devices':
+            if parts[2] != fleet.customer_id:
+                return self._send(404, {'status': 404, 'message': 'Requested item wasn\'t found!'})
+            return self._send(200, mock.page_devices(query))
+
+        # /api/plugins/telemetry/DEVICE/{id}/values/timeseries and /keys/timeseries
+        if method == 'GET' and len(parts) == 7 and parts[:3] == ['api', 'plugins', 'telemetry']:
+            i_dev = fleet.device_index(parts[4])
+            if i_dev is None:
+                return self._send(404, {'status': 404, 'message': 'Requested item wasn\'t found!'})
+            if parts[5:] == ['keys', 'timeseries']:
+                return self._send(200, fleet.device_keys(i_dev))
+            if parts[5:] == ['values', 'timeseries']:
+                return self._send(200, mock.timeseries(i_dev, query))
+
+        if method == 'POST' and url.path == '/api/entitiesQuery/find':
+            return self._send(200, mock.find_entity_data(body))
+
+        return self._send(404, {'status': 404, 'message': 'Not found: %s %s' % (method, url.path)})
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+
+class MockThingsBoard(object):
+    '''
+    Local HTTP server answering the thingsboard REST calls used by lib.mCommon.thingsboard (login, token refresh,
+    customer lookup, customer device paging, asset lookup, timeseries values and keys, entity data query with entity
+    list and relations query filters) from a SyntheticFleet.
+
+    latency_ms (+ up to latency_jitter_ms) is added to every request; error_rate of the requests fail with HTTP 500
+    and rate_limit_rate with HTTP 429 and a Retry-After header. Requests and response bytes are counted in stats.
+
+        with MockThingsBoard(SyntheticFleet(n_devices=500)) as mock:
+            tb_client = get_tb_client(mock.host, mock.port, 'user', 'password')
+    '''
+    def __init__(self, fleet: SyntheticFleet = None, host: str = '127.0.0.1', port: int = 0,
+                 latency_ms: float = 0, latency_jitter_ms: float = 0, error_rate: float = 0,
+                 rate_limit_rate: float = 0, token_ttl_seconds: int = 9000, seed: int = None):
+        self.fleet = fleet or SyntheticFleet()
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.token_ttl_seconds = token_ttl_seconds
+        self.tokens = {}            # token -> expiry (epoch seconds)
+        self.refresh_tokens = {}    # refresh token -> username
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {}
+        self.reset_stats()
+
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def host(self) -> str:
+        return 'http://%s' % self._server.server_address[0]
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    @property
+    def url(self) -> str:
+        return '%s:%d' % (self.host, self.port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.debug('MockThingsBoard(): serving %d devices on %s' % (self.fleet.n_devices, self.url))
+        return self
+
+    def serve_forever(self):
+        # in the calling thread, until interrupted
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        self._server.server_close()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'bytes': 0, 'errors': 0, 'rate_limited': 0, 'by_endpoint': {},
+                          'bytes_by_endpoint': {}}
+
+    def count(self, request_path: str, n_bytes: int):
+        endpoint = urlparse(request_path).path
+        if endpoint.startswith('/api/plugins/telemetry/'):
+            endpoint = '/api/plugins/telemetry/.../' + '/'.join(endpoint.split('/')[-2:])
+        elif endpoint.startswith('/api/customer/'):
+            endpoint = '/api/customer/.../devices'
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += n_bytes
+            self.stats['by_endpoint'][endpoint] = self.stats['by_endpoint'].get(endpoint, 0) + 1
+            self.stats['bytes_by_endpoint'][endpoint] = self.stats['bytes_by_endpoint'].get(endpoint, 0) + n_bytes
+
+    def inject_fault(self):
+        '''
+        Sleep the configured latency, then return (status, body, headers) of an injected failure or None
+        '''
+        with self._lock:
+            delay = self.latency_ms + self._random.random() * self.latency_jitter_ms
+            draw = self._random.random()
+        if delay:
+            time.sleep(delay / 1000.0)
+
+        if draw < self.rate_limit_rate:
+            with self._lock:
+                self.stats['rate_limited'] += 1
+            return 429, {'status': 429, 'message': 'Too many requests', 'errorCode': 33}, {'Retry-After': '1'}
+        if draw < self.rate_limit_rate + self.error_rate:
+            with self._lock:
+                self.stats['errors'] += 1
+            return 500, {'status': 500, 'message': 'Injected failure'}
+        return None
+
+    def new_tokens(self, username: str = 'mock') -> dict:
+        token = _make_token(self.token_ttl_seconds, username)
+        refresh_token = _make_token(7 * 86400, username)
+        with self._lock:
+            self.tokens[token] = time.time() + self.token_ttl_seconds
+            self.refresh_tokens[refresh_token] = username
+        return {'token': token, 'refreshToken': refresh_token}
+
+    def authorized(self, header: str) -> bool:
+        if not header.startswith('Bearer '):
+            return False
+        with self._lock:
+            return self.tokens.get(header[len('Bearer '):], 0) > time.time()
+
+    def expire_tokens(self):
+        with self._lock:
+            self.tokens = {}
+
+    def page_devices(self, query: dict) -> dict:
+        fleet = self.fleet
+        page_size = int(query.get('pageSize', 10))
+        page = int(query.get('page', 0))
+        order = list(range(fleet.n_devices))
+        if query.get('sortOrder', 'ASC').upper() == 'DESC':
+            order.reverse()
+        selected = order[page * page_size:(page + 1) * page_size]
+        total_pages = int(math.ceil(fleet.n_devices / float(page_size))) if page_size else 0
+        return {'data': [fleet.device(i) for i in selected],
+                'totalPages': total_pages,
+                'totalElements': fleet.n_devices,
+                'hasNext': page + 1 < total_pages}
+
+    def timeseries(self, i_dev: int, query: dict) -> dict:
+        start_ts = int(query.get('startTs', 0))
+        end_ts = int(query.get('endTs', self.fleet.end_ms))
+        limit = int(query.get('limit', 100))
+        interval = int(query['interval']) if query.get('interval') else None
+        strict = str(query.get('useStrictDataTypes')).lower() == 'true'       # the generated client sends True
+        result = {}
+        for key in query.get('keys', '').split(','):
+            raw = self.fleet.get_timeseries(i_dev, key, start_ts, end_ts, limit,
+                                            agg=query.get('agg'), interval=interval, strict=strict)
+            if raw:
+                result[key] = raw
+        return result
+
+    def find_entity_data(self, body: dict) -> dict:
+        fleet = self.fleet
+        entity_filter = body.get('entityFilter') or {}
+        if entity_filter.get('type') == 'entityList':
+            lst_dev = [fleet.device_index(i) for i in entity_filter.get('entityList', [])]
+            lst_dev = [i for i in lst_dev if i is not None]
+        elif entity_filter.get('type') == 'relationsQuery':
+            # sites only contain devices, one level deep
+            i_site = fleet.asset_index((entity_filter.get('rootEntity') or {}).get('id', ''))
+            entity_types = [t for f in entity_filter.get('filters') or [] for t in f.get('entityTypes') or []]
+            wanted = entity_filter.get('direction') == 'FROM' and (not entity_types or 'DEVICE' in entity_types)
+            lst_dev = fleet.site_devices(i_site) if i_site is not None and wanted else []
+        else:
+            lst_dev = list(range(fleet.n_devices))
+
+        page_link = body.get('pageLink') or {}
+        page_size = int(page_link.get('pageSize') or 100)
+        page = int(page_link.get('page') or 0)
+        selected = lst_dev[page * page_size:(page + 1) * page_size]
+
+        data = []
+        for i_dev in selected:
+            latest = {}
+            for latest_value in body.get('latestValues') or []:
+                values = latest.setdefault(latest_value['type'], {})
+                last = fleet.get_latest(i_dev, latest_value['key']) if latest_value['type'] == 'TIME_SERIES' else None
+                values[latest_value['key']] = last or {'ts': 0, 'value': ''}
+            device = fleet.device(i_dev)
+            for field in body.get('entityFields') or []:
+                if field.get('key') in device:
+                    value = device[field['key']]
+                    latest.setdefault('ENTITY_FIELD', {})[field['key']] = {'ts': 0, 'value': '' if value is None
+                                                                           else str(value)}
+            data.append({'entityId': {'entityType': 'DEVICE', 'id': fleet.device_id(i_dev)},
+                         'latest': latest, 'timeseries': {}})
+
+        total_pages = int(math.ceil(len(lst_dev) / float(page_size))) if page_size else 0
+        return {'data': data, 'totalPages': total_pages, 'totalElements': len(lst_dev), 'hasNext': page + 1 < total_pages}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Local thingsboard stand-in serving a synthetic fleet')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=100, help='number of devices in the fleet')
+    parser.add_argument('--keys', type=int, default=None, help='only serve the first KEYS keys of DEFAULT_KEYS')
+    parser.add_argument('--period-ms', type=int, default=60000, help='time between two values of a key')
+    parser.add_argument('--history-days', type=int, default=30)
+    parser.add_argument('--customer', default='AOMS OPS')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--latency-jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO)
+
+    fleet = SyntheticFleet(n_devices=args.devices, keys=DEFAULT_KEYS[:args.keys] if args.keys else None,
+                           period_ms=args.period_ms, history_days=args.history_days, customer_name=args.customer)
+    mock = MockThingsBoard(fleet, host=args.host, port=args.port, latency_ms=args.latency_ms,
+                           latency_jitter_ms=args.latency_jitter_ms, error_rate=args.error_rate,
+                           rate_limit_rate=args.rate_limit_rate)
+    logger = logging.getLogger()
+    logger.info('serving %d devices (260A%d - 260A%d) of customer %s on %s, any username and password' %
+                (fleet.n_devices, fleet.first_node, fleet.first_node + fleet.n_devices - 1, fleet.customer_name,
+                 mock.url))
+    mock.serve_forever()
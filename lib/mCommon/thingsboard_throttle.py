@@ -0,0 +1,204 @@
+## Back-pressure for thingsboard requests: token bucket rate limit and adaptive concurrency
+import time
+import random
+import asyncio
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+
+logger = logging.getLogger(__name__)
+
+OVERLOAD_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_RETRY_AFTER_SECONDS = 1.0
+LATENCY_TARGET_SECONDS = 2.0            # answer time of a request without points (listing, login, empty page)
+LATENCY_PER_POINT_SECONDS = 0.0005      # added to the target per point answered: 2.5 s more for a 5000 points page
+
+
+# Seconds to wait from a Retry-After header value (seconds or HTTP date), None if absent or unreadable
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+# (overloaded, retry_after) of a failed request: thingsboard answered 429 or 5xx, or the connection failed or timed
+# out. retry_after is the Retry-After of the answer if any
+def overload_info(exc: Exception):
+    status = getattr(exc, 'status', None)
+    if status is not None:
+        if status not in OVERLOAD_STATUSES:
+            return False, None
+        headers = getattr(exc, 'headers', None) or {}
+        return True, parse_retry_after(headers.get('Retry-After'))
+
+    # connection errors and timeouts: OSError covers socket, asyncio and aiohttp ones, urllib3 has its own root
+    if isinstance(exc, (OSError, asyncio.TimeoutError)) or type(exc).__module__.startswith('urllib3'):
+        return True, None
+
+    return False, None
+
+
+class RequestThrottle(object):
+    '''
+    Shared back-pressure for thingsboard requests, combining
+        - a token bucket: at most rate requests per second on average, bursts of up to burst requests
+        - an adaptive concurrency limit (AIMD): grows by one request in flight per limit requests answered within
+          their latency target, halves on every 429 / 5xx / connection failure and shrinks by 10% on slow answers.
+          The target of a request is latency_target_s plus latency_per_point_s per point it returned, a full page of
+          telemetry taking longer than a listing page without the server being any slower
+        - a pause honoring Retry-After: no request is started before it expires
+    call() runs a request through it, retrying overloaded requests up to max_retries times with jittered backoff,
+    points_of giving the number of points of a result. call_async() does the same for coroutines without blocking the
+    event loop.
+    '''
+    def __init__(self, rate: float = 50.0, burst: int = 50, initial_concurrency: int = 4,
+                 min_concurrency: int = 1, max_concurrency: int = 32,
+                 latency_target_s: float = LATENCY_TARGET_SECONDS,
+                 latency_per_point_s: float = LATENCY_PER_POINT_SECONDS, max_retries: int = 5):
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target_s = latency_target_s
+        self.latency_per_point_s = latency_per_point_s
+        self.max_retries = max_retries
+
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._tokens_ts = time.monotonic()
+        self._limit = float(max(min_concurrency, min(initial_concurrency, max_concurrency)))
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._local = threading.local()
+        self.stats = {'requests': 0, 'retries': 0, 'overloads': 0, 'slow': 0}
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def last_retries(self) -> int:
+        # retries of the last call() of the calling thread
+        return getattr(self._local, 'retries', 0)
+
+    def _try_acquire(self) -> float:
+        # under self._cond: take a slot and a token and return 0, or return the seconds to wait before trying again
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= int(self._limit):
+            return 0.05
+
+        self._tokens = min(float(self.burst), self._tokens + (now - self._tokens_ts) * self.rate)
+        self._tokens_ts = now
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+
+        self._tokens -= 1.0
+        self._in_flight += 1
+        return 0.0
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire()
+                if not wait:
+                    return
+                self._cond.wait(wait)
+
+    async def acquire_async(self):
+        while True:
+            with self._cond:
+                wait = self._try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, latency_s: float = None, overloaded: bool = False, retry_after: float = None,
+                points: int = 0):
+        '''
+        Give back the slot of a request, latency_s being its duration and points the number of points it returned if
+        it was answered
+        '''
+        latency_target_s = self.latency_target_s + points * self.latency_per_point_s
+        with self._cond:
+            self._in_flight -= 1
+            self.stats['requests'] += 1
+            if overloaded:
+                self.stats['overloads'] += 1
+                self._limit = max(float(self.min_concurrency), self._limit / 2.0)
+                pause = retry_after if retry_after is not None else 0.0
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+                logger.debug('RequestThrottle: overloaded, limit %d, paused %.1f s' % (self._limit, pause))
+            elif latency_s is not None and latency_s > latency_target_s:
+                self.stats['slow'] += 1
+                self._limit = max(float(self.min_concurrency), self._limit * 0.9)
+            elif latency_s is not None:
+                self._limit = min(float(self.max_concurrency), self._limit + 1.0 / self._limit)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt: int, retry_after: float) -> float:
+        if retry_after is not None:
+            return retry_after
+        return min(30.0, DEFAULT_RETRY_AFTER_SECONDS * 2 ** attempt) * (0.5 + random.random() / 2)
+
+    def call(self, function, *args, points_of=None, **kwargs):
+        attempt = 0
+        while True:
+            self._local.retries = attempt
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                overloaded, retry_after = overload_info(e)
+                self.release(overloaded=overloaded, retry_after=retry_after)
+                if not overloaded or attempt >= self.max_retries:
+                    raise
+                backoff = self._backoff(attempt, retry_after)
+                logger.warning('RequestThrottle: %s, retry %d in %.1f s' % (type(e).__name__, attempt + 1, backoff))
+                with self._cond:
+                    self.stats['retries'] += 1
+                time.sleep(backoff)
+                attempt += 1
+                continue
+
+            self.release(latency_s=time.monotonic() - start, points=points_of(result) if points_of else 0)
+            return result
+
+    async def call_async(self, coroutine_function, *args, points_of=None, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire_async()
+            start = time.monotonic()
+            try:
+                result = await coroutine_function(*args, **kwargs)
+            except Exception as e:
+                overloaded, retry_after = overload_info(e)
+                self.release(overloaded=overloaded, retry_after=retry_after)
+                if not overloaded or attempt >= self.max_retries:
+                    raise
+                backoff = self._backoff(attempt, retry_after)
+                logger.warning('RequestThrottle: %s, retry %d in %.1f s' % (type(e).__name__, attempt + 1, backoff))
+                with self._cond:
+                    self.stats['retries'] += 1
+                await asyncio.sleep(backoff)
+                attempt += 1
+                continue
+
+            self.release(latency_s=time.monotonic() - start, points=points_of(result) if points_of else 0)
+            return result
+
+
+gThrottle = RequestThrottle()       # shared by every thingsboard request of the process
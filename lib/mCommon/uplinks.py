@@ -0,0 +1,110 @@
+## Missed uplink detection: gaps between consecutive uplinks longer than the reporting period allows
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+GAP_TOLERANCE = 0.5             # a gap is an interval over frequency_ms * (1 + GAP_TOLERANCE)
+
+# Gaps of one device, all arrays in the order of the gaps:
+#   count       number of gaps
+#   lengths     float64 length of each gap (ms)
+#   positions   int64 position, in the sorted uplink timestamps, of the uplink ending each gap
+#   ts_before   float64 timestamp (ms) of the uplink before each gap
+#   ts_after    float64 timestamp (ms) of the uplink ending each gap
+UplinkGaps = namedtuple('UplinkGaps', ['count', 'lengths', 'positions', 'ts_before', 'ts_after'])
+
+GAPS_TABLE_COLUMNS = ['Device ID', 'Missed', 'Longest gap (h)', 'Total gap (h)']
+
+
+def find_gaps(ts_ms, frequency_ms: float, tolerance: float = GAP_TOLERANCE) -> UplinkGaps:
+    '''
+    Gaps of one device from its uplink timestamps (ms, any order, NaN ignored): one numpy diff and mask, no python loop
+    '''
+    ts = np.asarray(ts_ms, dtype=np.float64)
+    ts = np.sort(ts[~np.isnan(ts)])
+
+    diff = np.diff(ts)
+    positions = np.flatnonzero(diff > frequency_ms * (1.0 + tolerance)) + 1
+
+    return UplinkGaps(len(positions), diff[positions - 1], positions, ts[positions - 1], ts[positions])
+
+
+# {name: UplinkGaps} from {name: uplink timestamps (ms)}
+def find_gaps_by_devices(dict_ts: dict, frequency_ms: float, tolerance: float = GAP_TOLERANCE) -> dict:
+    return {name: find_gaps(ts, frequency_ms, tolerance) for name, ts in dict_ts.items()}
+
+
+# One row per device: the number of gaps, the longest and the total gap length in hours
+def gaps_table(dict_gaps: dict) -> pd.DataFrame:
+    ms_per_hour = 1000.0 * 60 * 60
+    rows = [[name, gaps.count,
+             gaps.lengths.max() / ms_per_hour if gaps.count else 0.0,
+             gaps.lengths.sum() / ms_per_hour]
+            for name, gaps in dict_gaps.items()]
+
+    return pd.DataFrame(rows, columns=GAPS_TABLE_COLUMNS)
+
+
+BURST_SPLIT = 0.8               # uplinks more than frequency_ms * BURST_SPLIT apart belong to different bursts
+
+# Which device sent an uplink in each burst of the fleet (the uplinks of every device for one reporting period):
+#   present     bool matrix, one row per burst in time order, one column per device
+#   devices     names of the columns
+#   burst_ts    float64 timestamp (ms) of the first uplink of each burst
+#   gap_before  float64 interval (ms) between each burst and the previous one, NaN for the first one
+PresenceMatrix = namedtuple('PresenceMatrix', ['present', 'devices', 'burst_ts', 'gap_before'])
+
+
+def presence_matrix(ts_ms, names, devices: list, frequency_ms: float, split: float = BURST_SPLIT) -> PresenceMatrix:
+    '''
+    Bucket the uplinks of a fleet, given as timestamps (ms, any order, NaN ignored) and the names of their devices, into
+    bursts and record which of devices is present in each one. Names are compared case insensitively, uplinks of
+    devices not in devices are ignored. Costs a sort of the uplinks, then array operations only.
+    '''
+    devices = list(devices)
+    dict_code = {}
+    for d in devices:
+        dict_code.setdefault(str(d).upper(), len(dict_code))
+    categories = list(dict_code)
+    column = np.array([dict_code[str(d).upper()] for d in devices], dtype=np.int64)
+
+    ts = np.asarray(ts_ms, dtype=np.float64)
+    # normalize the distinct names only
+    name_codes, uniques = pd.factorize(pd.Series(names, dtype=object), use_na_sentinel=False)
+    codes = np.array([dict_code.get(str(u).upper(), -1) for u in uniques], dtype=np.int64)[name_codes]
+    keep = ~np.isnan(ts) & (codes >= 0)
+    order = np.argsort(ts[keep], kind='stable')
+    ts = ts[keep][order]
+    codes = codes[keep][order]
+
+    diff = np.diff(ts)
+    new_burst = np.concatenate(([False], diff > frequency_ms * split)) if len(ts) else np.empty(0, dtype=bool)
+    burst_id = np.cumsum(new_burst)
+    n_bursts = int(burst_id[-1]) + 1 if len(ts) else 0
+
+    present_codes = np.zeros((n_bursts, len(categories)), dtype=bool)
+    present_codes[burst_id, codes] = True
+
+    starts = np.flatnonzero(new_burst)
+    burst_ts = ts[np.concatenate(([0], starts))] if len(ts) else np.empty(0, dtype=np.float64)
+    gap_before = np.concatenate(([np.nan], diff[starts - 1])) if len(ts) else np.empty(0, dtype=np.float64)
+
+    return PresenceMatrix(present_codes[:, column], devices, burst_ts, gap_before)
+
+
+# Devices absent from a burst, one row per (device, burst) with the device name and the datetime 'ts' of the next burst,
+# in time then devices order. The first and last bursts are not checked: the time range may cut them
+def missing_nodes(presence: PresenceMatrix) -> pd.DataFrame:
+    i_burst, i_dev = np.nonzero(~presence.present[1:-1])
+
+    return pd.DataFrame({'device': np.asarray(presence.devices, dtype=object)[i_dev],
+                         'ts': pd.to_datetime(presence.burst_ts[i_burst + 2], unit='ms')}, columns=['device', 'ts'])
+
+
+# Datetimes of the bursts following a gap over frequency_ms * (1 + tolerance): no device sent anything in between
+def all_missing_bursts(presence: PresenceMatrix, frequency_ms: float,
+                       tolerance: float = GAP_TOLERANCE) -> pd.DatetimeIndex:
+    with np.errstate(invalid='ignore'):
+        mask = presence.gap_before > frequency_ms * (1.0 + tolerance)
+
+    return pd.to_datetime(presence.burst_ts[mask], unit='ms')
@@ -1,5 +1,7 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_frames import get_long_frame_by_devices, wide_frames_from_long, raw_ts_column
+from lib.mCommon.uplinks import presence_matrix, missing_nodes, all_missing_bursts
 import pandas as pd
 import yaml
 import pytz
@@ -31,9 +33,8 @@ if __name__ == '__main__':
         pass
 
     # Login to thingsboard
-    TB_URL = SETTINGS["Thingsboard"]["Host"] + ":" + str(SETTINGS["Thingsboard"]["Port"])
-    tb_client = RestClientPE(base_url=TB_URL)
-    tb_client.login(username=SETTINGS["Thingsboard"]["Username"], password=SETTINGS["Thingsboard"]["Password"])
+    tb_client = get_tb_client(SETTINGS["Thingsboard"]["Host"], SETTINGS["Thingsboard"]["Port"],
+                              SETTINGS["Thingsboard"]["Username"], SETTINGS["Thingsboard"]["Password"])
 
     # Generate device spec dictionary
     if type(SETTINGS["NodeList"]) == list:
@@ -41,8 +42,7 @@ if __name__ == '__main__':
     else:
         my_devices = [SETTINGS["NodeList"]]
 
-    device_list = get_devices_by_customer_name_as_dict(tb_client, SETTINGS["Thingsboard"]["CustomerName"])
-    my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+    my_devices_specs = get_device_directory(tb_client, SETTINGS["Thingsboard"]["CustomerName"]).get_specs(my_devices)
     logger.debug(my_devices_specs)
 
     # Generate while loop variables
@@ -57,6 +57,11 @@ if __name__ == '__main__':
                  'data.E.payload.T.25', 'data.E.payload.T.26', 'data.E.payload.T.27',
                  'data.E.payload.T.28', 'data.E.payload.T.29', 'data.E.payload.T.30'
                  ]
+
+    # Only request the keys each device has
+    key_index = get_key_index(tb_client)
+    for dev_eui, skipped in key_index.skip_report(my_devices_specs, keys_list).items():
+        logger.info('%s: %d keys never reported, skipped: %s' % (dev_eui, len(skipped), ', '.join(skipped)))
     start_ts = int(pytz.timezone("America/New_York").localize(
         datetime(year=int(SETTINGS["StartTimestamp"]["Year"]),
                  month=int(SETTINGS["StartTimestamp"]["Month"]),
@@ -74,35 +79,28 @@ if __name__ == '__main__':
     LOW_TEMP_THRESHOLD = SETTINGS["LowTempThreshold"]
     FREQUENCY_MS = SETTINGS["FrequencyMS"]
 
-    df_dict = {}
     failure_flags = {}
+    uplink_devices = []             # devices with uplinks in the time range, in my_devices order
+
+    # Download the temperatures and frame counts of every device: the values of each key for the checks, and one wide
+    # dataframe per device
+    df_long, _ = get_long_frame_by_devices(tb_client, my_devices_specs, keys_list + ["network.fcnt"],
+                                           start_ts=start_ts, end_ts=end_ts, key_index=key_index)
+    df_dict = wide_frames_from_long(df_long)
+    dict_long = dict(tuple(df_long.groupby('device', observed=False, sort=False)))
 
-    # While loop to pull data and fill dicts
+    # While loop to check the data
     for dev_eui in my_devices:
         failure_flags[dev_eui] = 0
         logger.info('Processing %s ...' % dev_eui)
-        try:
-            this_dev_spec = my_devices_specs[dev_eui]
-        except KeyError:
+        if dev_eui not in df_dict:
             logger.warning("Node id %s not found in thingsboard. Moving on." % dev_eui)
             continue
-        this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
-
-        # Get data into dataframe for each key
-        df_dict[dev_eui] = pd.DataFrame()
-        for e, k in enumerate(keys_list):
-            logger.debug('processing key %s' % k)
-            data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts, end_ts=end_ts)
-
-            df_data = pd.DataFrame.from_records(data)
-            if df_data.empty:
-                logger.debug("Empty dataframe.")
-                continue
-            if e == 0:
-                df_data['tsr'] = df_data['ts']
-            df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-            df_data['value'] = df_data['value'].apply(pd.to_numeric)
-            df_data.rename(columns={"value": k}, inplace=True)
+
+        # Check the values of each key
+        df_dev = dict_long[dev_eui]
+        for k, df_data in df_dev[df_dev['key'].isin(keys_list)].groupby('key', observed=True, sort=False):
+            df_data = df_data.rename(columns={"value": k})
 
             missing_data_list = df_data.loc[df_data[k].isnull(), 'ts'].tolist()
             if missing_data_list:
@@ -127,24 +125,16 @@ if __name__ == '__main__':
                         f"{dev_eui}: Low temperature found on sensor {k} at {low_temp_list_ts[c]}. "
                         f"Temp value: {low_temp_pt}")
 
-            df_data.set_index('ts', inplace=True)
+            logger.debug('%s: %d' % (k, len(df_data)))
 
-            df_dict[dev_eui] = pd.concat([df_dict[dev_eui], df_data], axis=1)
-            logger.debug('%s: %d' % (k, len(data)))
-
-
-        # Check framecount
-        data = get_timeseries_by_device(tb_client, this_dev, ["network.fcnt"], start_ts=start_ts, end_ts=end_ts)
+        # no value of the first key: no uplink in the time range at all
+        if keys_list[0] not in df_dict[dev_eui].columns:
+            logger.warning("%s: no %s data in the time range. Moving on." % (dev_eui, keys_list[0]))
+            failure_flags[dev_eui] = 1
+            continue
 
-        df_data = pd.DataFrame.from_records(data)
-        if df_data.empty:
-            logger.debug("Empty dataframe.")
-        else:
-            df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-            df_data['value'] = df_data['value'].apply(pd.to_numeric)
-            df_data.rename(columns={"value": "network.fcnt"}, inplace=True)
-            df_data.set_index('ts', inplace=True)
-            df_dict[dev_eui] = pd.concat([df_dict[dev_eui], df_data], axis=1)
+        # tsr: ms timestamp of the rows with a value of the first key
+        df_dict[dev_eui].insert(1, 'tsr', raw_ts_column(df_dict[dev_eui], keys_list[0]))
 
         # Finalize df
         df_dict[dev_eui].to_excel(path.join(SCRIPT_PATH, 'output',
@@ -152,18 +142,21 @@ if __name__ == '__main__':
                                   index_label='Timestamp',
                                   freeze_panes=(1, 0))
         df_dict[dev_eui]["DeviceID"] = dev_eui
+        uplink_devices.append(dev_eui)
 
         # for i in range(1, 6):
         #     logger.info(f"Progress: {i}/5 seconds")
         #     time.sleep(1)
 
-    global_df = pd.DataFrame()
-
-    for dev_eui in my_devices:
-        global_df = pd.concat([global_df, df_dict[dev_eui]])
+    # Every device with uplinks in one dataframe
+    global_columns = ['tsr', 'DeviceID', "network.fcnt"]
+    if uplink_devices:
+        global_df = pd.concat([df_dict[dev_eui] for dev_eui in uplink_devices])
+    else:
+        global_df = pd.DataFrame(columns=global_columns)
 
     global_df = global_df.sort_index()
-    global_df = global_df[['tsr', 'DeviceID', "network.fcnt"]]
+    global_df = global_df.reindex(columns=global_columns)
     global_df['tsr diff'] = global_df['tsr'].diff()
 
     # Check framecount
@@ -178,27 +171,19 @@ if __name__ == '__main__':
             for dev in my_devices:
                 failure_flags[dev] = 1
 
-    # Check for missing data based on frequency
-    devices_found = []
-    first_time = 1
-    for index, row in global_df.iterrows():
-        if row['tsr diff'] > FREQUENCY_MS-(FREQUENCY_MS*0.2):
-            if first_time:
-                first_time = 0
-            else:
-                for dev in my_devices:
-                    if dev.upper() not in devices_found:
-                        failure_flags[dev] = 1
-                        logger.info(
-                            f"{dev}: Data missing just before {index}.")
-
-            if row['tsr diff'] > FREQUENCY_MS+(FREQUENCY_MS*0.5):
-                logger.info(f"Data missing for all nodes just before {index}.")
-                for dev in my_devices:
-                    failure_flags[dev] = 1
-
-            devices_found = []
-        devices_found.append(row['DeviceID'])
+    # Check for missing data based on frequency: which nodes sent an uplink in each burst of uplinks of the fleet
+    df_uplinks = global_df[global_df['tsr'].notna()]
+    presence = presence_matrix(df_uplinks['tsr'].to_numpy(), df_uplinks['DeviceID'].to_numpy(),
+                               uplink_devices, FREQUENCY_MS)
+    df_missing = missing_nodes(presence)
+    for dev, index in zip(df_missing['device'], df_missing['ts']):
+        failure_flags[dev] = 1
+        logger.info(f"{dev}: Data missing just before {index}.")
+
+    for index in all_missing_bursts(presence, FREQUENCY_MS):
+        logger.info(f"Data missing for all nodes just before {index}.")
+        for dev in my_devices:
+            failure_flags[dev] = 1
 
     global_df.to_excel(path.join(SCRIPT_PATH, 'output',
                                  'global.xlsx'),
@@ -206,8 +191,9 @@ if __name__ == '__main__':
                        freeze_panes=(1, 0))
 
     for dev_eui in my_devices:
-        global_df = pd.concat([global_df, df_dict[dev_eui]])
         if failure_flags[dev_eui]:
             logger.info(f"ID {dev_eui}: FAILURE!!!")
         else:
             logger.info(f"ID {dev_eui}: Pass!")
+
+    logger.info('fetch metrics: %s' % gMetrics.summary())
@@ -1,5 +1,7 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_memo import get_frame_memo, show_memo_controls
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib
@@ -11,11 +13,14 @@ import streamlit as st
 from datetime import datetime as dt
 from datetime import date as d
 from datetime import time as t
+import time
 
 
 # MODE = 0 ==> BV difference on Creed Active rising edge distribution
 # MODE = 1 ==> A distribution
 
+DOWNLOAD_TIME_LIMIT_SECONDS = 120      # downloading stops after this, pressing Done again continues from the cache
+
 # Expanders setup
 eth = st.expander('ThingsBoard')
 tm = st.expander('Start time stamp')
@@ -74,6 +79,8 @@ if blNodes is not None:
 if Hw_v is not None:
     HardwareVersion = Hw_v.getvalue().decode('utf-8').splitlines()
 
+# Run on Done only, widget edits do not download. Pressing it again for the same query reuses the memoized
+# downloads
 if st.button('Done'):
     SCRIPT_PATH = path.dirname(path.realpath(__file__))
     SETTINGS_PATH = path.join(SCRIPT_PATH, 'settings.yaml')
@@ -114,10 +121,12 @@ if st.button('Done'):
         # except:
         #     pass
 
+        # Fetch metrics of this run only, the other sessions keep theirs
+        session_metrics()
+
         # Login to thingsboard
-        TB_URL = ThingsBoard['Host'] + ":" + str(ThingsBoard['Port'])
-        tb_client = RestClientPE(base_url=TB_URL)
-        tb_client.login(username=ThingsBoard['Username'], password=ThingsBoard['Password'])
+        tb_client = get_tb_client(ThingsBoard['Host'], ThingsBoard['Port'],
+                                  ThingsBoard['Username'], ThingsBoard['Password'])
 
         # Generate device spec dictionary
         if NodeList:
@@ -128,8 +137,7 @@ if st.button('Done'):
         else:
             my_devices = get_node_list_from_startid_and_endid(StartNode, EndNode)
 
-        device_list = get_devices_by_customer_name_as_dict(tb_client, ThingsBoard['CustomerName'])
-        my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+        my_devices_specs = get_device_directory(tb_client, ThingsBoard['CustomerName']).get_specs(my_devices)
         logger.info(my_devices_specs)
 
         # Variable generation for while loop
@@ -147,43 +155,47 @@ if st.button('Done'):
                 distribution_vals[str(n / 10)] = []
             aggregate_title = "Maximum battery difference"
 
+        # Keep only the devices whose current hardware version matches, before downloading anything
+        dict_rejected = {}
         if HardwareVersion:
-            keys_list.append('data.D.payload.ASCII.1.brd_ver')
+            my_devices_specs, dict_rejected = filter_devices_by_latest(
+                tb_client, my_devices_specs, timeseries_filters={'data.D.payload.ASCII.1.brd_ver': HardwareVersion})
 
         start_ts = int(pytz.timezone("America/New_York").localize(
             datetime(year=TimeStamp['Year'], month=TimeStamp['Month'],
                      day=TimeStamp['Day'], hour=0)).timestamp()) * 1000
 
+        # Download every device and key, one wide dataframe per device. The values go through the timeseries cache so
+        # that a download cut short by the time limit is continued, not restarted, by the next run
+        frames, dict_failed = get_wide_frames_by_devices(tb_client, my_devices_specs, keys_list, start_ts=start_ts,
+                                                         memo=get_frame_memo(), cache=get_timeseries_cache(tb_client),
+                                                         deadline=time.time() + DOWNLOAD_TIME_LIMIT_SECONDS)
+        n_incomplete = sum([isinstance(e, DownloadIncomplete) for failed in dict_failed.values()
+                            for e in failed.values()])
+        if n_incomplete:
+            st.warning('%d downloads not finished after %d s, press Done again to continue them' %
+                       (n_incomplete, DOWNLOAD_TIME_LIMIT_SECONDS))
+            show_metrics_expander()
+            st.stop()
+
         first_found_aggregate_val = 1
         aggregate_val = 0
         # While loop to pull data and fill battery differences distributions dict
         for dev_eui in my_devices:
             logger.info('processing %s' % dev_eui)
-            try:
-                this_dev_spec = my_devices_specs[dev_eui]
-            except KeyError:
+            if dev_eui in dict_rejected:
+                logger.info("Device filtered out: %s" % dict_rejected[dev_eui])
+                continue
+            if dev_eui not in my_devices_specs:
                 logger.warning("Node id %s not found in thingsboard. Moving on." % dev_eui)
                 continue
-            this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
 
-            # Get data into dataframe for each key
-            df_final = pd.DataFrame()
+            df_final = frames.get(dev_eui, pd.DataFrame())
             for k in keys_list:
-                logger.info('processing key %s' % k)
-                data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts)
-
-                df_data = pd.DataFrame.from_records(data)
-                if df_data.empty:
-                    logger.info("Empty dataframe.")
+                if k not in df_final.columns:
+                    logger.info("No %s data." % k)
                     continue
-                df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-                if k != 'data.D.payload.ASCII.1.brd_ver':
-                    df_data['value'] = df_data['value'].apply(pd.to_numeric)
-                df_data.set_index('ts', inplace=True)
-                df_data.rename(columns={"value": k}, inplace=True)
-
-                df_final = pd.concat([df_final, df_data], axis=1)
-                logger.info('%s: %d' % (k, len(data)))
+                logger.info('%s: %d' % (k, df_final[k].count()))
 
             # Check for necessary data in dataframe
             if not mode:
@@ -191,23 +203,11 @@ if st.button('Done'):
                     logger.info("No creed active data found.")
                     continue
 
-            if HardwareVersion:
-                if 'data.D.payload.ASCII.1.brd_ver' not in df_final.columns:
-                    logger.info("No hardware version data found.")
-                    continue
-                df_no_none_brd_ver = df_final.copy()
-                df_no_none_brd_ver = df_no_none_brd_ver.dropna(subset=['data.D.payload.ASCII.1.brd_ver'])
-                if df_no_none_brd_ver.iloc[-1]['data.D.payload.ASCII.1.brd_ver'] in HardwareVersion:
-                    pass
-                else:
-                    logger.info("Device not the correct Skyla Hardware Version: %s" % df_no_none_brd_ver.iloc[-1][
-                        'data.D.payload.ASCII.1.brd_ver'])
-                    continue
-
             # Generate new columns in dataframe
             if not mode:
-                df_final['Toggle'] = df_final["data.N.payload.ASCII.1.creed_active"].diff(periods=-1)
-                df_final['Batt Diff'] = df_final["data.N.payload.BV"].diff(periods=-1) / -1
+                # oldest first: each row against the one before it
+                df_final['Toggle'] = df_final["data.N.payload.ASCII.1.creed_active"].diff()
+                df_final['Batt Diff'] = df_final["data.N.payload.BV"].diff() / -1
 
                 # df_final.to_excel(path.join(SCRIPT_PATH, 'output',
                 #                            '%s_%s.xlsx' % (dev_eui, start_ts)),
@@ -296,3 +296,5 @@ if st.button('Done'):
                                          f"BV_{StartNode}-{EndNode}_{start_ts}"))
 
         st.pyplot(fig)
+        show_metrics_expander()
+        show_memo_controls()
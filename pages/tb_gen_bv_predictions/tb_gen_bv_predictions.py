@@ -1,5 +1,6 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices
 import pandas as pd
 import matplotlib.pyplot as plt
 import yaml
@@ -47,9 +48,8 @@ if __name__ == '__main__':
         pass
 
     # Login to thingsboard
-    TB_URL = SETTINGS["Thingsboard"]["Host"] + ":" + str(SETTINGS["Thingsboard"]["Port"])
-    tb_client = RestClientPE(base_url=TB_URL)
-    tb_client.login(username=SETTINGS["Thingsboard"]["Username"], password=SETTINGS["Thingsboard"]["Password"])
+    tb_client = get_tb_client(SETTINGS["Thingsboard"]["Host"], SETTINGS["Thingsboard"]["Port"],
+                              SETTINGS["Thingsboard"]["Username"], SETTINGS["Thingsboard"]["Password"])
 
     # Generate device spec dictionary
     if SETTINGS["NodeList"]:
@@ -60,14 +60,19 @@ if __name__ == '__main__':
     else:
         my_devices = get_node_list_from_startid_and_endid(SETTINGS["StartNode"], SETTINGS["EndNode"])
 
-    device_list = get_devices_by_customer_name_as_dict(tb_client, SETTINGS["Thingsboard"]["CustomerName"])
-    my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+    my_devices_specs = get_device_directory(tb_client, SETTINGS["Thingsboard"]["CustomerName"]).get_specs(my_devices)
     logger.debug(my_devices_specs)
 
     # Variable generation for while loop
     keys_list = ['data.N.payload.BV']
+
+    # Keep only the devices whose current hardware version matches, before downloading anything
+    dict_rejected = {}
     if SETTINGS["HardwareVersions"]:
-        keys_list.append('data.D.payload.ASCII.1.brd_ver')
+        my_devices_specs, dict_rejected = filter_devices_by_latest(
+            tb_client, my_devices_specs,
+            timeseries_filters={'data.D.payload.ASCII.1.brd_ver': SETTINGS["HardwareVersions"]})
+
     start_ts = int(pytz.timezone("America/New_York").localize(
         datetime(year=SETTINGS["StartTimestamp"]["Year"],
                  month=SETTINGS["StartTimestamp"]["Month"],
@@ -80,48 +85,26 @@ if __name__ == '__main__':
                  hour=SETTINGS["EndTimestamp"]["Hour"])).timestamp()) * 1000
     fig, ax = plt.subplots(figsize=(12, 6))
 
+    # Timeseries cache for the cached and incremental fetch modes
+    fetch_mode = SETTINGS.get("FetchMode") or 'full'
+    cache = None
+    if fetch_mode in ('cached', 'incremental'):
+        cache = TimeseriesCache(path.join(SCRIPT_PATH, SETTINGS["CacheFile"]))
+
+    # Download every device, one dataframe per device, oldest first
+    frames, _ = get_wide_frames_by_devices(tb_client, my_devices_specs, keys_list, start_ts=start_ts, end_ts=end_ts,
+                                           cache=cache, incremental=fetch_mode == 'incremental')
+
     # While loop to pull data and fill battery differences distributions dict
     for dev_eui in my_devices:
         logger.info('processing %s ==========================================================' % dev_eui)
-        try:
-            this_dev_spec = my_devices_specs[dev_eui]
-        except KeyError:
+        if dev_eui in dict_rejected:
+            logger.debug("Device filtered out: %s" % dict_rejected[dev_eui])
+            continue
+        if dev_eui not in frames:
             logger.warning("Node id %s not found in thingsboard. Moving on." % dev_eui)
             continue
-        this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
-
-        # Get data into dataframe for each key
-        df_final = pd.DataFrame()
-        for k in keys_list:
-            logger.debug('processing key %s' % k)
-            data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts, end_ts=end_ts)
-
-            df_data = pd.DataFrame.from_records(data)
-            if df_data.empty:
-                logger.debug("Empty dataframe.")
-                continue
-            df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-            if k != 'data.D.payload.ASCII.1.brd_ver':
-                df_data['value'] = df_data['value'].apply(pd.to_numeric)
-            df_data.set_index('ts', inplace=True)
-            df_data.rename(columns={"value": k}, inplace=True)
-
-            df_final = pd.concat([df_final, df_data], axis=1)
-            logger.debug('%s: %d' % (k, len(data)))
-
-        # Remove device ids that don't match specified hardware versions
-        if SETTINGS["HardwareVersions"]:
-            if 'data.D.payload.ASCII.1.brd_ver' not in df_final.columns:
-                logger.debug("No hardware version data found.")
-                continue
-            df_no_none_brd_ver = df_final.copy()
-            df_no_none_brd_ver = df_no_none_brd_ver.dropna(subset=['data.D.payload.ASCII.1.brd_ver'])
-            if df_no_none_brd_ver.iloc[-1]['data.D.payload.ASCII.1.brd_ver'] in SETTINGS["HardwareVersions"]:
-                pass
-            else:
-                logger.debug("Device not the correct Skyla Hardware Version: %s" % df_no_none_brd_ver.iloc[-1][
-                    'data.D.payload.ASCII.1.brd_ver'])
-                continue
+        df_final = frames[dev_eui]
 
         df_final.to_excel(path.join(SCRIPT_PATH, 'output',
                                    '%s_%s-%s.xlsx' % (dev_eui, start_ts, end_ts)),
@@ -153,24 +136,25 @@ if __name__ == '__main__':
         predicted_ts = int(backwards_poly_eqn(3.1))
         pred_ts_str = datetime.fromtimestamp(predicted_ts)
 
-        logger.info(dev_eui + " start date: " + str(df_final.iloc[-1]['raw_ts']))
+        # oldest value first
+        logger.info(dev_eui + " start date: " + str(df_final.iloc[0]['raw_ts']))
         logger.info(dev_eui+" drop date: "+str(pred_ts_str))
-        duration = (pred_ts_str - df_final.iloc[-1]['raw_ts']).days
+        duration = (pred_ts_str - df_final.iloc[0]['raw_ts']).days
         logger.info(dev_eui + " Duration: " + str(duration))
 
         if SETTINGS["TripledNodeList"] and dev_eui.lower() in SETTINGS["TripledNodeList"]:
-            duration = (pred_ts_str - df_final.iloc[-1]['raw_ts']).days*3
+            duration = (pred_ts_str - df_final.iloc[0]['raw_ts']).days*3
             logger.info(dev_eui + " Tripled Duration: " + str(duration))
-            new_drop_date = df_final.iloc[-1]['raw_ts'] + timedelta(days=duration)
+            new_drop_date = df_final.iloc[0]['raw_ts'] + timedelta(days=duration)
             logger.info(dev_eui + " Tripled drop date: " + str(new_drop_date))
 
-            pred_x3 = [df_final.index[-1], new_drop_date]
-            pred_y3 = [df_final["data.N.payload.BV"][-1], 3.1]
+            pred_x3 = [df_final.index[0], new_drop_date]
+            pred_y3 = [df_final["data.N.payload.BV"].iloc[0], 3.1]
             # plt.plot(pred_x3, pred_y3, label=dev_eui + "_prediction_x3")
             ax.annotate(str(new_drop_date)[:10], (mdates.date2num(new_drop_date), 3.1), ha="center", va="top", fontsize=7)
         else:
-            pred_x = [df_final.index[-1], pred_ts_str]
-            pred_y = [df_final["data.N.payload.BV"][-1], 3.1]
+            pred_x = [df_final.index[0], pred_ts_str]
+            pred_y = [df_final["data.N.payload.BV"].iloc[0], 3.1]
             # plt.plot(pred_x, pred_y, label=dev_eui+"_prediction")
             ax.annotate(str(pred_ts_str)[:10], (mdates.date2num(pred_ts_str), 3.1), ha="center", va="top", fontsize=7)
 
@@ -184,3 +168,5 @@ if __name__ == '__main__':
 
     plt.savefig(path.join(path.join(SCRIPT_PATH, SETTINGS["OutputFolder"]),
                           f"BV_{SETTINGS['StartNode']}-{SETTINGS['EndNode']}_{start_ts}-{end_ts}"))
+
+    logger.info('fetch metrics: %s' % gMetrics.summary())
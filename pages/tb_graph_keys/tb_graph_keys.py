@@ -1,5 +1,6 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices
 import pandas as pd
 import matplotlib.pyplot as plt
 import yaml
@@ -45,9 +46,8 @@ if __name__ == '__main__':
         pass
 
     # Login to thingsboard
-    TB_URL = SETTINGS["Thingsboard"]["Host"] + ":" + str(SETTINGS["Thingsboard"]["Port"])
-    tb_client = RestClientPE(base_url=TB_URL)
-    tb_client.login(username=SETTINGS["Thingsboard"]["Username"], password=SETTINGS["Thingsboard"]["Password"])
+    tb_client = get_tb_client(SETTINGS["Thingsboard"]["Host"], SETTINGS["Thingsboard"]["Port"],
+                              SETTINGS["Thingsboard"]["Username"], SETTINGS["Thingsboard"]["Password"])
 
     # Generate device spec dictionary
     if SETTINGS["NodeList"]:
@@ -58,8 +58,7 @@ if __name__ == '__main__':
     else:
         my_devices = get_node_list_from_startid_and_endid(SETTINGS["StartNode"], SETTINGS["EndNode"])
 
-    device_list = get_devices_by_customer_name_as_dict(tb_client, SETTINGS["Thingsboard"]["CustomerName"])
-    my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+    my_devices_specs = get_device_directory(tb_client, SETTINGS["Thingsboard"]["CustomerName"]).get_specs(my_devices)
     logger.debug(my_devices_specs)
 
     # Generate while loop variables
@@ -67,35 +66,27 @@ if __name__ == '__main__':
     start_ts = int(pytz.timezone("America/New_York").localize(
         datetime(year=SETTINGS["StartTimestamp"]["Year"], month=SETTINGS["StartTimestamp"]["Month"],
                  day=SETTINGS["StartTimestamp"]["Day"], hour=0)).timestamp()) * 1000
-    df_dict = {}
+    end_ts = int(datetime.now().timestamp()) * 1000
+
+    # Only request the keys each device has
+    key_index = get_key_index(tb_client)
+    for dev_eui, skipped in key_index.skip_report(my_devices_specs, keys_list).items():
+        logger.info('%s: %d keys never reported, skipped: %s' % (dev_eui, len(skipped), ', '.join(skipped)))
+
+    # Let thingsboard aggregate long ranges
+    agg, interval = get_auto_aggregation(start_ts, end_ts, agg=SETTINGS.get("AggregationFunction", 'NONE'),
+                                         max_points=SETTINGS.get("AggregationMaxPoints", 2000),
+                                         min_range_ms=SETTINGS.get("AggregationMinHours", 48) * 3600 * 1000)
+    if agg:
+        logger.info('plotting %s over %d s intervals' % (agg, interval / 1000))
 
-    # While loop to pull data and fill dicts
     for dev_eui in my_devices:
-        logger.info('processing %s' % dev_eui)
-        try:
-            this_dev_spec = my_devices_specs[dev_eui]
-        except KeyError:
+        if dev_eui not in my_devices_specs:
             logger.warning("Node id %s not found in thingsboard. Moving on." % dev_eui)
-            continue
-        this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
-
-        # Get data into dataframe for each key
-        df_dict[dev_eui] = pd.DataFrame()
-        for k in keys_list:
-            logger.debug('processing key %s' % k)
-            data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts)
-
-            df_data = pd.DataFrame.from_records(data)
-            if df_data.empty:
-                logger.debug("Empty dataframe.")
-                continue
-            df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-            df_data['value'] = df_data['value'].apply(pd.to_numeric)
-            df_data.set_index('ts', inplace=True)
-            df_data.rename(columns={"value": k}, inplace=True)
-
-            df_dict[dev_eui] = pd.concat([df_dict[dev_eui], df_data], axis=1)
-            logger.debug('%s: %d' % (k, len(data)))
+
+    # Download every device and key, one wide dataframe per device
+    df_dict, _ = get_wide_frames_by_devices(tb_client, my_devices_specs, keys_list, start_ts=start_ts, end_ts=end_ts,
+                                            agg=agg, interval=interval, key_index=key_index)
 
     # Plot each key
     for k in keys_list:
@@ -113,3 +104,5 @@ if __name__ == '__main__':
 
         plt.legend()
         plt.show()
+
+    logger.info('fetch metrics: %s' % gMetrics.summary())
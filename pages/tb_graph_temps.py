@@ -1,5 +1,7 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_memo import get_frame_memo, show_memo_controls
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices
 import pandas as pd
 import matplotlib.pyplot as plt
 import yaml
@@ -70,6 +72,11 @@ eDate = {
     'Minute': finED.day
 }
 
+# Long ranges are plotted from values aggregated by thingsboard
+AggregationFunction = tm.selectbox('Aggregation for ranges over 48 hours', ['AVG', 'MIN', 'MAX', 'NONE'],
+                                   help='NONE = always plot the raw values')
+AggregationMaxPoints = tm.number_input('Maximum points per key', min_value=1, step=100, value=2000)
+
 
 # Debugger and mode
 debug = st.checkbox('Debug',
@@ -92,6 +99,8 @@ if blNodes is not None:
 
 
 
+# Run on Done only, widget edits do not download. Pressing it again for the same query reuses the memoized
+# downloads
 if st.button('Done'):
     SCRIPT_PATH = path.dirname(path.realpath(__file__))
     SETTINGS_PATH = path.join(SCRIPT_PATH, 'settings.yaml')
@@ -129,10 +138,12 @@ if st.button('Done'):
         except:
             pass
 
+        # Fetch metrics of this run only, the other sessions keep theirs
+        session_metrics()
+
         # Login to thingsboard
-        TB_URL = ThingsBoard['Host'] + ":" + str(ThingsBoard['Port'])
-        tb_client = RestClientPE(base_url=TB_URL)
-        tb_client.login(username=ThingsBoard['Username'], password=ThingsBoard['Password'])
+        tb_client = get_tb_client(ThingsBoard['Host'], ThingsBoard['Port'],
+                                  ThingsBoard['Username'], ThingsBoard['Password'])
 
         # Generate device spec dictionary
         if NodeList:
@@ -143,8 +154,7 @@ if st.button('Done'):
         else:
             my_devices = get_node_list_from_startid_and_endid(StartNode, EndNode)
 
-        device_list = get_devices_by_customer_name_as_dict(tb_client, ThingsBoard['CustomerName'])
-        my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+        my_devices_specs = get_device_directory(tb_client, ThingsBoard['CustomerName']).get_specs(my_devices)
         logger.debug(my_devices_specs)
 
         # Generate while loop variables
@@ -160,35 +170,19 @@ if st.button('Done'):
                      month=int(eDate['Month']),
                      day=int(eDate['Day']),
                      hour=int(eDate['Hour']))).timestamp()) * 1000
-        df_dict = {}
 
-        # While loop to pull data and fill dicts
+        agg, interval = get_auto_aggregation(start_ts, end_ts, agg=AggregationFunction,
+                                             max_points=AggregationMaxPoints)
+        if agg:
+            logger.info('plotting %s over %d s intervals' % (agg, interval / 1000))
+
         for dev_eui in my_devices:
-            logger.info('processing %s' % dev_eui)
-            try:
-                this_dev_spec = my_devices_specs[dev_eui]
-            except KeyError:
+            if dev_eui not in my_devices_specs:
                 logger.warning("Node id %s not found in thingsboard. Moving on." % dev_eui)
-                continue
-            this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
-
-            # Get data into dataframe for each key
-            df_dict[dev_eui] = pd.DataFrame()
-            for k in keys_list:
-                logger.debug('processing key %s' % k)
-                data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts, end_ts=end_ts)
-
-                df_data = pd.DataFrame.from_records(data)
-                if df_data.empty:
-                    logger.debug("Empty dataframe.")
-                    continue
-                df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-                df_data['value'] = df_data['value'].apply(pd.to_numeric)
-                df_data.set_index('ts', inplace=True)
-                df_data.rename(columns={"value": k}, inplace=True)
-
-                df_dict[dev_eui] = pd.concat([df_dict[dev_eui], df_data], axis=1)
-                logger.debug('%s: %d' % (k, len(data)))
+
+        # Download every device and key, one wide dataframe per device
+        df_dict, _ = get_wide_frames_by_devices(tb_client, my_devices_specs, keys_list, start_ts=start_ts,
+                                                end_ts=end_ts, agg=agg, interval=interval, memo=get_frame_memo())
 
         # Generate graphs pt 1
         fig, ax = plt.subplots(figsize=(12, 6))
@@ -274,4 +268,6 @@ if st.button('Done'):
         plt.title("Temperature vs Time")
         plt.legend()
 
-        #plt.show()
\ No newline at end of file
+        #plt.show()
+        show_metrics_expander()
+        show_memo_controls()
\ No newline at end of file
@@ -1,5 +1,8 @@
 from os import path, mkdir
 from lib.mCommon.thingsboard import *
+from lib.mCommon.thingsboard_memo import get_frame_memo, show_memo_controls
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices, raw_ts_column
+from lib.mCommon.uplinks import find_gaps_by_devices, gaps_table
 import pandas as pd
 import yaml
 import pytz
@@ -83,8 +86,9 @@ up = nl.file_uploader('Upload Node .txt file')
 if up is not None:
     NodeList = up.getvalue().decode('utf-8').splitlines()
 
+    # Run on Done only, widget edits do not download. Pressing it again for the same query reuses the memoized
+    # downloads
     if st.button('Done'):
-        st.write("Device ID          Num of Occurences          Lengths of occurence")
         SCRIPT_PATH = path.dirname(path.realpath(__file__))
         # SETTINGS_PATH = path.join(SCRIPT_PATH, 'settings.yaml')
         # with open(SETTINGS_PATH, 'r', encoding='utf-8') as setting:
@@ -107,10 +111,12 @@ if up is not None:
             except:
                 pass
 
+            # Fetch metrics of this run only, the other sessions keep theirs
+            session_metrics()
+
             # Login to thingsboard
-            TB_URL = ThingsBoard['Host'] + ":" + str(ThingsBoard['Port'])
-            tb_client = RestClientPE(base_url=TB_URL)
-            tb_client.login(username=ThingsBoard['Username'], password=ThingsBoard['Password'])
+            tb_client = get_tb_client(ThingsBoard['Host'], ThingsBoard['Port'],
+                                      ThingsBoard['Username'], ThingsBoard['Password'])
 
             # Generate device spec dictionary
             if type(NodeList) == list:
@@ -118,8 +124,7 @@ if up is not None:
             else:
                 my_devices = [NodeList]
 
-            device_list = get_devices_by_customer_name_as_dict(tb_client, ThingsBoard['CustomerName'])
-            my_devices_specs = {k: device_list[k] for k in device_list if k in my_devices}
+            my_devices_specs = get_device_directory(tb_client, ThingsBoard['CustomerName']).get_specs(my_devices)
             logger.debug(my_devices_specs)
 
             # Generate while loop variables
@@ -141,76 +146,59 @@ if up is not None:
             LOW_TEMP_THRESHOLD = LowTempThreshold
             FREQUENCY_MS = FrequencyMS
 
-            df_dict = {}
             failure_flags = {}
 
-            # While loop to pull data and fill dicts
+            # Download every device and key, one wide dataframe per device
+            df_dict, _ = get_wide_frames_by_devices(tb_client, my_devices_specs, keys_list,
+                                                    start_ts=start_ts, end_ts=end_ts, memo=get_frame_memo())
+
+            # While loop to check the dataframes
+            dict_ts = {}
             for dev_eui in my_devices:
                 failure_flags[dev_eui] = 0
                 logger.debug('Processing %s ...' % dev_eui)
-                try:
-                    this_dev_spec = my_devices_specs[dev_eui]
-                except KeyError:
+                if dev_eui not in df_dict:
                     logger.warning("Node id %s not found in ThingsBoard. Moving on." % dev_eui)
                     continue
-                this_dev = DeviceId(id=this_dev_spec['id']['id'], entity_type=this_dev_spec['id']['entityType'])
-
-                # Get data into dataframe for each key
-                df_dict[dev_eui] = pd.DataFrame()
-                for e, k in enumerate(keys_list):
-                    logger.debug('processing key %s' % k)
-                    data = get_timeseries_by_device(tb_client, this_dev, [k], start_ts=start_ts, end_ts=end_ts)
 
-                    df_data = pd.DataFrame.from_records(data)
-                    if df_data.empty:
-                        logger.debug("Empty dataframe.")
-                        continue
-                    if e == 0:
-                        df_data['tsr'] = df_data['ts']
-                    df_data['ts'] = pd.to_datetime(df_data['ts'], unit='ms')
-                    df_data['value'] = df_data['value'].apply(pd.to_numeric)
-                    df_data.rename(columns={"value": k}, inplace=True)
-
-                    df_data.set_index('ts', inplace=True)
+                # no value of the first key: no uplink in the time range at all
+                if keys_list[0] not in df_dict[dev_eui].columns:
+                    logger.warning("%s: no %s data in the time range. Moving on." % (dev_eui, keys_list[0]))
+                    failure_flags[dev_eui] = 1
+                    continue
 
-                    df_dict[dev_eui] = pd.concat([df_dict[dev_eui], df_data], axis=1)
-                    logger.debug('%s: %d' % (k, len(data)))
+                # tsr: ms timestamp of the rows with a value of the first key
+                df_dict[dev_eui].insert(1, 'tsr', raw_ts_column(df_dict[dev_eui], keys_list[0]))
 
                 # Finalize df
                 df_dict[dev_eui]["DeviceID"] = dev_eui
                 df_dict[dev_eui] = df_dict[dev_eui].sort_index(ascending=True)
                 df_dict[dev_eui]['tsr diff'] = df_dict[dev_eui]['tsr'].diff()
-
-                # Check for missing data based on frequency
-                devices_found = []
-                first_time = 1
-                number_messages_missed = 0
-                max_missed_interval = 0
-                for index, row in df_dict[dev_eui].iterrows():
-                    if row['tsr diff'] > FREQUENCY_MS + (FREQUENCY_MS * 0.5):
-                        if row['tsr diff'] > max_missed_interval:
-                            max_missed_interval = row['tsr diff']
-                        logger.info(f"{dev_eui}: Data missing just before {index}.")
-                        failure_flags[dev_eui] = 1
-                        number_messages_missed += 1
-
-                        devices_found = []
-                    devices_found.append(row['DeviceID'])
-
-                if failure_flags[dev_eui]:
-                    st.text(
-                        f"{dev_eui}          {number_messages_missed}          {max_missed_interval / (1000 * 60 * 60)}")
+                dict_ts[dev_eui] = df_dict[dev_eui]['tsr'].to_numpy()
 
                 df_dict[dev_eui].to_excel(path.join(SCRIPT_PATH, 'output',
                                                     '%s_%s-%s.xlsx' % (dev_eui, start_ts, end_ts)),
                                           index_label='Timestamp',
                                           freeze_panes=(1, 0))
 
+            # Check for missing data based on frequency
+            dict_gaps = find_gaps_by_devices(dict_ts, FREQUENCY_MS)
+            for dev_eui, gaps in dict_gaps.items():
+                for index in pd.to_datetime(gaps.ts_after, unit='ms'):
+                    logger.info(f"{dev_eui}: Data missing just before {index}.")
+                failure_flags[dev_eui] = int(gaps.count > 0)
+
+            df_gaps = gaps_table(dict_gaps)
+            st.dataframe(df_gaps[df_gaps['Missed'] > 0], hide_index=True)
+
             for dev_eui in my_devices:
                 if failure_flags[dev_eui]:
                     logger.info(f"ID {dev_eui}: FAILURE!!!")
                 else:
                     logger.info(f"ID {dev_eui}: Pass!")
 
+            show_metrics_expander()
+            show_memo_controls()
+
 else:
     st.warning('Upload Node File')
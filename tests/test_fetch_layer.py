@@ -0,0 +1,214 @@
+## Regression tests of the telemetry fetch layer against the local thingsboard stand-in
+#
+#   python -m pytest tests
+#
+# Every result is checked against the values SyntheticFleet computes, the ground truth of the mock.
+import time
+import numpy as np
+import pytest
+
+# fail, not skip, without the REST client: a skipped suite would check nothing
+try:
+    import tb_rest_client32
+except ImportError as e:
+    raise ImportError('the fetch layer tests need the ThingsBoard REST client (tb_rest_client32), '
+                      'see lib/mCommon/requirements.txt') from e
+
+from lib.mCommon.thingsboard import get_tb_client, get_devices_by_customer_name_as_dict, device_id_from_spec, \
+    get_timeseries_all, get_timeseries_by_device, get_timeseries_by_devices, get_timeseries_cached, \
+    get_timeseries_incremental, DownloadIncomplete, gMetrics
+from lib.mCommon.thingsboard_cache import TimeseriesCache
+from lib.mCommon.thingsboard_frames import get_wide_frames_by_devices
+from lib.mCommon.thingsboard_mock import MockThingsBoard, SyntheticFleet
+
+KEYS = ['data.N.payload.BV', 'data.B.frame_count', 'data.E.payload.T.1']
+TELEMETRY = '/api/plugins/telemetry/.../values/timeseries'
+HOUR_MS = 3600 * 1000
+
+
+@pytest.fixture(scope='module')
+def mock():
+    with MockThingsBoard(SyntheticFleet(n_devices=4, keys=KEYS, history_days=2), port=0, seed=1) as mock:
+        yield mock
+
+
+@pytest.fixture(scope='module')
+def tb_client(mock):
+    return get_tb_client(mock.host, mock.port, 'tester', 'password')
+
+
+@pytest.fixture(scope='module')
+def specs(tb_client, mock):
+    return get_devices_by_customer_name_as_dict(tb_client, mock.fleet.customer_name)
+
+
+@pytest.fixture(autouse=True)
+def clean_mock(mock):
+    mock.rate_limit_rate = 0
+    mock.error_rate = 0
+    mock.reset_stats()
+    yield
+
+
+# Values of the fleet, newest first as thingsboard answers
+def _truth(fleet, spec, key, start_ts, end_ts):
+    return fleet.get_timeseries(fleet.device_index(spec['id']['id']), key, start_ts, end_ts, limit=10 ** 9)
+
+
+def _window(fleet, hours):
+    # well before now, outside the settle window of the cache
+    end_ts = fleet.end_ms - HOUR_MS
+    return end_ts - hours * HOUR_MS, end_ts
+
+
+def test_paging_across_page_boundaries(mock, tb_client, specs):
+    fleet = mock.fleet
+    spec = specs['260A2001']
+    start_ts, end_ts = _window(fleet, 5)
+
+    raw = get_timeseries_all(tb_client, device_id_from_spec(spec), KEYS[0], start_ts, end_ts=end_ts, page_limit=70)
+
+    truth = _truth(fleet, spec, KEYS[0], start_ts, end_ts)
+    assert len(truth) == 300
+    assert raw == truth
+    assert mock.stats['by_endpoint'][TELEMETRY] == 5        # 4 full pages of 70 and a short one
+
+
+def test_retries_on_rate_limit(mock, tb_client, specs):
+    fleet = mock.fleet
+    spec = specs['260A2002']
+    start_ts, end_ts = _window(fleet, 3)
+    mock.rate_limit_rate = 0.5
+    gMetrics.reset()
+
+    raw = get_timeseries_all(tb_client, device_id_from_spec(spec), KEYS[1], start_ts, end_ts=end_ts, page_limit=60)
+
+    assert raw == _truth(fleet, spec, KEYS[1], start_ts, end_ts)
+    # urllib3 retries some 429s on its own (Retry-After), gThrottle the others: none may surface
+    assert mock.stats['rate_limited'] > 0
+    assert gMetrics.summary()['errors'] == 0
+
+
+def test_multi_key(mock, tb_client, specs):
+    fleet = mock.fleet
+    spec = specs['260A2003']
+    start_ts, end_ts = _window(fleet, 2)
+
+    rows = get_timeseries_by_device(tb_client, device_id_from_spec(spec), KEYS, start_ts=start_ts, end_ts=end_ts,
+                                    multi_key=True)
+
+    expected = {}
+    for k in KEYS:
+        for d in _truth(fleet, spec, k, start_ts, end_ts):
+            expected.setdefault(d['ts'], {'ts': d['ts']})[k] = d['value']
+    assert rows == [expected[ts] for ts in sorted(expected)]
+    assert mock.stats['by_endpoint'][TELEMETRY] == 1        # every key in the same request
+
+
+def test_cache_refetches_gaps_only(mock, tb_client, specs):
+    fleet = mock.fleet
+    spec = specs['260A2000']
+    dev_id = device_id_from_spec(spec)
+    cache = TimeseriesCache(':memory:')
+    start_ts, end_ts = _window(fleet, 6)
+    middle_ts = start_ts + 3 * HOUR_MS
+
+    get_timeseries_cached(tb_client, cache, dev_id, KEYS[0], middle_ts, end_ts=end_ts, page_limit=5000)
+    assert mock.stats['by_endpoint'][TELEMETRY] == 1
+
+    # covered: answered from the cache
+    mock.reset_stats()
+    assert get_timeseries_cached(tb_client, cache, dev_id, KEYS[0], middle_ts, end_ts=end_ts) == \
+        _truth(fleet, spec, KEYS[0], middle_ts, end_ts)
+    assert mock.stats['requests'] == 0
+
+    # half covered: only the older half is downloaded
+    mock.reset_stats()
+    raw = get_timeseries_cached(tb_client, cache, dev_id, KEYS[0], start_ts, end_ts=end_ts, page_limit=5000)
+    assert raw == _truth(fleet, spec, KEYS[0], start_ts, end_ts)
+    assert mock.stats['by_endpoint'][TELEMETRY] == 1
+    assert cache.get_missing_intervals(dev_id, KEYS[0], start_ts, end_ts) == []
+    cache.close()
+
+
+@pytest.mark.parametrize('incremental', [False, True])
+def test_deadline_resumes_from_the_cache(mock, tb_client, specs, incremental):
+    fleet = mock.fleet
+    cache = TimeseriesCache(':memory:')
+    start_ts, end_ts = _window(fleet, 3)
+    with pytest.raises(ValueError):
+        get_timeseries_by_devices(tb_client, specs, KEYS[:1], start_ts=start_ts, end_ts=end_ts, deadline=0)
+
+    # slow pages: the deadline cuts the download short
+    spec_one = {'260A2002': specs['260A2002']}
+    mock.latency_ms = 100
+    try:
+        dict_raw, dict_failed = get_timeseries_by_devices(tb_client, spec_one, KEYS[:1], start_ts=start_ts,
+                                                          end_ts=end_ts, page_limit=20, cache=cache,
+                                                          incremental=incremental, deadline=time.time() + 0.3)
+    finally:
+        mock.latency_ms = 0
+    truth = _truth(fleet, spec_one['260A2002'], KEYS[0], start_ts, end_ts)
+    assert isinstance(dict_failed['260A2002'][KEYS[0]], DownloadIncomplete)
+    assert 0 < len(dict_raw['260A2002'][KEYS[0]]) < len(truth)
+    n_first = mock.stats['by_endpoint'][TELEMETRY]
+
+    # the next run continues where the first one stopped
+    mock.reset_stats()
+    dict_raw, dict_failed = get_timeseries_by_devices(tb_client, spec_one, KEYS[:1], start_ts=start_ts,
+                                                      end_ts=end_ts, page_limit=20, cache=cache,
+                                                      incremental=incremental, deadline=time.time() + 60)
+    assert dict_failed == {}
+    assert dict_raw['260A2002'][KEYS[0]] == truth
+    assert n_first + mock.stats['by_endpoint'][TELEMETRY] <= len(truth) // 20 + 3
+    cache.close()
+
+
+def test_incremental_late_values_and_data_types(mock, tb_client, specs, monkeypatch):
+    fleet = mock.fleet
+    spec = specs['260A2001']
+    dev_id = device_id_from_spec(spec)
+    cache = TimeseriesCache(':memory:', settle_ms=10 * 60 * 1000)
+    start_ts, end_ts = _window(fleet, 2)
+    late_start_ts, late_end_ts = end_ts - 4 * 60 * 1000, end_ts - 2 * 60 * 1000
+    truth = _truth(fleet, spec, KEYS[0], start_ts, end_ts)
+
+    # first run: a few minutes before the end had not reached thingsboard yet
+    get_timeseries = fleet.get_timeseries
+    monkeypatch.setattr(fleet, 'get_timeseries', lambda *args, **kwargs: [
+        d for d in get_timeseries(*args, **kwargs) if not late_start_ts <= d['ts'] <= late_end_ts])
+    first = get_timeseries_incremental(tb_client, cache, dev_id, KEYS[0], start_ts, end_ts=end_ts)
+    assert len(first) < len(truth)
+
+    # next run: the settle window behind the watermark is downloaded again
+    monkeypatch.setattr(fleet, 'get_timeseries', get_timeseries)
+    raw = get_timeseries_incremental(tb_client, cache, dev_id, KEYS[0], start_ts, end_ts=end_ts + HOUR_MS)
+    assert raw == _truth(fleet, spec, KEYS[0], start_ts, end_ts + HOUR_MS)
+
+    # typed values are cached apart from the strings
+    typed = get_timeseries_incremental(tb_client, cache, dev_id, KEYS[0], start_ts, end_ts=end_ts,
+                                       use_strict_data_types=True)
+    assert typed == fleet.get_timeseries(fleet.device_index(spec['id']['id']), KEYS[0], start_ts, end_ts,
+                                         limit=10 ** 9, strict=True)
+    assert all(isinstance(d['value'], str) for d in cache.get_values(dev_id, KEYS[0], start_ts, end_ts))
+    cache.close()
+
+
+def test_wide_frames(mock, tb_client, specs):
+    fleet = mock.fleet
+    start_ts, end_ts = _window(fleet, 4)
+
+    frames, dict_failed = get_wide_frames_by_devices(tb_client, specs, KEYS, start_ts=start_ts, end_ts=end_ts,
+                                                     page_limit=100)
+
+    assert dict_failed == {}
+    assert list(frames) == list(specs)
+    for name, spec in specs.items():
+        df = frames[name]
+        ts_ms = df.index.to_numpy(dtype='datetime64[ms]').astype(np.int64)
+        assert (np.diff(ts_ms) > 0).all()
+        for k in KEYS:
+            truth = _truth(fleet, spec, k, start_ts, end_ts)[::-1]
+            present = df[k].notna().to_numpy()
+            assert ts_ms[present].tolist() == [d['ts'] for d in truth]
+            assert df[k].to_numpy()[present].tolist() == [float(d['value']) for d in truth]